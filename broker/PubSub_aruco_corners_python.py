@@ -24,6 +24,8 @@ import numpy as np
 from PIL import Image, ImageTk
 import math
 
+from pubsub_json import dumpl, loads
+
 # ---------------------------
 # Configuración de referencia / robots
 # ---------------------------
@@ -196,6 +198,7 @@ class CameraThread(threading.Thread):
             corners, ids, _ = self.detector.detectMarkers(frame)
 
             tag_centers_img = {}
+            batch = []  # paquetes de este frame: se envían juntos al final
             if ids is not None:
                 ids_flat = ids.flatten()
                 # Calcular centros
@@ -221,8 +224,7 @@ class CameraThread(threading.Thread):
                                 "corners": corner_list
                             }
                         }
-                        if self.gui.client and self.gui.client.running:
-                            self.gui.client.send_json(pkt)
+                        batch.append(pkt)
 
                 # Si tenemos homografía, proyectar al mundo y calcular pose
                 if self.H is not None:
@@ -252,8 +254,10 @@ class CameraThread(threading.Thread):
                             "data": data
                         }
 
-                        if self.gui.client and self.gui.client.running:
-                            self.gui.client.send_json(pkt_pose)
+                        batch.append(pkt_pose)
+
+            if batch and self.gui.client and self.gui.client.running:
+                self.gui.client.send_many(batch)
 
             # Actualizar frame para la GUI (video con dibujos)
             self.latest_frame = frame
@@ -308,9 +312,19 @@ class PubSubClient:
             self.log("No conectado")
             return
         try:
-            data = json.dumps(obj) + "\n"
-            self.sock.send(data.encode("utf-8"))
-            self.log(f"→ Enviado: {data.strip()}")
+            data = dumpl(obj)
+            self.sock.sendall(data)
+            self.log(f"→ Enviado: {data.decode('utf-8').strip()}")
+        except Exception as e:
+            self.log(f"Error al enviar: {e}")
+
+    def send_many(self, objs):
+        """Varios paquetes en una sola escritura (p.ej. todas las poses de un frame)."""
+        if not self.sock or not objs:
+            return
+        try:
+            self.sock.sendall(b"".join(dumpl(obj) for obj in objs))
+            self.log(f"→ Enviados {len(objs)} paquetes")
         except Exception as e:
             self.log(f"Error al enviar: {e}")
 
@@ -328,7 +342,7 @@ class PubSubClient:
                     if not text:
                         continue
                     try:
-                        obj = json.loads(text)
+                        obj = loads(line)
                         self.log(f"← Recibido: {json.dumps(obj)}")
                     except Exception:
                         self.log(f"← (texto) {text}")
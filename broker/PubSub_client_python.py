@@ -8,6 +8,7 @@ Permite:
 - Publicar mensajes JSON
 - Ver los mensajes recibidos
 - Ejecutar pruebas automáticas con payloads válidos de topics.md
+- (opcional) Protocolo binario bin1 para payloads grandes (ver pubsub_wire.py)
 
 Autor: ChatGPT
 """
@@ -15,19 +16,41 @@ Autor: ChatGPT
 import socket
 import threading
 import json
+import base64
 import tkinter as tk
 from tkinter import ttk, scrolledtext, messagebox
 import time
 
+from pubsub_wire import StreamFramer, pack_frame, BinaryFrame, PROTO_BIN1, PUB, TOPIC, FLAG_RETAIN
+from pubsub_outbound import OutboundQueue, DROP_OLDEST, WRITE_BATCH_BYTES, sendmsg_all
+from pubsub_json import dumpb, dumpl, loads
+
 
 class PubSubClient:
-    def __init__(self, host="localhost", port=5051, log_func=None):
+    """
+    Cliente TCP del broker. Con max_batch > 1 los mensajes se encolan y un
+    hilo los envía agrupados: hasta max_batch por llamada a sendmsg,
+    esperando a lo sumo linger_us microsegundos a que lleguen más (útil
+    para muchas actualizaciones pequeñas de pose/estado por segundo).
+    write_stats() da mensajes y syscalls de escritura.
+    """
+    QUEUE_MESSAGES = 4096
+    QUEUE_BYTES = 16 * 1024 * 1024
+
+    def __init__(self, host="localhost", port=5051, log_func=None, binary=False, max_batch=1, linger_us=0):
         self.host = host
         self.port = port
         self.sock = None
         self.running = False
         self.thread = None
         self.log = log_func or (lambda msg: print(msg))
+        self.binary = binary
+        self._topic_ids = {}  # topic -> id ya definido en el broker (bin1)
+        self.max_batch = max(1, int(max_batch))
+        self.linger = max(0, linger_us) / 1e6
+        self._out = None  # OutboundQueue del hilo emisor (solo con max_batch > 1)
+        self.messages_sent = 0
+        self.writes = 0
 
     def connect(self):
         if self.running:
@@ -39,7 +62,13 @@ class PubSubClient:
             self.running = True
             self.thread = threading.Thread(target=self._recv_loop, daemon=True)
             self.thread.start()
+            if self.max_batch > 1:
+                self._out = OutboundQueue(self.QUEUE_MESSAGES, self.QUEUE_BYTES, DROP_OLDEST)
+                threading.Thread(target=self._send_loop, args=(self.sock, self._out), daemon=True).start()
             self.log(f"Conectado a {self.host}:{self.port}")
+            if self.binary:
+                self._topic_ids.clear()
+                self.send_json({"action": "HELLO", "proto": PROTO_BIN1})
             return True
         except Exception as e:
             self.log(f"Error de conexión: {e}")
@@ -47,6 +76,9 @@ class PubSubClient:
 
     def disconnect(self):
         self.running = False
+        if self._out is not None:
+            self._out.close()
+            self._out = None
         if self.sock:
             try:
                 self.sock.shutdown(socket.SHUT_RDWR)
@@ -64,34 +96,104 @@ class PubSubClient:
             self.log("No conectado")
             return
         try:
-            data = json.dumps(obj) + "\n"
-            self.sock.send(data.encode("utf-8"))
-            self.log(f"→ Enviado: {data.strip()}")
+            data = dumpl(obj)
+            self._write(data)
+            self.log(f"→ Enviado: {data.decode('utf-8').strip()}")
+        except Exception as e:
+            self.log(f"Error al enviar: {e}")
+
+    def publish(self, topic, data, blob=None, blob_key="frame_b64", retain=False):
+        """
+        Publica data en topic. blob (bytes) es un payload crudo opcional:
+        en modo binario viaja tal cual en un frame bin1; en modo JSON se
+        codifica en base64 dentro de data[blob_key]. Con retain=True el
+        broker lo guarda y lo entrega a quien se suscriba después.
+        """
+        if not self.binary:
+            if blob is not None:
+                data = dict(data or {})
+                data[blob_key] = base64.b64encode(blob).decode("ascii")
+            pkt = {"action": "PUB", "topic": topic, "data": data}
+            if retain:
+                pkt["retain"] = True
+            self.send_json(pkt)
+            return
+        if not self.sock:
+            self.log("No conectado")
+            return
+        try:
+            tid = self._topic_ids.get(topic)
+            if tid is None and len(self._topic_ids) < 0xFFFF:
+                tid = len(self._topic_ids) + 1
+                self._topic_ids[topic] = tid
+                self._write(pack_frame(TOPIC, tid, topic.encode("utf-8")))
+            meta = dumpb(data) if data is not None else b""
+            key = blob_key.encode("utf-8") if blob is not None else b""
+            # sin id libre el tópico viaja en línea
+            flags = FLAG_RETAIN if retain else 0
+            self._write(pack_frame(PUB, tid if tid else topic, meta, blob or b"", key, flags))
+            self.log(f"→ Enviado (bin): {topic} {len(meta)}+{len(blob or b'')} bytes")
         except Exception as e:
             self.log(f"Error al enviar: {e}")
 
+    def _write(self, data):
+        out = self._out
+        if out is not None:
+            out.put(data)
+            return
+        self.sock.sendall(data)
+        self.messages_sent += 1
+        self.writes += 1
+
+    def _send_loop(self, sock, out):
+        """Hilo emisor: lo encolado mientras se escribía sale en un solo sendmsg."""
+        while not out.closed:
+            batch = out.get_batch(self.max_batch, WRITE_BATCH_BYTES, timeout=1.0, linger=self.linger)
+            if not batch:
+                continue
+            try:
+                writes = sendmsg_all(sock, batch)
+            except OSError as e:
+                if self.running:
+                    self.log(f"Error al enviar: {e}")
+                break
+            self.messages_sent += len(batch)
+            self.writes += writes
+
+    def write_stats(self):
+        """Mensajes enviados, llamadas de escritura y mensajes por syscall."""
+        return {
+            "messages": self.messages_sent,
+            "writes": self.writes,
+            "messages_per_write": round(self.messages_sent / self.writes, 2) if self.writes else None,
+        }
+
     def _recv_loop(self):
-        buf = b""
+        framer = StreamFramer()
         while self.running:
             try:
-                data = self.sock.recv(1024)
-                if not data:
+                if not framer.recv_into(self.sock):
                     break
-                buf += data
-                while b"\n" in buf:
-                    line, buf = buf.split(b"\n", 1)
-                    text = line.decode("utf-8").strip()
-                    if not text:
+                for frame in framer:
+                    if isinstance(frame, BinaryFrame):
+                        self._log_binary(frame)
                         continue
                     try:
-                        obj = json.loads(text)
+                        obj = loads(frame)
                         self.log(f"← Recibido: {json.dumps(obj)}")
                     except Exception:
-                        self.log(f"← (texto) {text}")
+                        self.log(f"← (texto) {frame.decode('utf-8', 'replace').strip()}")
             except Exception:
                 break
         self.disconnect()
 
+    def _log_binary(self, frame):
+        meta = frame.meta.decode("utf-8")
+        if frame.action == PUB:
+            self.log(f"← Recibido (bin): {frame.topic} {meta} + {len(frame.blob)} bytes en '{frame.key}'")
+        else:
+            self.log(f"← Recibido (bin): {meta}")
+
 
 # -----------------------------
 # GUI con Tkinter
@@ -111,6 +213,8 @@ class PubSubGUI:
         ttk.Label(frm_conn, text="Puerto:").pack(side=tk.LEFT)
         self.port_var = tk.StringVar(value="5051")
         ttk.Entry(frm_conn, textvariable=self.port_var, width=6).pack(side=tk.LEFT, padx=2)
+        self.binary_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(frm_conn, text="Binario", variable=self.binary_var).pack(side=tk.LEFT, padx=2)
         self.btn_conn = ttk.Button(frm_conn, text="Conectar", command=self.toggle_connection)
         self.btn_conn.pack(side=tk.LEFT, padx=5)
 
@@ -137,6 +241,8 @@ class PubSubGUI:
         frm_btns.pack(fill=tk.X, pady=3)
         ttk.Button(frm_btns, text="Suscribirse", command=self.subscribe).pack(side=tk.LEFT, padx=2)
         ttk.Button(frm_btns, text="Publicar", command=self.publish).pack(side=tk.LEFT, padx=2)
+        self.retain_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(frm_btns, text="Retener", variable=self.retain_var).pack(side=tk.LEFT, padx=2)
         ttk.Button(frm_btns, text="Prueba automática", command=self.auto_test).pack(side=tk.LEFT, padx=5)
 
         # Log
@@ -161,7 +267,7 @@ class PubSubGUI:
         else:
             host = self.host_var.get().strip()
             port = int(self.port_var.get().strip())
-            self.client = PubSubClient(host, port, log_func=self.log)
+            self.client = PubSubClient(host, port, log_func=self.log, binary=self.binary_var.get())
             ok = self.client.connect()
             if ok:
                 self.btn_conn.config(text="Desconectar")
@@ -188,8 +294,7 @@ class PubSubGUI:
         except Exception as e:
             self.log(f"JSON inválido: {e}")
             return
-        pkt = {"action": "PUB", "topic": topic, "data": data}
-        self.client.send_json(pkt)
+        self.client.publish(topic, data, retain=self.retain_var.get())
 
     def auto_test(self):
         if not self.client:
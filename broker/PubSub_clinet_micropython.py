@@ -7,6 +7,7 @@ import network, time, sys, gc
 import usocket as socket
 import ubinascii
 import json
+import struct
 from machine import Pin, I2C, PWM, Timer
 from ov7670_wrapper import *
 import _thread
@@ -36,6 +37,8 @@ BROKER_PORT = 5051          # puerto del Broker TCP (Tkinter)
 
 TOPIC_FRAME = "UDFJC/emb1/robot0/camera/frame"
 SEND_INTERVAL = 3.0         # segundos entre envíos
+USE_BINARY = False          # True: frame crudo en protocolo bin1 (sin base64, ver pubsub_wire.py)
+FRAME_TOPIC_ID = 1          # id bin1 de TOPIC_FRAME en esta conexión
 
 # ----------------- CÁMARA OV7670 -----------------
 WIDTH = 160
@@ -90,20 +93,38 @@ def connect_to_broker():
     s.connect(addr)
     s.settimeout(5)
     print("🔌 Conectado al broker TCP:", BROKER_HOST, BROKER_PORT)
+    if USE_BINARY:
+        # define el id del tópico una vez; los PUB siguientes solo llevan el id
+        send_bin_frame(s, 4, FRAME_TOPIC_ID, TOPIC_FRAME.encode())
     return s
 
-def send_json_line(sock, obj):
-    """Envía un JSON + '\n' por el socket (protocolo del Broker)."""
-    line = json.dumps(obj) + "\n"
+def send_all(sock, data):
     # Enviar todo (puede que send no mande todo en una sola llamada)
-    data = line.encode("utf-8")
     total = 0
     while total < len(data):
         total += sock.send(data[total:])
 
+def send_json_line(sock, obj):
+    """Envía un JSON + '\n' por el socket (protocolo del Broker)."""
+    line = json.dumps(obj) + "\n"
+    send_all(sock, line.encode("utf-8"))
+
+def send_bin_frame(sock, action, topic_id, meta=b"", blob=b"", key=b""):
+    """Frame bin1: cabecera >BBBBHII + key + meta + blob (acciones: 1=PUB, 4=TOPIC)."""
+    header = struct.pack(">BBBBHII", 0xB5, action, len(key), 0, topic_id, len(meta), len(blob))
+    send_all(sock, header + key + meta)
+    if blob:
+        send_all(sock, memoryview(blob))
+
 def publish_frame(sock):
     """Captura un frame, lo codifica y lo envía como PUB al broker."""
     frame = get_frame()
+    if USE_BINARY:
+        meta = json.dumps({"w": WIDTH, "h": HEIGHT, "format": "RGB565", "ts": time.time()})
+        # el broker lo entrega crudo a clientes bin1 y como data["frame_b64"] a los JSON
+        send_bin_frame(sock, 1, FRAME_TOPIC_ID, meta.encode(), frame, b"frame_b64")
+        print("📤 Frame enviado (bin), tamaño:", len(frame), "bytes")
+        return
     # Codificar en base64 para meterlo en JSON
     frame_b64 = ubinascii.b2a_base64(frame).decode().strip()
 
@@ -0,0 +1,91 @@
+"""
+Message activity seen by the brokers, for the UI.
+
+The per-message hot path (every inbound packet, every publish) must not
+push an event per message to the Tk thread: at a few hundred messages per
+second the UI falls behind and its log grows without bound. Instead the
+brokers record into an ActivityMonitor:
+
+- counters (messages in, publishes, deliveries), read as rates;
+- a fixed-size ring buffer of the most recent messages.
+
+The UI samples both once per tick. Low-rate events (connects, errors,
+info) still go through the ui_queue callback.
+"""
+
+import threading
+import time
+from collections import deque
+
+IN = "in"
+PUBLISHED = "published"
+
+
+class ActivityMonitor:
+    """
+    Counters plus a ring buffer of the last `recent` messages.
+
+    Recording is O(1) and never formats anything: entries keep the raw
+    packet and are rendered by whoever reads them. Thread-safe.
+    """
+
+    def __init__(self, recent=200):
+        self._lock = threading.Lock()
+        self._ring = deque(maxlen=recent)   # entries: (seq, ts, kind, who, what)
+        self._seq = 0
+        self.messages_in = 0
+        self.published = 0
+        self.deliveries = 0
+
+    def _record(self, kind, who, what):
+        with self._lock:
+            self._seq += 1
+            self._ring.append((self._seq, time.time(), kind, who, what))
+
+    def message_in(self, addr, pkt):
+        """A packet received from a client (pkt is the decoded dict)."""
+        with self._lock:
+            self.messages_in += 1
+        self._record(IN, addr, pkt)
+
+    def publish(self, topic, subscribers):
+        """A publish delivered to `subscribers` subscribers, on every transport (TCP, WebSocket, ...)."""
+        with self._lock:
+            self.published += 1
+            self.deliveries += subscribers
+        self._record(PUBLISHED, topic, subscribers)
+
+    def counters(self):
+        with self._lock:
+            return {
+                "messages_in": self.messages_in,
+                "published": self.published,
+                "deliveries": self.deliveries,
+            }
+
+    def recent(self, since=0):
+        """
+        Entries with seq > since, oldest first, and the number of entries
+        newer than `since` that already fell out of the ring.
+        """
+        with self._lock:
+            missed = max(0, self._seq - since - len(self._ring))
+            return [e for e in self._ring if e[0] > since], missed
+
+
+class RateMeter:
+    """Per-second rates from successive counter samples (one per UI tick)."""
+
+    def __init__(self):
+        self._last = None
+        self._last_ts = None
+
+    def sample(self, counters):
+        now = time.monotonic()
+        rates = {}
+        if self._last is not None and now > self._last_ts:
+            dt = now - self._last_ts
+            rates = {k: (v - self._last.get(k, 0)) / dt for k, v in counters.items()}
+        self._last = dict(counters)
+        self._last_ts = now
+        return rates
@@ -0,0 +1,599 @@
+#!/usr/bin/env python3
+"""
+Load generator and latency benchmark for the brokers.
+
+Runs a broker in-process and drives it with simulated clients:
+
+  thread   Broker (one thread per client) + WebSocketServer
+  async    AsyncBroker (--shards event loops) + WebSocketServer
+  simple   simple_server.PubSub with its TCPServer and WSServer
+  cluster  pubsub_headless --workers N in a subprocess (pubsub_cluster),
+           once per value of --workers; reported as clusterN
+
+Publishers send `messages` PUBs each, spread over `topics` topics, at
+`rate` msgs/s (0: as fast as they can). Subscriber j subscribes to topic
+j % topics, so the fan-out is subscribers / topics. Every payload carries
+its send time; subscribers record the end-to-end latency on arrival.
+`stalled` more TCP subscribers take every topic and never read (a frozen
+Pico): the "stalled" scenario shows whether they slow down the others,
+whose latency is all that is reported. With `sndbuf` every TCP socket
+(the broker's too) gets that SO_SNDBUF / SO_RCVBUF, so large messages
+are written in parts; a line that does not parse on arrival is counted
+as corrupt.
+
+Reported per run: delivered msgs/s, loss, p50/p99/p999/max latency, CPU
+seconds of the whole process and RSS. Clients share the process (and the
+GIL) with the broker: compare runs with each other, not with absolute
+numbers from another machine. With pub_procs > 0 the TCP publishers run
+in that many separate processes, so the load generator is not capped by
+one core; the "ingest" scenario uses that to show how the cluster target
+scales with --workers (cpu_s then only counts the benchmark process).
+
+  python3 -m pubsub_bench --target thread,async --scenario small,camera --out before.json
+  python3 -m pubsub_bench --target thread,async --scenario small,camera --compare before.json
+  python3 -m pubsub_bench --target async,cluster --workers 1,2,4 --scenario ingest
+"""
+
+import argparse
+import asyncio
+import contextlib
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import socket
+import subprocess
+import sys
+import signal
+import threading
+import time
+
+import websockets
+
+from pubsub_wire import StreamFramer, BinaryFrame
+
+# per publisher: messages; payload: bytes of padding in data
+# pub_procs: processes running the TCP publishers (0: threads of this process)
+# stalled: extra subscribers that never read
+# sndbuf: SO_SNDBUF / SO_RCVBUF of every TCP socket, the broker's included (0: default)
+SCENARIOS = {
+    "small": dict(tcp_pubs=4, tcp_subs=16, ws_pubs=0, ws_subs=4, topics=4,
+                  payload=64, messages=2000, rate=0, pub_procs=0, stalled=0, sndbuf=0),
+    "fanout": dict(tcp_pubs=1, tcp_subs=64, ws_pubs=0, ws_subs=0, topics=1,
+                   payload=256, messages=500, rate=0, pub_procs=0, stalled=0, sndbuf=0),
+    "camera": dict(tcp_pubs=1, tcp_subs=4, ws_pubs=0, ws_subs=2, topics=1,
+                   payload=38400, messages=150, rate=30, pub_procs=0, stalled=0, sndbuf=0),
+    # many publishers, little fan-out: broker time goes to reading and parsing
+    "ingest": dict(tcp_pubs=16, tcp_subs=4, ws_pubs=0, ws_subs=0, topics=4,
+                   payload=512, messages=4000, rate=0, pub_procs=4, stalled=0, sndbuf=0),
+    # 4 robots x 250 pose updates/s of ~100 bytes: small writes, where coalescing pays
+    "pose": dict(tcp_pubs=4, tcp_subs=8, ws_pubs=0, ws_subs=0, topics=1,
+                 payload=48, messages=2500, rate=250, pub_procs=0, stalled=0, sndbuf=0),
+    # one subscriber stops reading: the others must not notice
+    "stalled": dict(tcp_pubs=1, tcp_subs=8, ws_pubs=0, ws_subs=2, topics=1,
+                    payload=4096, messages=2000, rate=500, pub_procs=0, stalled=1, sndbuf=0),
+    # 40 KB frames through 4 KB socket buffers: every frame is written in parts
+    "tinybuf": dict(tcp_pubs=1, tcp_subs=4, ws_pubs=0, ws_subs=1, topics=1,
+                    payload=40000, messages=200, rate=50, pub_procs=0, stalled=0, sndbuf=4096),
+}
+TARGETS = ("thread", "async", "simple", "cluster")
+HOST = "127.0.0.1"
+SUB_TIMEOUT = 10.0  # max seconds to wait for the SUB acks before publishing
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind((HOST, 0))
+        return s.getsockname()[1]
+
+
+def _wait_listening(port, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            socket.create_connection((HOST, port), timeout=0.5).close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.02)
+
+
+# ---------------------------
+# Targets
+# ---------------------------
+
+class _BrokerTarget:
+    """Broker or AsyncBroker plus a WebSocketServer."""
+    SUB_ACKS = True  # answers every SUB: subscribers know when they are registered
+
+    def __init__(self, engine, shards=1, **broker_opts):
+        self.engine = engine
+        self.shards = shards
+        self.broker_opts = broker_opts
+
+    def start(self):
+        from pubsub_broker import make_broker, WebSocketServer
+        self.tcp_port, self.ws_port = _free_port(), _free_port()
+        self.broker = make_broker(self.engine, shards=self.shards, host=HOST, port=self.tcp_port,
+                                  **self.broker_opts)
+        self.ws = WebSocketServer(host=HOST, port=self.ws_port, broker=self.broker)
+        self.broker.start()
+        self.ws.start()
+        _wait_listening(self.tcp_port)
+        _wait_listening(self.ws_port)
+
+    def stop(self):
+        self.ws.stop()
+        self.ws.thread.join(timeout=5)
+        self.broker.stop()
+
+    def messages_per_write(self):
+        """Messages sent to subscribers per socket write call, clients already gone included."""
+        from pubsub_metrics import collect
+        snap = collect(self.broker, self.ws)
+        return round(snap["sent"] / snap["writes"], 2) if snap["writes"] else None
+
+
+class _SimpleTarget:
+    """simple_server.PubSub on its own event loop thread."""
+    SUB_ACKS = False
+
+    def start(self):
+        import simple_server
+        self.tcp_port, self.ws_port = _free_port(), _free_port()
+        self.loop = asyncio.new_event_loop()
+        pubsub = simple_server.PubSub()
+        tcp = simple_server.TCPServer(pubsub, HOST, self.tcp_port)
+        ws = simple_server.WSServer(pubsub, HOST, self.ws_port)
+        self.servers = [self.loop.run_until_complete(tcp.start()),
+                        self.loop.run_until_complete(ws.start())]
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        async def close():
+            for server in self.servers:
+                server.close()
+        asyncio.run_coroutine_threadsafe(close(), self.loop).result(5)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(timeout=5)
+
+
+class _ClusterTarget:
+    """pubsub_headless --workers N as a subprocess; ready once every worker is."""
+    SUB_ACKS = True
+
+    def __init__(self, workers, engine="async", shards=1):
+        self.workers = workers
+        self.engine = engine
+        self.shards = shards
+
+    def start(self):
+        self.tcp_port, self.ws_port = _free_port(), _free_port()
+        self.proc = subprocess.Popen(
+            [sys.executable, "-m", "pubsub_headless", "--workers", str(self.workers),
+             "--engine", self.engine, "--shards", str(self.shards), "--host", HOST,
+             "--port", str(self.tcp_port), "--ws-port", str(self.ws_port), "--log-format", "json"],
+            cwd=os.path.dirname(os.path.abspath(__file__)), stdout=subprocess.PIPE, text=True)
+        for line in self.proc.stdout:
+            event = json.loads(line).get("event")
+            if event == "cluster_ready" or (event == "ready" and self.workers == 1):
+                break
+        else:
+            raise RuntimeError(f"cluster exited with status {self.proc.wait()}")
+        _wait_listening(self.tcp_port)
+        _wait_listening(self.ws_port)
+        # keep reading so the workers never block on a full pipe
+        threading.Thread(target=self.proc.stdout.read, daemon=True).start()
+
+    def stop(self):
+        self.proc.send_signal(signal.SIGTERM)
+        try:
+            self.proc.wait(timeout=15)
+        except subprocess.TimeoutExpired:
+            self.proc.kill()
+            self.proc.wait()
+
+
+def make_target(name, shards=1, workers=1, **broker_opts):
+    if name == "simple":
+        return _SimpleTarget()
+    if name == "cluster":
+        return _ClusterTarget(workers, shards=shards)
+    return _BrokerTarget(name, shards, **broker_opts)
+
+
+# ---------------------------
+# Simulated clients
+# ---------------------------
+
+def _latency_ns(text, now):
+    msg = json.loads(text)
+    data = msg.get("data")
+    if isinstance(data, dict) and "ts" in data:
+        return now - data["ts"]
+    return None  # acks and other control messages
+
+
+def _pub_template(topic, payload):
+    pad = "x" * payload
+    head = '{"action": "PUB", "topic": "%s", "data": {"pad": "%s", ' % (topic, pad)
+    return (head.replace("%", "%%") + '"seq": %d, "ts": %d}}').encode("utf-8")
+
+
+def _paced(messages, rate):
+    """Yield seq numbers, sleeping to keep `rate` msgs/s (0: no pacing)."""
+    t0 = time.perf_counter()
+    for seq in range(messages):
+        if rate:
+            delay = t0 + seq / rate - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        yield seq
+
+
+def _small_buffers(sock, size):
+    if size:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, size)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, size)
+
+
+def _tcp_subscriber(port, topic, latencies, stop, corrupt, sndbuf=0, ready=None):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    _small_buffers(sock, sndbuf)
+    sock.connect((HOST, port))
+    try:
+        sock.sendall(json.dumps({"action": "SUB", "topic": topic}).encode("utf-8") + b"\n")
+        sock.settimeout(0.2)
+        framer = StreamFramer(max_frame=1 << 24)
+        while not stop.is_set():
+            try:
+                if not framer.recv_into(sock):
+                    break
+            except socket.timeout:
+                continue
+            now = time.perf_counter_ns()
+            for line in framer:
+                if isinstance(line, BinaryFrame):
+                    continue
+                try:
+                    lat = _latency_ns(line, now)
+                except ValueError:
+                    # a message cut in half, or two glued together
+                    corrupt.append(line[:80])
+                    continue
+                if lat is not None:
+                    latencies.append(lat)
+                elif b'"subscribed"' in line:
+                    ready.set()
+    except OSError:
+        pass
+    finally:
+        sock.close()
+
+
+def _stalled_subscriber(port, topics):
+    """A subscriber to every topic that never reads, with a tiny receive buffer."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+    sock.connect((HOST, port))
+    for topic in topics:
+        sock.sendall(json.dumps({"action": "SUB", "topic": topic}).encode("utf-8") + b"\n")
+    return sock
+
+
+def _tcp_publisher(port, topic, payload, messages, rate, sndbuf=0):
+    template = _pub_template(topic, payload)
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        _small_buffers(sock, sndbuf)
+        sock.connect((HOST, port))
+        for seq in _paced(messages, rate):
+            sock.sendall(template % (seq, time.perf_counter_ns()) + b"\n")
+        # keep the connection until the broker has read everything
+        sock.shutdown(socket.SHUT_WR)
+        sock.settimeout(5)
+        try:
+            while sock.recv(65536):
+                pass
+        except OSError:
+            pass
+
+
+def _publisher_process(port, jobs):
+    """Runs a share of the TCP publishers, one thread each, in a child process."""
+    threads = [threading.Thread(target=_tcp_publisher, args=(port,) + job) for job in jobs]
+    for th in threads:
+        th.start()
+    for th in threads:
+        th.join()
+
+
+async def _ws_subscriber(port, topic, latencies, stop, ready):
+    async with websockets.connect(f"ws://{HOST}:{port}", max_size=None) as ws:
+        await ws.send(json.dumps({"action": "SUB", "topic": topic}))
+        while not stop.is_set():
+            try:
+                text = await asyncio.wait_for(ws.recv(), 0.2)
+            except asyncio.TimeoutError:
+                continue
+            lat = _latency_ns(text, time.perf_counter_ns())
+            if lat is not None:
+                latencies.append(lat)
+            elif '"subscribed"' in text:
+                ready.set()
+
+
+async def _ws_publisher(port, topic, payload, messages, rate):
+    template = _pub_template(topic, payload).decode("utf-8")
+    async with websockets.connect(f"ws://{HOST}:{port}", max_size=None) as ws:
+        t0 = time.perf_counter()
+        for seq in range(messages):
+            if rate:
+                delay = t0 + seq / rate - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            await ws.send(template % (seq, time.perf_counter_ns()))
+
+
+# ---------------------------
+# Runner
+# ---------------------------
+
+def _percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(p * len(sorted_values)))]
+
+
+def _rss_kb():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") // 1024
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def run_scenario(target, tcp_pubs, tcp_subs, ws_pubs, ws_subs, topics, payload, messages, rate,
+                 pub_procs=0, stalled=0, sndbuf=0, settle=0.5, drain=10.0):
+    """Run one scenario against a started target and return its result dict."""
+    topic_names = [f"bench/t{i}" for i in range(topics)]
+    stop = threading.Event()
+    sub_topics = [topic_names[j % topics] for j in range(tcp_subs + ws_subs)]
+    latencies = [[] for _ in sub_topics]
+    ready = [threading.Event() for _ in sub_topics]
+    corrupt = []
+
+    threads = [threading.Thread(target=_tcp_subscriber, daemon=True,
+                                args=(target.tcp_port, sub_topics[j], latencies[j], stop, corrupt, sndbuf,
+                                      ready[j]))
+               for j in range(tcp_subs)]
+    ws_loop = asyncio.new_event_loop()
+    ws_thread = threading.Thread(target=ws_loop.run_forever, daemon=True)
+    ws_thread.start()
+    ws_subs_f = [asyncio.run_coroutine_threadsafe(
+        _ws_subscriber(target.ws_port, sub_topics[j], latencies[j], stop, ready[j]), ws_loop)
+        for j in range(tcp_subs, tcp_subs + ws_subs)]
+    for th in threads:
+        th.start()
+    frozen = [_stalled_subscriber(target.tcp_port, topic_names) for _ in range(stalled)]
+    if target.SUB_ACKS:
+        # with many subscriber threads on few cores a fixed settle is not enough:
+        # publishing before a SUB is registered would count as lost messages
+        deadline = time.monotonic() + SUB_TIMEOUT
+        for event in ready:
+            event.wait(max(0.0, deadline - time.monotonic()))
+    time.sleep(settle)  # let every SUB reach the broker (stalled subscribers, no acks)
+
+    pub_topics = [topic_names[i % topics] for i in range(tcp_pubs + ws_pubs)]
+    subs_per_topic = {t: sub_topics.count(t) for t in topic_names}
+    expected = sum(subs_per_topic[t] for t in pub_topics) * messages
+
+    jobs = [(pub_topics[i], payload, messages, rate, sndbuf) for i in range(tcp_pubs)]
+    if pub_procs:
+        # perf_counter_ns is CLOCK_MONOTONIC: latencies stay comparable across processes
+        ctx = multiprocessing.get_context("spawn")
+        pubs = [ctx.Process(target=_publisher_process, args=(target.tcp_port, jobs[k::pub_procs]))
+                for k in range(min(pub_procs, tcp_pubs))]
+    else:
+        pubs = [threading.Thread(target=_tcp_publisher, daemon=True, args=(target.tcp_port,) + job)
+                for job in jobs]
+
+    cpu0 = resource.getrusage(resource.RUSAGE_SELF)
+    t0 = time.perf_counter()
+    for th in pubs:
+        th.start()
+    ws_pubs_f = [asyncio.run_coroutine_threadsafe(
+        _ws_publisher(target.ws_port, pub_topics[i], payload, messages, rate), ws_loop)
+        for i in range(tcp_pubs, tcp_pubs + ws_pubs)]
+    for th in pubs:
+        th.join()
+    for f in ws_pubs_f:
+        f.result()
+    t_pub = time.perf_counter() - t0
+
+    # wait for the deliveries still in flight
+    deadline = time.monotonic() + drain
+    last, last_change = -1, time.monotonic()
+    while time.monotonic() < deadline:
+        received = sum(len(l) for l in latencies)
+        if received >= expected:
+            break
+        if received != last:
+            last, last_change = received, time.monotonic()
+        elif time.monotonic() - last_change > 2.0:
+            break  # nothing arrived for a while: the rest was dropped
+        time.sleep(0.01)
+    elapsed = time.perf_counter() - t0
+    cpu1 = resource.getrusage(resource.RUSAGE_SELF)
+
+    stop.set()
+    for th in threads:
+        th.join(timeout=2)
+    for f in ws_subs_f:
+        with contextlib.suppress(Exception):
+            f.result(timeout=2)
+    ws_loop.call_soon_threadsafe(ws_loop.stop)
+    ws_thread.join(timeout=2)
+    ws_loop.close()
+    for sock in frozen:
+        sock.close()
+
+    all_lat = sorted(x for l in latencies for x in l)
+    received = len(all_lat)
+    cpu = (cpu1.ru_utime - cpu0.ru_utime) + (cpu1.ru_stime - cpu0.ru_stime)
+    ms = lambda ns: None if ns is None else round(ns / 1e6, 3)
+    return {
+        "published": (tcp_pubs + ws_pubs) * messages,
+        "expected": expected,
+        "received": received,
+        "lost": expected - received,
+        "corrupt": len(corrupt),
+        "publish_s": round(t_pub, 3),
+        "elapsed_s": round(elapsed, 3),
+        "msgs_per_s": round(received / elapsed, 1) if elapsed else None,
+        "publish_msgs_per_s": round((tcp_pubs + ws_pubs) * messages / t_pub, 1) if t_pub else None,
+        "latency_ms": {
+            "p50": ms(_percentile(all_lat, 0.50)),
+            "p99": ms(_percentile(all_lat, 0.99)),
+            "p999": ms(_percentile(all_lat, 0.999)),
+            "max": ms(all_lat[-1] if all_lat else None),
+        },
+        "cpu_s": round(cpu, 3),
+        "cpu_pct": round(100 * cpu / elapsed, 1) if elapsed else None,
+        "rss_kb": _rss_kb(),
+        "max_rss_kb": cpu1.ru_maxrss,
+    }
+
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def run(targets, scenarios, overrides, shards=1, settle=0.5, drain=10.0, quiet_simple=True,
+        workers=(2,), broker_opts=None):
+    """
+    Run every scenario on every target. Returns the JSON-able report.
+    broker_opts go to Broker / AsyncBroker (e.g. write_batch, write_linger_us).
+    """
+    report = {
+        "meta": {
+            "commit": _git_commit(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+        },
+        "results": [],
+    }
+    # the cluster target runs once per worker count
+    runs = [(name, n) for name in targets for n in (workers if name == "cluster" else (None,))]
+    for name, n in runs:
+        for scenario in scenarios:
+            params = dict(SCENARIOS[scenario], **overrides)
+            opts = dict(broker_opts or {})
+            if params.get("sndbuf"):
+                opts["sndbuf"] = params["sndbuf"]
+            target = make_target(name, shards=shards, workers=n, **opts)
+            # simple_server prints every SUB/PUB
+            quiet = quiet_simple and name == "simple"
+            with open(os.devnull, "w") as devnull, \
+                    contextlib.redirect_stdout(devnull if quiet else sys.stdout):
+                target.start()
+                try:
+                    result = run_scenario(target, settle=settle, drain=drain, **params)
+                    if hasattr(target, "messages_per_write"):
+                        result["messages_per_write"] = target.messages_per_write()
+                finally:
+                    target.stop()
+            entry = {"target": name if n is None else f"{name}{n}", "scenario": scenario,
+                     "params": params, **result}
+            if broker_opts and name in ("thread", "async"):
+                entry["broker_opts"] = broker_opts
+            if name in ("async", "cluster"):
+                entry["shards"] = shards
+            if n is not None:
+                entry["workers"] = n
+            report["results"].append(entry)
+            print(format_result(entry), flush=True)
+    return report
+
+
+def format_result(r):
+    lat = r["latency_ms"]
+    return (f"{r['target']:<8} {r['scenario']:<8} {r['msgs_per_s'] or 0:>10.1f} msg/s  "
+            f"lost {r['lost']:<6} p50 {lat['p50']} ms  p99 {lat['p99']} ms  p999 {lat['p999']} ms  "
+            f"cpu {r['cpu_pct']}%  rss {r['rss_kb']} KB"
+            + (f"  msg/write {r['messages_per_write']}" if r.get("messages_per_write") else "")
+            + (f"  CORRUPT {r['corrupt']}" if r.get("corrupt") else ""))
+
+
+def compare(old, new):
+    """Print msgs/s and p99 of new against a previous report."""
+    before = {(r["target"], r["scenario"]): r for r in old["results"]}
+    print(f"vs {old['meta'].get('commit')} ({old['meta'].get('time')})")
+    for r in new["results"]:
+        o = before.get((r["target"], r["scenario"]))
+        if o is None:
+            continue
+        def delta(a, b):
+            return f"{(b - a) / a * 100:+.1f}%" if a and b is not None else "n/a"
+        print(f"{r['target']:<8} {r['scenario']:<8} "
+              f"msg/s {o['msgs_per_s']} -> {r['msgs_per_s']} ({delta(o['msgs_per_s'], r['msgs_per_s'])})  "
+              f"p99 {o['latency_ms']['p99']} -> {r['latency_ms']['p99']} ms "
+              f"({delta(o['latency_ms']['p99'], r['latency_ms']['p99'])})")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Pub/Sub broker benchmark")
+    parser.add_argument("--target", default="thread,async",
+                        help=f"comma-separated, from {', '.join(TARGETS)}")
+    parser.add_argument("--scenario", default="small",
+                        help=f"comma-separated, from {', '.join(SCENARIOS)}")
+    parser.add_argument("--shards", type=int, default=1, help="event loops for the async target")
+    parser.add_argument("--workers", default="2",
+                        help="comma-separated worker counts for the cluster target, e.g. 1,2,4")
+    for key in SCENARIOS["small"]:
+        parser.add_argument("--" + key.replace("_", "-"), type=float if key == "rate" else int,
+                            help=f"override the scenario's {key}")
+    parser.add_argument("--write-batch", type=int, help="max messages per write call (thread/async)")
+    parser.add_argument("--write-linger-us", type=int, help="write coalescing linger (thread/async)")
+    parser.add_argument("--settle", type=float, default=0.5, help="seconds between SUB and the first PUB")
+    parser.add_argument("--drain", type=float, default=10.0, help="max seconds to wait for deliveries")
+    parser.add_argument("--out", metavar="FILE", help="save the results as JSON")
+    parser.add_argument("--compare", metavar="FILE", help="previous --out file to compare with")
+    args = parser.parse_args(argv)
+
+    targets = [t for t in args.target.split(",") if t]
+    scenarios = [s for s in args.scenario.split(",") if s]
+    for t in targets:
+        if t not in TARGETS:
+            parser.error(f"unknown target {t!r}")
+    for s in scenarios:
+        if s not in SCENARIOS:
+            parser.error(f"unknown scenario {s!r}")
+    overrides = {k: getattr(args, k) for k in SCENARIOS["small"] if getattr(args, k) is not None}
+
+    try:
+        workers = [int(n) for n in args.workers.split(",") if n]
+    except ValueError:
+        parser.error(f"invalid --workers {args.workers!r}")
+    broker_opts = {k: getattr(args, k) for k in ("write_batch", "write_linger_us")
+                   if getattr(args, k) is not None}
+    report = run(targets, scenarios, overrides, shards=args.shards, settle=args.settle, drain=args.drain,
+                 workers=workers, broker_opts=broker_opts)
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,399 @@
+"""
+Bridges: persistent links from this broker to another one (federation).
+
+A classroom broker keeps a link to the central broker and forwards
+selected topics in each direction:
+
+  --bridge "tcp://central:5051 out=robots/+/pose,camera/# in=commands/#"
+  --bridge "ws://central:5052 out=robots/#"
+
+- out: local messages matching these patterns are published on the
+  remote broker. The bridge is an ordinary subscriber of the local
+  registry (a front-end, see pubsub_registry).
+- in: the bridge subscribes to these patterns on the remote broker and
+  publishes what it receives locally.
+
+Over TCP the link speaks bin1 (blobs travel raw, and the local frame
+bytes are sent as they are); over WebSocket, JSON PUB packets. Outgoing
+messages go through a bounded OutboundQueue (drop-oldest), so a slow or
+broken link never blocks publishers; the sender thread writes whatever
+is queued in one batch. The link reconnects with exponential backoff
+and subscribes again.
+
+Loop prevention: every broker has an id (Broker.broker_id) and the
+bridge presents it in its HELLO, so both ends know the link leads to
+another broker. A message that crosses a link carries the ids of the
+brokers it went through ("via", see pubsub_wire):
+
+- it is never sent over a link to a broker already in via;
+- a broker that finds its own id in via drops it (Broker.publish).
+
+So cycles (A -> B -> C -> A) cannot loop. A message can still reach a
+broker once per distinct path in a mesh; a star of classrooms around a
+central broker has one path.
+
+stats(): connected, reconnects, messages/bytes/batches out and in,
+queued, dropped, loops dropped, and the link round trip time, measured
+every PROBE_INTERVAL s with a HELLO whose ack travels behind the data.
+"""
+
+import asyncio
+import socket
+import threading
+import time
+from urllib.parse import urlsplit
+
+import websockets
+
+from pubsub_broker import _Backoff
+from pubsub_json import dumps, dumpl, loads
+from pubsub_outbound import OutboundQueue, DROP_OLDEST
+from pubsub_topics import validate_pattern
+from pubsub_wire import StreamFramer, BinaryFrame, PUB, CTRL, PROTO_BIN1, raw_json
+
+
+class _BridgeHandle:
+    """The bridge's subscriptions in the local registry."""
+    __slots__ = ("frontend",)
+
+    def __init__(self, bridge):
+        self.frontend = bridge
+
+    def __repr__(self):
+        return f"bridge {self.frontend.name}"
+
+
+def _endpoint(uri):
+    """(uri, transport, host, port) for tcp://host:port, host:port or ws://host:port."""
+    uri = uri if "://" in uri else "tcp://" + uri
+    parts = urlsplit(uri)
+    if parts.scheme not in ("tcp", "ws", "wss") or not parts.hostname:
+        raise ValueError(f"bridge URI must be tcp://host:port or ws://host:port: {uri!r}")
+    transport = "tcp" if parts.scheme == "tcp" else "ws"
+    return uri, transport, parts.hostname, parts.port or (5051 if transport == "tcp" else 5052)
+
+
+def parse_spec(spec):
+    """'URI [out=P1,P2] [in=P3]' -> (uri, out patterns, in patterns). Raises ValueError."""
+    parts = spec.split()
+    if not parts:
+        raise ValueError("empty bridge spec")
+    uri, out, inbound = parts[0], [], []
+    _endpoint(uri)
+    for part in parts[1:]:
+        key, sep, value = part.partition("=")
+        if not sep or key not in ("out", "in"):
+            raise ValueError(f"bridge option must be out=PATTERNS or in=PATTERNS: {part!r}")
+        patterns = [p for p in value.split(",") if p]
+        for pattern in patterns:
+            validate_pattern(pattern)
+        (out if key == "out" else inbound).extend(patterns)
+    return uri, out, inbound
+
+
+class Bridge:
+    """
+    Link from broker to the broker at uri (tcp://host:port, host:port or
+    ws://host:port). start() and stop() from any thread.
+    """
+    PROBE_INTERVAL = 2.0       # seconds between round trip probes
+    BATCH_BYTES = 256 * 1024   # max bytes written per batch
+
+    def __init__(self, broker, uri, out=(), inbound=(), name=None,
+                 queue_size=4096, queue_bytes=16 * 1024 * 1024, ui_queue=None):
+        self.broker = broker
+        self.uri, self.transport, self.host, self.port = _endpoint(uri)
+        self.out = list(out)
+        self.inbound = list(inbound)
+        self.name = name or f"{self.host}:{self.port}"
+        self.ui_queue = ui_queue or broker.ui_queue
+        self.handle = _BridgeHandle(self)
+        self.queue_size = queue_size
+        self.queue_bytes = queue_bytes
+        self.queue = OutboundQueue(queue_size, queue_bytes, DROP_OLDEST)
+        self.running = False
+        self.thread = None
+        self._closing = None  # closes the current connection (set per session)
+        self.remote_id = None  # broker_id of the other side, from its HELLO ack
+        # stats
+        self.connected = False
+        self.reconnects = 0
+        self.messages_out = 0
+        self.bytes_out = 0
+        self.batches = 0
+        self.messages_in = 0
+        self.bytes_in = 0
+        self.loops_dropped = 0
+        self.rtt = None
+        self.rtt_max = 0.0
+        self._probe_sent = None
+        self._next_probe = 0.0
+
+    # -- local side --
+
+    def start(self):
+        """Subscribe to the out patterns locally and connect. Raises ValueError for a bad pattern."""
+        if self.running:
+            return False
+        if self.queue.closed:
+            self.queue = OutboundQueue(self.queue_size, self.queue_bytes, DROP_OLDEST)
+        for pattern in self.out:
+            self.broker.registry.subscribe(self.handle, pattern)
+        self.running = True
+        target = self._run_tcp if self.transport == "tcp" else self._run_ws
+        self.thread = threading.Thread(target=target, name=f"bridge {self.name}", daemon=True)
+        self.thread.start()
+        return True
+
+    def deliver(self, handles, frame, conflated=()):
+        """Front-end hook (Broker._deliver): queue frame for the remote broker."""
+        if self.remote_id is not None and self.remote_id in frame.via:
+            return 0  # it came from there
+        if self.transport == "ws":
+            payload = frame.pub_text()
+        else:
+            payload = frame.via_binary() if frame.via else frame.binary
+        self.queue.put(payload, frame.topic, self.handle in conflated)
+        return 1
+
+    def _received(self, topic, data, blob, blob_key, via, size, raw=None):
+        via = tuple(via) + (self.remote_id,) if self.remote_id else tuple(via)
+        if self.broker.broker_id in via:
+            self.loops_dropped += 1
+            return
+        self.messages_in += 1
+        self.bytes_in += size
+        self.broker.publish(topic, data, origin=self.handle, blob=blob, blob_key=blob_key, via=via, raw=raw)
+
+    def _ack(self, obj):
+        if obj.get("status") != "hello":
+            return
+        self.remote_id = obj.get("broker")
+        if self._probe_sent is not None:
+            self.rtt = time.perf_counter() - self._probe_sent
+            self.rtt_max = max(self.rtt_max, self.rtt)
+            self._probe_sent = None
+
+    def _hello(self):
+        obj = {"action": "HELLO", "broker": self.broker.broker_id}
+        if self.transport == "tcp":
+            obj["proto"] = PROTO_BIN1
+        return self._control(obj)
+
+    def _control(self, obj):
+        """A control packet in the link's format."""
+        return dumpl(obj) if self.transport == "tcp" else dumps(obj)
+
+    def _next_batch(self):
+        """Queued payloads up to BATCH_BYTES, preceded by a probe when one is due. Never blocks."""
+        batch = []
+        now = time.monotonic()
+        if now >= self._next_probe:
+            self._next_probe = now + self.PROBE_INTERVAL
+            self._probe_sent = time.perf_counter()
+            batch.append(self._hello())
+        payload = self.queue.get_nowait()
+        size = 0
+        while payload is not None:
+            batch.append(payload)
+            size += len(payload)
+            self.messages_out += 1
+            if size >= self.BATCH_BYTES:
+                break
+            payload = self.queue.get_nowait()
+        if batch:
+            self.batches += 1
+            self.bytes_out += size
+        return batch
+
+    def _session_started(self):
+        self.connected = True
+        self._next_probe = 0.0
+        self.ui_queue(("info", f"Bridge {self.name} connected ({self.transport})"))
+
+    def _session_ended(self, error=None):
+        self.remote_id = None
+        if self.connected:
+            self.reconnects += 1
+            self.ui_queue(("info", f"Bridge {self.name} disconnected" + (f": {error}" if error else "")))
+        self.connected = False
+        self._probe_sent = None
+
+    # -- TCP link --
+
+    def _run_tcp(self):
+        backoff = _Backoff()
+        while self.running:
+            if not backoff.ready():
+                time.sleep(0.1)
+                continue
+            try:
+                sock = socket.create_connection((self.host, self.port), timeout=5)
+            except OSError as e:
+                if not backoff.failures:
+                    self.ui_queue(("error", f"Bridge {self.name}: cannot connect: {e}"))
+                backoff.failed()
+                continue
+            backoff.succeeded()
+            self._tcp_session(sock)
+            backoff.failed()  # pause before reconnecting, even after a clean close
+
+    def _tcp_session(self, sock):
+        sock.settimeout(None)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._closing = lambda: _shutdown(sock)
+        done = threading.Event()
+        error = None
+        try:
+            sock.sendall(self._hello() + b"".join(
+                self._control({"action": "SUB", "topic": p}) for p in self.inbound))
+            self._session_started()
+            threading.Thread(target=self._tcp_sender, args=(sock, done), daemon=True).start()
+            framer = StreamFramer(max_frame=1 << 26)
+            while self.running and framer.recv_into(sock):
+                for frame in framer:
+                    if not isinstance(frame, BinaryFrame):
+                        self._ack(loads(frame))  # the HELLO ack, before bin1
+                    elif frame.action == PUB:
+                        data = raw = None
+                        if (frame.meta and not frame.key and not self.broker.validate_data
+                                and raw_json(frame.meta)):
+                            raw = frame.meta  # routed without parsing (see pubsub_wire.raw_json)
+                        elif frame.meta:
+                            data = loads(frame.meta)
+                        self._received(frame.topic, data, frame.blob if frame.key else None,
+                                       frame.key or None, frame.via, len(frame.meta) + len(frame.blob), raw)
+                    elif frame.action == CTRL:
+                        self._ack(loads(frame.meta))
+        except (OSError, ValueError) as e:
+            error = e
+        finally:
+            done.set()
+            _shutdown(sock)
+            sock.close()
+            self._session_ended(error)
+
+    def _tcp_sender(self, sock, done):
+        while self.running and not done.is_set():
+            # wait, then take: after the session ends nothing is popped and lost
+            self.queue.wait(0.5)
+            if done.is_set():
+                return
+            batch = self._next_batch()
+            if not batch:
+                continue
+            try:
+                sock.sendall(b"".join(batch))
+            except OSError:
+                _shutdown(sock)  # the reader sees it and ends the session
+                return
+
+    # -- WebSocket link --
+
+    def _run_ws(self):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            loop.run_until_complete(self._ws_main(loop))
+        finally:
+            loop.close()
+
+    async def _ws_main(self, loop):
+        backoff = _Backoff()
+        while self.running:
+            if not backoff.ready():
+                await asyncio.sleep(0.1)
+                continue
+            error = None
+            try:
+                async with websockets.connect(self.uri, max_size=None) as ws:
+                    backoff.succeeded()
+                    self._closing = lambda: asyncio.run_coroutine_threadsafe(ws.close(), loop)
+                    await ws.send(self._hello())
+                    for pattern in self.inbound:
+                        await ws.send(self._control({"action": "SUB", "topic": pattern}))
+                    self._session_started()
+                    writer = loop.create_task(self._ws_writer(ws, loop))
+                    try:
+                        async for text in ws:
+                            msg = loads(text)
+                            if "data" in msg:
+                                via = msg.get("via")
+                                self._received(msg.get("topic", ""), msg["data"], None, None,
+                                               via if isinstance(via, list) else (), len(text))
+                            else:
+                                self._ack(msg)
+                    finally:
+                        writer.cancel()
+            except (OSError, ValueError, asyncio.TimeoutError, websockets.exceptions.WebSocketException) as e:
+                error = e
+                if not self.connected and not backoff.failures:
+                    self.ui_queue(("error", f"Bridge {self.name}: cannot connect: {e}"))
+            backoff.failed()  # pause before reconnecting, even after a clean close
+            self._session_ended(error)
+
+    async def _ws_writer(self, ws, loop):
+        while True:
+            # blocking wait off the loop (returns within 0.5 s), but the payloads
+            # are taken here: a job still waiting when the writer is cancelled
+            # leaves them queued for the next session
+            await loop.run_in_executor(None, self.queue.wait, 0.5)
+            for text in self._next_batch():
+                await ws.send(text)
+
+    # -- control --
+
+    def stats(self):
+        q = self.queue.stats()
+        return {
+            "name": self.name,
+            "connected": self.connected,
+            "reconnects": self.reconnects,
+            "messages_out": self.messages_out,
+            "bytes_out": self.bytes_out,
+            "batches": self.batches,
+            "messages_in": self.messages_in,
+            "bytes_in": self.bytes_in,
+            "queued": q["queued_messages"],
+            "dropped": q["dropped"],
+            "loops_dropped": self.loops_dropped,
+            "rtt_ms": None if self.rtt is None else round(self.rtt * 1000, 2),
+            "rtt_max_ms": round(self.rtt_max * 1000, 2),
+        }
+
+    def stop(self):
+        if not self.running:
+            return
+        self.running = False
+        self.broker.registry.remove_client(self.handle)
+        self.queue.close()
+        if self._closing is not None:
+            try:
+                self._closing()
+            except RuntimeError:
+                pass  # WS loop already gone
+        if self.thread is not None:
+            self.thread.join(timeout=5)
+
+
+def _shutdown(sock):
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+
+
+def add_arguments(parser):
+    """The --bridge option (shared by the Tk and headless entry points)."""
+    parser.add_argument("--bridge", action="append", default=None, metavar="SPEC",
+                        help='link to another broker: "tcp://host:port out=P1,P2 in=P3" (repeatable)')
+
+
+def make_bridges(broker, specs):
+    """Bridges for --bridge specs, not started. Raises ValueError."""
+    return [Bridge(broker, *parse_spec(spec)) for spec in specs]
+
+
+def from_args(args, broker):
+    """Bridges for the parsed --bridge options."""
+    return make_bridges(broker, args.bridge or ())
@@ -0,0 +1,1378 @@
+"""
+Pub/Sub broker core, without any UI.
+
+- Broker: TCP broker, one thread per client ("thread" engine)
+- AsyncBroker: TCP broker on asyncio event loops ("async" engine)
+- RemoteConnector (TCP) y RemoteConnectorWS (WebSocket): pooled clients
+- WebSocketServer: WebSocket broker sharing topics with the TCP one
+
+Used by PubSub_server_python.py (Tk UI) and pubsub_headless.py (no UI).
+Events for a UI or a log go through the ui_queue callback as
+(kind, payload) tuples: info, error, client_connect, client_disconnect,
+remote_resp.
+"""
+
+import socket
+import threading
+import time
+import traceback
+import uuid
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import websockets
+
+from pubsub_topics import TopicTrie
+from pubsub_registry import SubscriptionRegistry
+from pubsub_retained import RetainedStore
+from pubsub_wire import (
+    EncodedMessage, EncodeCounter, BinaryFrame, StreamFramer, FrameTooLarge, pack_ctrl,
+    split_packet, raw_json, PROTO_JSON, PROTO_BIN1, PUB, TOPIC, ACTION_NAMES, FLAG_RETAIN, LAZY_MIN_BYTES,
+)
+from pubsub_outbound import (
+    OutboundQueue, SlowConsumer, POLICIES, QUEUE_MESSAGES, QUEUE_BYTES, OVERFLOW,
+    WRITE_BATCH, WRITE_BATCH_BYTES, sendmsg_all,
+)
+from pubsub_activity import ActivityMonitor
+from pubsub_metrics import Metrics, TCP, WS
+from pubsub_json import dumps, dumpl, loads
+
+# ---------------------------
+# Broker implementation (TCP)
+# ---------------------------
+
+class Broker:
+    def __init__(self, host="0.0.0.0", port=5051, ui_queue=None,
+                 queue_size=QUEUE_MESSAGES, queue_bytes=QUEUE_BYTES, overflow=OVERFLOW,
+                 conflate=(), max_frame=1 << 20, activity=None, registry=None,
+                 retain=(), retain_max_topics=10000, retain_max_bytes=16 * 1024 * 1024,
+                 message_log=None, reuse_port=False, broker_id=None, metrics=None,
+                 write_batch=WRITE_BATCH, write_linger_us=0, sndbuf=0, validate_data=False):
+        self.host = host
+        self.port = port
+        # SO_REUSEPORT: several broker processes on one port (see pubsub_cluster)
+        self.reuse_port = reuse_port
+        self.server_sock = None
+        self.running = False
+        self.clients = {}  # client_socket -> {"addr": addr, "thread": th, "queue": OutboundQueue}
+        # suscripciones de todos los transportes (TCP y WebSocket), ver pubsub_registry
+        self.registry = registry or SubscriptionRegistry()
+        self.lock = self.registry.lock  # also guards self.clients
+        self.ui_queue = ui_queue or (lambda *args, **kwargs: None)
+        # contadores y últimos mensajes para la UI (no un evento por mensaje)
+        self.activity = activity or ActivityMonitor()
+        # contadores e histogramas para $SYS y Prometheus (ver pubsub_metrics)
+        self.metrics = metrics or Metrics()
+        # Hooks para publicar también hacia otros backends (p.ej. WebSockets)
+        self.external_publishers = []
+        # serializations done by this broker's frames (see serializations_avoided)
+        self.encodes = EncodeCounter()
+        # límites de la cola de salida de cada suscriptor (ver pubsub_outbound)
+        if overflow not in POLICIES:
+            raise ValueError(f"Unknown overflow policy: {overflow}")
+        self.queue_size = queue_size
+        self.queue_bytes = queue_bytes
+        self.overflow = overflow
+        # coalescing of queued messages into one write call per client (see pubsub_outbound)
+        self.write_batch = max(1, int(write_batch))
+        self.write_linger = max(0, write_linger_us) / 1e6
+        # SO_SNDBUF of client sockets (0: system default); a bigger frame goes
+        # out in parts as the client reads, never blocking the publisher
+        self.sndbuf = sndbuf
+        # longest JSON line / bin1 frame accepted from a client
+        self.max_frame = max_frame
+        # a large PUB is routed on action/topic and its data forwarded as
+        # received (pubsub_wire.split_packet); validate_data parses it all
+        self.validate_data = validate_data
+        # topics where only the latest value matters (p.ej. robots/+/pose, camera/frame)
+        self.conflate_topics = TopicTrie()
+        for pattern in conflate:
+            self.conflate_topics.add(pattern, pattern)
+        # último valor por tópico, enviado al suscribirse (ver pubsub_retained)
+        self.retained = RetainedStore(retain_max_topics, retain_max_bytes)
+        self.retain_topics = TopicTrie()  # always retained, without the PUB flag
+        for pattern in retain:
+            self.retain_topics.add(pattern, pattern)
+        # registro persistente de todo lo publicado (pubsub_log.MessageLog), opcional
+        self.message_log = message_log
+        # bus hacia los otros procesos del cluster (pubsub_cluster.RoutingBus), opcional
+        self.bus = None
+        # identidad ante otros brokers (puentes, ver pubsub_bridge); un mensaje
+        # que ya pasó por este broker (via) no se vuelve a publicar
+        self.broker_id = broker_id or uuid.uuid4().hex[:12]
+        self.loops_dropped = 0
+
+    def register_external_publisher(self, fn):
+        """
+        Registra una función fn(topic, data, origin, frame) para ser llamada en cada publish.
+
+        frame es el EncodedMessage ya serializado; fn puede devolver el número
+        de clientes a los que lo entregó (para el contador de serializaciones).
+        """
+        with self.lock:
+            self.external_publishers.append(fn)
+
+    def _listen(self, backlog):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.reuse_port:
+            # the kernel spreads incoming connections over every listener
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        if self.sndbuf:
+            # inherited by the accepted sockets
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.sndbuf)
+        try:
+            sock.bind((self.host, self.port))
+            sock.listen(backlog)
+        except OSError:
+            sock.close()
+            raise
+        return sock
+
+    def start(self):
+        if self.running:
+            return False
+        # backlog > 10 para aceptar bastantes conexiones
+        self.server_sock = self._listen(20)
+        self.running = True
+        threading.Thread(target=self._accept_loop, daemon=True).start()
+        self.ui_queue(("info", f"Broker (TCP) listening on {self.host}:{self.port}"))
+        return True
+
+    def stop(self):
+        self.running = False
+        try:
+            # close all client sockets
+            with self.lock:
+                for csock, info in list(self.clients.items()):
+                    info["queue"].close()
+                    try:
+                        csock.shutdown(socket.SHUT_RDWR)
+                    except:
+                        pass
+                    try:
+                        csock.close()
+                    except:
+                        pass
+                self.clients.clear()
+            self.registry.drop_frontend(None)
+            if self.server_sock:
+                try:
+                    self.server_sock.close()
+                except:
+                    pass
+        except Exception as e:
+            self.ui_queue(("error", f"Error stopping broker: {e}"))
+        self.ui_queue(("info", "Broker (TCP) stopped"))
+
+    def _accept_loop(self):
+        while self.running:
+            try:
+                client, addr = self.server_sock.accept()
+                self.ui_queue(("client_connect", f"{addr}"))
+                info = self._new_client_info(addr)
+                q = info["queue"]
+                with self.lock:
+                    self.clients[client] = info
+                th = threading.Thread(target=self._client_thread, args=(client,), daemon=True)
+                sender = threading.Thread(target=self._sender_thread, args=(client, q), daemon=True)
+                with self.lock:
+                    self.clients[client]["thread"] = th
+                    self.clients[client]["sender"] = sender
+                self.registry.add_client(client)
+                th.start()
+                sender.start()
+            except OSError:
+                break
+            except Exception as e:
+                self.ui_queue(("error", f"Accept error: {e}"))
+                traceback.print_exc()
+
+    def _client_thread(self, client):
+        addr = self.clients[client]["addr"]
+        framer = StreamFramer(max_frame=self.max_frame)
+        try:
+            client.settimeout(0.5)
+            while self.running:
+                try:
+                    n = framer.recv_into(client)
+                    if not n:
+                        break
+                    if not self._dispatch_frames(client, addr, framer, n):
+                        break
+                except socket.timeout:
+                    continue
+                except ConnectionResetError:
+                    break
+                except Exception as e:
+                    self.ui_queue(("error", f"Client read error {addr}: {e}"))
+                    traceback.print_exc()
+                    break
+        finally:
+            self._remove_client(client)
+            try:
+                client.close()
+            except:
+                pass
+            self.ui_queue(("client_disconnect", f"{addr}"))
+
+    def _sender_thread(self, client, q):
+        """
+        Drains the client's outbound queue; a slow client only blocks this
+        thread. Whatever queued up meanwhile goes out in one sendmsg.
+        """
+        running = lambda: self.running
+        while self.running and not q.closed:
+            batch = q.get_batch(self.write_batch, WRITE_BATCH_BYTES, timeout=1.0, linger=self.write_linger)
+            if not batch:
+                continue
+            try:
+                # settimeout(0.5) of the reader also applies here: retried while running
+                writes = sendmsg_all(client, batch, running)
+            except OSError:
+                # the reader thread sees the shutdown and cleans up
+                self._disconnect(client)
+                break
+            q.record_sent(sum(map(len, batch)), len(batch), writes)
+
+    def _new_queue(self, name=None):
+        return OutboundQueue(self.queue_size, self.queue_bytes, self.overflow, name)
+
+    def _new_client_info(self, addr, **extra):
+        info = {
+            "addr": addr,
+            "thread": None,
+            "queue": self._new_queue(str(addr)),
+            "proto": PROTO_JSON,   # what we send; switched by HELLO
+            "rx_topics": {},       # bin1 topic id -> topic defined by the client
+            "broker": None,        # id of the broker on the other side of a bridge link
+        }
+        info.update(extra)
+        return info
+
+    def _disconnect(self, client):
+        try:
+            client.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    @property
+    def serializations_avoided(self):
+        """Deliveries that reused an already encoded frame instead of serializing again."""
+        return max(0, self.activity.counters()["deliveries"] - self.encodes.value)
+
+    def client_stats(self):
+        """Outbound queue counters per client address."""
+        with self.lock:
+            return {info["addr"]: info["queue"].stats() for info in self.clients.values()}
+
+    def _dispatch_frames(self, client, addr, framer, nbytes=0):
+        """
+        Handle every complete JSON line or bin1 frame buffered in framer
+        (nbytes: just received). Returns False if the client exceeded
+        max_frame and must be dropped.
+        """
+        count = 0
+        try:
+            for frame in framer:
+                count += 1
+                if isinstance(frame, BinaryFrame):
+                    self._handle_binary(client, addr, frame)
+                else:
+                    self._handle_line(client, addr, frame)
+        except FrameTooLarge as e:
+            self.ui_queue(("error", f"Client {addr} dropped: {e}"))
+            return False
+        finally:
+            self.metrics.received(TCP, count, nbytes)
+        return True
+
+    def _handle_binary(self, client, addr, frame):
+        info = self.clients.get(client)
+        if info is None:
+            return
+        if frame.action == TOPIC:
+            info["rx_topics"][frame.topic] = frame.meta.decode("utf-8")
+            return
+        if frame.action == PUB:
+            topic = frame.topic
+            if not isinstance(topic, str):
+                topic = info["rx_topics"].get(topic)
+                if topic is None:
+                    self.ui_queue(("error", f"Unknown topic id {frame.topic} from {addr}"))
+                    return
+            data = raw = None
+            if frame.meta and not frame.key and not self.validate_data and raw_json(frame.meta):
+                raw = frame.meta  # forwarded as is, like the blob
+            else:
+                try:
+                    data = loads(frame.meta) if frame.meta else None
+                except Exception:
+                    self.ui_queue(("error", f"Invalid JSON metadata from {addr} on {topic}"))
+                    return
+            self.activity.message_in(addr, {"action": "PUB", "topic": topic, "blob": len(frame.blob)})
+            self.publish(topic, data, origin=client,
+                         blob=frame.blob if frame.key else None, blob_key=frame.key or None,
+                         retain=bool(frame.flags & FLAG_RETAIN), via=_via_in(frame.via, info["broker"]),
+                         raw=raw)
+            return
+        # SUB / UNSUB / CTRL: same JSON object as the JSON-lines packet
+        try:
+            pkt = loads(frame.meta)
+        except Exception:
+            self.ui_queue(("error", f"Invalid binary control frame from {addr}"))
+            return
+        pkt["action"] = ACTION_NAMES.get(frame.action, pkt.get("action", ""))
+        self.activity.message_in(addr, pkt)
+        self._handle_packet(client, pkt)
+
+    def _handle_line(self, client, addr, line):
+        split = _split_pub(line, self.validate_data)
+        if split is not None:
+            pkt, raw = split
+        else:
+            raw = None
+            try:
+                # the codec parses the UTF-8 bytes as read, without decoding them first
+                pkt = loads(line)
+            except ValueError:
+                # not UTF-8 (or not JSON): one more try as latin-1
+                text = line.decode('latin-1').strip()
+                try:
+                    pkt = loads(text)
+                except ValueError:
+                    self.ui_queue(("error", f"Invalid JSON from {addr}: {text}"))
+                    return
+        self.activity.message_in(addr, pkt)
+        self._handle_packet(client, pkt, raw)
+
+    def _handle_packet(self, client, pkt, raw=None):
+        action = pkt.get("action", "").upper()
+        topic = pkt.get("topic", "")
+        if action == "SUB":
+            conflate = bool(pkt.get("conflate"))
+            try:
+                self.registry.subscribe(client, topic, conflate)
+            except ValueError as e:
+                self.ui_queue(("error", f"Invalid SUB pattern: {e}"))
+                return
+            self.ui_queue(("info", f"Client subscribed {topic}"))
+            # Optionally send ack
+            self._safe_send(client, {"topic": topic, "status": "subscribed"})
+            # current values, without waiting for the next publish
+            for frame in self.retained.match(topic):
+                self._send_frame(client, frame, conflate)
+        elif action == "UNSUB":
+            self.registry.unsubscribe(client, topic)
+            self.ui_queue(("info", f"Client unsubscribed {topic}"))
+        elif action == "PUB":
+            data = pkt.get("data", None)
+            info = self.clients.get(client)
+            via = _via_in(pkt.get("via"), info["broker"] if info is not None else None)
+            # broadcast to subscribers whose topic matches exactly
+            self.publish(topic, data, origin=client, retain=bool(pkt.get("retain")), via=via, raw=raw)
+        elif action == "HELLO":
+            # negociación del formato de salida (ver pubsub_wire)
+            proto = PROTO_BIN1 if pkt.get("proto") == PROTO_BIN1 else PROTO_JSON
+            self._safe_send(client, {"status": "hello", "proto": proto, "broker": self.broker_id})
+            info = self.clients.get(client)
+            if info is not None:
+                info["proto"] = proto
+                # un puente desde otro broker se presenta con su id
+                if isinstance(pkt.get("broker"), str):
+                    info["broker"] = pkt["broker"]
+        else:
+            self.ui_queue(("error", f"Unknown action: {action}"))
+
+    def _safe_send(self, client, obj):
+        info = self.clients.get(client)
+        if info is None:
+            return
+        if info["proto"] == PROTO_BIN1:
+            payload = pack_ctrl(obj)
+        else:
+            payload = dumpl(obj)
+        self._enqueue(client, info, payload)
+
+    def _send_frame(self, client, frame, conflate=False):
+        info = self.clients.get(client)
+        if info is None:
+            return
+        payload = _payload(info, frame)
+        if payload is not None:
+            self._enqueue(client, info, payload, frame.topic, conflate)
+
+    def _enqueue(self, client, info, payload, topic=None, conflate=False):
+        try:
+            info["queue"].put(payload, topic, conflate)
+        except SlowConsumer as e:
+            self.ui_queue(("error", f"Slow consumer {info['addr']} disconnected: {e}"))
+            self._disconnect(client)
+
+    def publish(self, topic, data, origin=None, blob=None, blob_key=None, retain=False, via=(), raw=None):
+        """
+        Route data to every matching subscriber. blob is an optional raw
+        payload (bytes) from a bin1 publisher, delivered as is to binary
+        clients and base64-encoded under data[blob_key] to JSON ones.
+        With retain (or a topic matching a --retain pattern) the message
+        also becomes the value sent to later subscribers.
+        With a cluster bus, messages not received from the bus are also
+        forwarded to the other worker processes. via lists the brokers a
+        bridged message went through; one that already went through this
+        broker is dropped (a bridge loop).
+        raw replaces data with its JSON text as received (bytes or str):
+        it is forwarded verbatim, and parsed only if a feature needs
+        the object (see EncodedMessage).
+        """
+        if via and self.broker_id in via:
+            with self.lock:
+                self.loops_dropped += 1
+            return
+        t0 = time.perf_counter()
+
+        # exact, '+' and '#' subscribers of every transport, in one trie walk
+        targets, conflated = self.registry.match(topic)
+        if len(self.conflate_topics) and self.conflate_topics.match(topic):
+            conflated = targets
+
+        # serialized once, the same bytes go to every subscriber
+        frame = EncodedMessage(topic, data, blob, blob_key, via, raw, counter=self.encodes)
+        if retain or (len(self.retain_topics) and self.retain_topics.match(topic)):
+            self.retained.put(frame)
+        if self.message_log is not None:
+            try:
+                self.message_log.append(frame)
+            except (OSError, ValueError) as e:
+                self.ui_queue(("error", f"Message log append failed: {e}"))
+        if self.bus is not None and origin is not self.bus:
+            self.bus.forward(frame, retain)
+
+        # Enviar a clientes TCP y WebSocket
+        deliveries = self._deliver(targets, origin, frame, conflated)
+
+        # Notificar a publicadores externos (p.ej. WebSockets)
+        for fn in list(self.external_publishers):
+            try:
+                deliveries += fn(topic, frame.data, origin, frame) or 0
+            except Exception as e:
+                self.ui_queue(("error", f"External publisher error: {e}"))
+        self.activity.publish(topic, deliveries)
+        self.metrics.published(topic, deliveries, frame.size, time.perf_counter() - t0)
+
+    def _deliver(self, targets, origin, frame, conflated=()):
+        """
+        Queue frame for every target except origin. Our TCP clients are
+        served by _deliver_tcp; handles of another front-end (WebSocket)
+        go to its deliver(), one call per front-end. Targets in conflated
+        keep only the latest pending message of this topic.
+        Returns the number of sends.
+        """
+        tcp = []
+        others = None
+        for c in targets:
+            if c is origin:
+                continue
+            frontend = getattr(c, "frontend", None)
+            if frontend is None:
+                tcp.append(c)
+            else:
+                if others is None:
+                    others = {}
+                others.setdefault(frontend, []).append(c)
+        sent = self._deliver_tcp(tcp, frame, conflated) if tcp else 0
+        if others:
+            for frontend, handles in others.items():
+                try:
+                    sent += frontend.deliver(handles, frame, conflated)
+                except Exception as e:
+                    self.ui_queue(("error", f"Delivery error ({type(frontend).__name__}): {e}"))
+        return sent
+
+    def _deliver_tcp(self, clients, frame, conflated):
+        for c in clients:
+            self._send_frame(c, frame, c in conflated)
+        return len(clients)
+
+    def _remove_client(self, client):
+        self._remove_clients((client,))
+
+    def _remove_clients(self, clients):
+        """Forget clients: their table entries and queues, then their subscriptions, one pass each."""
+        gone = []
+        with self.lock:
+            for client in clients:
+                info = self.clients.pop(client, None)
+                if info is not None:
+                    info["queue"].close()
+                    gone.append(info["queue"])
+        for q in gone:
+            self.metrics.client_gone(q)
+        self.registry.remove_clients(clients)
+
+    def disconnect_clients(self, clients):
+        """
+        Drop many TCP clients at once (e.g. every robot of a classroom whose
+        access point went down): tables and subscriptions are cleaned in one
+        pass before the connections are closed. Returns how many were connected.
+        """
+        with self.lock:
+            clients = [c for c in clients if c in self.clients]
+        self._remove_clients(clients)
+        for client in clients:
+            self._disconnect(client)
+        return len(clients)
+
+
+# ---------------------------
+# Broker implementation (asyncio engine)
+# ---------------------------
+
+class _LoopShard:
+    """One event loop thread of an AsyncBroker."""
+    def __init__(self, index):
+        self.index = index
+        self.loop = None
+        self.thread = None
+        self.thread_id = None
+        self.server = None
+        self.ready = threading.Event()
+        self.gone = []  # clients disconnected in this loop iteration, see AsyncBroker._reap
+
+
+class _AsyncTCPClient(asyncio.BufferedProtocol):
+    """A TCP client served by an AsyncBroker shard. Used as the client key in Broker dicts."""
+    def __init__(self, broker, shard):
+        self.broker = broker
+        self.shard = shard
+        self.transport = None
+        self.addr = None
+        self.framer = StreamFramer(max_frame=broker.max_frame)
+        self.info = None
+        self.queue = None
+        self.paused = False
+        self.flush_pending = False
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.addr = transport.get_extra_info("peername")
+        self.info = self.broker._new_client_info(self.addr, shard=self.shard.index)
+        self.queue = self.info["queue"]
+        self.broker.ui_queue(("client_connect", f"{self.addr}"))
+        with self.broker.lock:
+            self.broker.clients[self] = self.info
+        self.broker.registry.add_client(self)
+
+    # the transport reads straight into the framer's buffer
+    def get_buffer(self, sizehint):
+        return self.framer.writable(sizehint)
+
+    def buffer_updated(self, nbytes):
+        self.framer.commit(nbytes)
+        if not self.broker._dispatch_frames(self, self.addr, self.framer, nbytes):
+            self.transport.abort()
+
+    def connection_lost(self, exc):
+        # removed in batch with the other clients lost in this loop iteration
+        shard = self.shard
+        shard.gone.append(self)
+        if len(shard.gone) == 1:
+            shard.loop.call_soon(self.broker._reap, shard)
+        self.broker.ui_queue(("client_disconnect", f"{self.addr}"))
+
+    # transport buffer above its high-water mark: keep messages in our bounded queue
+    def pause_writing(self):
+        self.paused = True
+
+    def resume_writing(self):
+        self.paused = False
+        self._flush()
+
+    def _enqueue(self, line, topic=None, conflate=False):
+        try:
+            self.queue.put(line, topic, conflate)
+        except SlowConsumer as e:
+            self.broker.ui_queue(("error", f"Slow consumer {self.addr} disconnected: {e}"))
+            self.transport.abort()
+            return
+        if not self.paused and not self.flush_pending:
+            # everything queued in this loop iteration (or within the linger) goes in one write
+            self.flush_pending = True
+            broker = self.broker
+            if broker.write_linger:
+                self.shard.loop.call_later(broker.write_linger, self._flush)
+            else:
+                self.shard.loop.call_soon(self._flush)
+
+    def _flush(self):
+        self.flush_pending = False
+        q = self.queue
+        batch_size = self.broker.write_batch
+        while len(q) and not self.paused and not self.transport.is_closing():
+            batch = q.get_batch(batch_size, WRITE_BATCH_BYTES, timeout=0)
+            if len(batch) == 1:
+                self.transport.write(batch[0])
+            else:
+                self.transport.writelines(batch)
+            q.record_sent(sum(map(len, batch)), len(batch))
+
+    def send(self, line, topic=None, conflate=False):
+        """Thread-safe enqueue, same role as Broker._enqueue for the threaded engine."""
+        if threading.get_ident() == self.shard.thread_id:
+            self._enqueue(line, topic, conflate)
+        else:
+            self.shard.loop.call_soon_threadsafe(self._enqueue, line, topic, conflate)
+
+    def abort(self):
+        if threading.get_ident() == self.shard.thread_id:
+            self.transport.abort()
+        else:
+            self.shard.loop.call_soon_threadsafe(self.transport.abort)
+
+
+def _via_in(via, peer):
+    """Brokers a message received from a client went through: its own list plus the bridge peer, if any."""
+    via = tuple(str(v) for v in via) if isinstance(via, (list, tuple)) else ()
+    return via + (peer,) if peer is not None else via
+
+
+def _split_pub(doc, validate=False):
+    """
+    (pkt, raw) of a large PUB, routed without parsing its data (see
+    pubsub_wire.split_packet), or None: parse doc whole.
+    """
+    if validate or len(doc) < LAZY_MIN_BYTES:
+        return None
+    split = split_packet(doc)
+    if split is None or split[1] is None or str(split[0].get("action", "")).upper() != "PUB":
+        return None
+    split[0]["data_bytes"] = len(split[1])  # what the UI log shows instead of data
+    return split
+
+
+def _payload(info, frame):
+    """
+    The bytes of frame for a TCP client: the shared JSON line or bin1
+    frame, or, for a bridge link, the form with via (None if the broker
+    on the other side already had the message).
+    """
+    peer = info["broker"]
+    if peer is not None and frame.via:
+        if peer in frame.via:
+            return None
+        return frame.via_binary() if info["proto"] == PROTO_BIN1 else (frame.via_text() + "\n").encode("utf-8")
+    return frame.binary if info["proto"] == PROTO_BIN1 else frame.line
+
+
+def _enqueue_all(clients, frame, conflated):
+    for c in clients:
+        if not c.transport.is_closing():
+            payload = _payload(c.info, frame)
+            if payload is not None:
+                c._enqueue(payload, frame.topic, c in conflated)
+
+
+class AsyncBroker(Broker):
+    """
+    Broker engine that serves every TCP client from asyncio event loops
+    instead of one thread per client.
+
+    - Same JSON-lines SUB/UNSUB/PUB protocol, subscription registry and
+      register_external_publisher hooks as Broker (routing is inherited).
+    - shards > 1 runs N loops, each in its own thread, all accepting on
+      the same listening socket.
+    - Deliveries to clients of another shard are batched: one
+      call_soon_threadsafe per shard per publish.
+    """
+    def __init__(self, host="0.0.0.0", port=5051, ui_queue=None, shards=1, **queue_opts):
+        super().__init__(host=host, port=port, ui_queue=ui_queue, **queue_opts)
+        self.shards = max(1, int(shards))
+        self._shards = []
+
+    def start(self):
+        if self.running:
+            return False
+        self.server_sock = self._listen(128)
+        self.running = True
+        self._shards = [_LoopShard(i) for i in range(self.shards)]
+        for shard in self._shards:
+            shard.thread = threading.Thread(target=self._run_shard, args=(shard,), daemon=True)
+            shard.thread.start()
+        for shard in self._shards:
+            shard.ready.wait(5.0)
+        self.ui_queue(("info", f"Broker (TCP, asyncio x{self.shards}) listening on {self.host}:{self.port}"))
+        return True
+
+    def _run_shard(self, shard):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        shard.loop = loop
+        shard.thread_id = threading.get_ident()
+        try:
+            # each loop gets its own fd for the shared listening socket
+            shard.server = loop.run_until_complete(
+                loop.create_server(lambda: _AsyncTCPClient(self, shard), sock=self.server_sock.dup())
+            )
+        except Exception as e:
+            self.ui_queue(("error", f"Shard {shard.index} failed to start: {e}"))
+            shard.ready.set()
+            loop.close()
+            return
+        shard.ready.set()
+        try:
+            loop.run_forever()
+        finally:
+            shard.server.close()
+            with self.lock:
+                mine = [c for c in self.clients if c.shard is shard]
+            for c in mine:
+                c.transport.close()
+            # let connection_lost callbacks run
+            loop.run_until_complete(asyncio.sleep(0))
+            self._reap(shard)
+            loop.close()
+
+    def stop(self):
+        self.running = False
+        for shard in self._shards:
+            if shard.loop and not shard.loop.is_closed():
+                try:
+                    shard.loop.call_soon_threadsafe(shard.loop.stop)
+                except RuntimeError:
+                    pass
+        for shard in self._shards:
+            if shard.thread:
+                shard.thread.join(timeout=2.0)
+        self._shards = []
+        with self.lock:
+            self.clients.clear()
+        self.registry.drop_frontend(None)
+        if self.server_sock:
+            try:
+                self.server_sock.close()
+            except:
+                pass
+        self.ui_queue(("info", "Broker (TCP) stopped"))
+
+    def _reap(self, shard):
+        """Remove the clients lost since the last call, in one pass (runs on the shard loop)."""
+        gone, shard.gone = shard.gone, []
+        if gone:
+            self._remove_clients(gone)
+
+    def _enqueue(self, client, info, payload, topic=None, conflate=False):
+        client.send(payload, topic, conflate)
+
+    def _disconnect(self, client):
+        client.abort()
+
+    def _deliver_tcp(self, clients, frame, conflated):
+        me = threading.get_ident()
+        remote = {}
+        for c in clients:
+            if c.shard.thread_id == me:
+                if not c.transport.is_closing():
+                    payload = _payload(c.info, frame)
+                    if payload is not None:
+                        c._enqueue(payload, frame.topic, c in conflated)
+            else:
+                remote.setdefault(c.shard, []).append(c)
+        for shard, batch in remote.items():
+            try:
+                shard.loop.call_soon_threadsafe(_enqueue_all, batch, frame, conflated)
+            except RuntimeError:
+                # loop already closed (broker stopping)
+                pass
+        return len(clients)
+
+
+ENGINES = ("thread", "async")
+
+
+def make_broker(engine="thread", shards=1, **kwargs):
+    """Build the TCP broker engine selected at startup ("thread" or "async")."""
+    if engine == "thread":
+        return Broker(**kwargs)
+    if engine == "async":
+        return AsyncBroker(shards=shards, **kwargs)
+    raise ValueError(f"Unknown broker engine: {engine}")
+
+
+def add_arguments(parser):
+    """The queue, write and topic options of Broker (shared by the Tk and headless entry points)."""
+    parser.add_argument("--queue-size", type=int, default=QUEUE_MESSAGES,
+                        help="max messages queued per subscriber")
+    parser.add_argument("--queue-bytes", type=int, default=QUEUE_BYTES,
+                        help="max bytes queued per subscriber")
+    parser.add_argument("--overflow", choices=POLICIES, default=OVERFLOW,
+                        help="what to do when a subscriber queue is full (default disconnect: the "
+                             "client is closed, nothing is dropped silently; the drop-*/coalesce "
+                             "policies lose messages, the first drop per client is logged)")
+    parser.add_argument("--write-batch", type=int, default=WRITE_BATCH,
+                        help="max queued messages sent to a TCP subscriber in one write call")
+    parser.add_argument("--write-linger-us", type=int, default=0,
+                        help="microseconds a short write batch waits for more messages")
+    parser.add_argument("--sndbuf", type=int, default=0,
+                        help="kernel send buffer per TCP client in bytes (0: system default)")
+    parser.add_argument("--validate-data", action="store_true",
+                        help="parse the data of every PUB (by default large payloads are forwarded unparsed)")
+    # None rather than []: a --config file may set the list (see pubsub_headless)
+    parser.add_argument("--conflate", action="append", default=None, metavar="PATTERN",
+                        help="topic pattern delivered latest-value-only (repeatable)")
+    parser.add_argument("--max-frame", type=int, default=1 << 20,
+                        help="max bytes of a JSON line or bin1 frame from a client")
+    parser.add_argument("--retain", action="append", default=None, metavar="PATTERN",
+                        help="topic pattern whose last message is always retained (repeatable)")
+    parser.add_argument("--retain-max-topics", type=int, default=10000,
+                        help="max retained topics (least recently used evicted first)")
+    parser.add_argument("--retain-max-bytes", type=int, default=16 * 1024 * 1024,
+                        help="max bytes of retained messages")
+
+
+def broker_kwargs(args):
+    """Broker keyword arguments for the parsed add_arguments() options."""
+    return dict(queue_size=args.queue_size, queue_bytes=args.queue_bytes, overflow=args.overflow,
+                write_batch=args.write_batch, write_linger_us=args.write_linger_us,
+                sndbuf=args.sndbuf, validate_data=args.validate_data,
+                conflate=args.conflate or (), max_frame=args.max_frame, retain=args.retain or (),
+                retain_max_topics=args.retain_max_topics, retain_max_bytes=args.retain_max_bytes)
+
+
+# ---------------------------
+# RemoteConnector: TCP client
+# ---------------------------
+
+class _Backoff:
+    """Exponential reconnect delay for one remote endpoint."""
+    def __init__(self, base=0.5, cap=30.0):
+        self.base = base
+        self.cap = cap
+        self.failures = 0
+        self.next_try = 0.0
+
+    def ready(self):
+        return time.monotonic() >= self.next_try
+
+    def failed(self):
+        self.failures += 1
+        self.next_try = time.monotonic() + min(self.cap, self.base * 2 ** (self.failures - 1))
+
+    def succeeded(self):
+        self.failures = 0
+        self.next_try = 0.0
+
+
+class _PooledConn:
+    def __init__(self, sock):
+        self.sock = sock
+        self.lock = threading.Lock()  # one writer at a time
+        self.closed = False
+
+
+class RemoteConnector:
+    """
+    TCP client to send JSON packets to remote servers (RPis, other brokers).
+
+    Keeps one persistent connection per (host, port) and reuses it, with
+    exponential backoff between reconnect attempts. Sends are pipelined:
+    send_packet() returns as soon as the packet is written, and replies
+    are read by a background thread and reported as "remote_resp" events.
+    send_packet_async()/send_many() send to many hosts in parallel.
+    """
+    def __init__(self, ui_queue=None, max_workers=16):
+        self.ui_queue = ui_queue or (lambda *args, **kwargs: None)
+        self.max_workers = max_workers
+        self._conns = {}    # (host, port) -> _PooledConn
+        self._backoff = {}  # (host, port) -> _Backoff
+        self._lock = threading.Lock()
+        self._executor = None
+
+    def _get_conn(self, key, timeout):
+        with self._lock:
+            conn = self._conns.get(key)
+            if conn is not None and not conn.closed:
+                return conn
+            backoff = self._backoff.setdefault(key, _Backoff())
+        if not backoff.ready():
+            raise ConnectionError(f"waiting to reconnect ({backoff.failures} failures)")
+        try:
+            s = socket.create_connection(key, timeout=timeout)
+        except OSError:
+            backoff.failed()
+            raise
+        backoff.succeeded()
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        conn = _PooledConn(s)
+        with self._lock:
+            old = self._conns.get(key)
+            if old is not None and not old.closed:
+                # another thread connected meanwhile
+                s.close()
+                return old
+            self._conns[key] = conn
+        threading.Thread(target=self._reader, args=(key, conn), daemon=True).start()
+        return conn
+
+    def _close_conn(self, key, conn):
+        conn.closed = True
+        with self._lock:
+            if self._conns.get(key) is conn:
+                del self._conns[key]
+        try:
+            conn.sock.close()
+        except OSError:
+            pass
+
+    def _reader(self, key, conn):
+        host, port = key
+        framer = StreamFramer(size=2048)
+        try:
+            while not conn.closed:
+                try:
+                    if not framer.recv_into(conn.sock):
+                        break
+                except socket.timeout:
+                    continue
+                for frame in framer:
+                    if isinstance(frame, BinaryFrame):
+                        frame = frame.meta
+                    text = frame.decode('utf-8', 'replace').strip()
+                    try:
+                        obj = loads(text)
+                    except:
+                        obj = text
+                    self.ui_queue(("remote_resp", (host, port, obj)))
+        except (OSError, FrameTooLarge):
+            pass
+        finally:
+            self._close_conn(key, conn)
+
+    def send_packet(self, host, port, packet_obj, timeout=5.0):
+        key = (host, int(port))
+        payload = dumpl(packet_obj)
+        try:
+            conn = self._get_conn(key, timeout)
+            try:
+                with conn.lock:
+                    conn.sock.sendall(payload)
+            except OSError:
+                # pooled connection went stale (peer closed it): reconnect once
+                self._close_conn(key, conn)
+                conn = self._get_conn(key, timeout)
+                with conn.lock:
+                    conn.sock.sendall(payload)
+            return True
+        except Exception as e:
+            self.ui_queue(("error", f"Remote send error to {host}:{port}: {e}"))
+            return False
+
+    def send_packet_async(self, host, port, packet_obj, timeout=5.0):
+        """Like send_packet but non-blocking: returns a concurrent.futures.Future of the result."""
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers,
+                                                    thread_name_prefix="remote")
+            executor = self._executor
+        return executor.submit(self.send_packet, host, port, packet_obj, timeout)
+
+    def send_many(self, targets, packet_obj, timeout=5.0):
+        """Send packet_obj to every (host, port) in parallel. Returns {(host, port): ok}."""
+        futures = {(h, int(p)): self.send_packet_async(h, p, packet_obj, timeout) for h, p in targets}
+        return {key: f.result() for key, f in futures.items()}
+
+    def close(self):
+        with self._lock:
+            conns = list(self._conns.items())
+            executor, self._executor = self._executor, None
+        for key, conn in conns:
+            self._close_conn(key, conn)
+        if executor is not None:
+            executor.shutdown(wait=False)
+
+
+# ---------------------------
+# RemoteConnectorWS: WebSocket client
+# ---------------------------
+
+class RemoteConnectorWS:
+    """
+    Cliente WebSocket para enviar paquetes JSON a servidores WS.
+
+    Mantiene una conexión persistente por URI en un bucle asyncio propio
+    (un hilo), con backoff al reconectar. Las respuestas se leen en
+    segundo plano y se reportan como eventos "remote_resp".
+    """
+    def __init__(self, ui_queue=None):
+        self.ui_queue = ui_queue or (lambda *args, **kwargs: None)
+        self.loop = None
+        self.thread = None
+        self._lock = threading.Lock()
+        self._conns = {}    # uri -> websocket abierto
+        self._connecting = {}  # uri -> asyncio.Lock
+        self._backoff = {}  # uri -> _Backoff
+
+    def _ensure_loop(self):
+        with self._lock:
+            if self.loop is None:
+                self.loop = asyncio.new_event_loop()
+                self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+                self.thread.start()
+            return self.loop
+
+    async def _get_ws(self, uri, timeout):
+        ws = self._conns.get(uri)
+        if ws is not None:
+            return ws
+        lock = self._connecting.setdefault(uri, asyncio.Lock())
+        async with lock:
+            ws = self._conns.get(uri)
+            if ws is not None:
+                return ws
+            backoff = self._backoff.setdefault(uri, _Backoff())
+            if not backoff.ready():
+                raise ConnectionError(f"waiting to reconnect ({backoff.failures} failures)")
+            try:
+                ws = await websockets.connect(uri, open_timeout=timeout, close_timeout=1)
+            except Exception:
+                backoff.failed()
+                raise
+            backoff.succeeded()
+            self._conns[uri] = ws
+            self.loop.create_task(self._reader(uri, ws))
+            return ws
+
+    async def _reader(self, uri, ws):
+        try:
+            async for resp in ws:
+                try:
+                    obj = loads(resp)
+                except:
+                    obj = resp
+                self.ui_queue(("remote_resp", (uri, obj)))
+        except websockets.exceptions.ConnectionClosed:
+            pass
+        finally:
+            if self._conns.get(uri) is ws:
+                del self._conns[uri]
+
+    async def _send_packet_async(self, uri, packet_obj, timeout=5.0):
+        payload = dumps(packet_obj)
+        try:
+            ws = await self._get_ws(uri, timeout)
+            try:
+                await ws.send(payload)
+            except websockets.exceptions.ConnectionClosed:
+                # conexión caída: reconectar una vez
+                if self._conns.get(uri) is ws:
+                    del self._conns[uri]
+                ws = await self._get_ws(uri, timeout)
+                await ws.send(payload)
+            return True
+        except Exception as e:
+            self.ui_queue(("error", f"Remote WS send error to {uri}: {e}"))
+            return False
+
+    def send_packet_async(self, uri, packet_obj, timeout=5.0):
+        """Programa el envío sin bloquear: devuelve un concurrent.futures.Future del resultado."""
+        return asyncio.run_coroutine_threadsafe(
+            self._send_packet_async(uri, packet_obj, timeout), self._ensure_loop())
+
+    def send_packet(self, uri, packet_obj, timeout=5.0):
+        return self.send_packet_async(uri, packet_obj, timeout).result()
+
+    def send_many(self, uris, packet_obj, timeout=5.0):
+        """Envía packet_obj a todas las URIs en paralelo. Devuelve {uri: ok}."""
+        futures = {uri: self.send_packet_async(uri, packet_obj, timeout) for uri in uris}
+        return {uri: f.result() for uri, f in futures.items()}
+
+    async def _close_all(self):
+        conns, self._conns = list(self._conns.values()), {}
+        for ws in conns:
+            try:
+                await ws.close()
+            except Exception:
+                pass
+
+    def close(self):
+        with self._lock:
+            loop, self.loop = self.loop, None
+        if loop is not None:
+            try:
+                asyncio.run_coroutine_threadsafe(self._close_all(), loop).result(timeout=2.0)
+            except Exception:
+                pass
+            loop.call_soon_threadsafe(loop.stop)
+
+
+# ---------------------------
+# WebSocketServer: servidor WS ligado al Broker
+# ---------------------------
+
+class _WSClient:
+    """
+    A WebSocket connection as a handle in the shared SubscriptionRegistry.
+
+    Messages go through its own OutboundQueue, drained by one writer task
+    on the server loop; only that loop touches queue and wakeup.
+    """
+    __slots__ = ("ws", "addr", "frontend", "queue", "wakeup", "writer", "broker")
+
+    def __init__(self, ws, frontend, queue):
+        self.ws = ws
+        self.addr = ws.remote_address
+        self.frontend = frontend  # the WebSocketServer that delivers to it
+        self.queue = queue
+        self.wakeup = asyncio.Event()
+        self.writer = None
+        self.broker = None  # id of the broker on the other side of a bridge link
+
+    def text(self, frame):
+        """frame as sent to this client (None: a bridge peer that already had it)."""
+        if self.broker is not None and frame.via:
+            return None if self.broker in frame.via else frame.via_text()
+        return frame.text
+
+    def __repr__(self):
+        return f"WS {self.addr}"
+
+
+class WebSocketServer:
+    """
+    Servidor WebSocket que comparte topics con el Broker TCP.
+
+    - SUB/UNSUB/PUB vía WebSocket
+    - Registra sus clientes en el mismo SubscriptionRegistry que el Broker:
+      un publish (TCP o WS) hace un solo match y el Broker llama a
+      deliver() con los destinos WS
+    - Cada conexión tiene una cola de salida acotada (mismos límites y
+      política que el Broker) y una tarea que la vacía al ritmo del
+      cliente; un dashboard lento no frena a los demás
+    - stats(): clientes, colas, descartes y retraso (lag) del loop
+    """
+    LAG_INTERVAL = 0.25  # seconds between loop lag probes
+
+    def __init__(self, host="0.0.0.0", port=5052, broker=None, ui_queue=None, reuse_port=False):
+        self.host = host
+        self.port = port
+        self.reuse_port = reuse_port
+        self.broker = broker
+        self.ui_queue = ui_queue or (lambda *args, **kwargs: None)
+        # mismos contadores y suscripciones que el broker TCP, si lo hay
+        self.activity = broker.activity if broker is not None else ActivityMonitor()
+        self.metrics = broker.metrics if broker is not None else Metrics()
+        self.registry = broker.registry if broker is not None else SubscriptionRegistry()
+        self._new_queue = broker._new_queue if broker is not None else OutboundQueue
+
+        self.clients = set()  # _WSClient, added/removed on the loop
+        self._clients_lock = threading.Lock()
+        self._gone = []  # closed in this loop iteration, removed together by _reap
+        # metrics
+        self.handoffs = 0       # publishes handed to the loop from another thread
+        self.loop_lag = 0.0     # last measured scheduling delay, seconds
+        self.loop_lag_max = 0.0
+
+        self.loop = None
+        self.server = None
+        self.thread = None
+        self.thread_id = None
+        self.running = False
+
+    def start(self):
+        if self.running:
+            return False
+        self.running = True
+        self.thread = threading.Thread(target=self._run_loop, daemon=True)
+        self.thread.start()
+        return True
+
+    def _run_loop(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.thread_id = threading.get_ident()
+        self.server = self.loop.run_until_complete(
+            websockets.serve(self._handler, self.host, self.port, max_queue=32,
+                             reuse_port=self.reuse_port or None)
+        )
+        self.ui_queue(("info", f"WebSocket broker listening on {self.host}:{self.port}"))
+        self.loop.create_task(self._lag_monitor())
+        try:
+            self.loop.run_forever()
+        finally:
+            if self.server is not None:
+                self.server.close()
+                self.loop.run_until_complete(self.server.wait_closed())
+            pending = asyncio.all_tasks(self.loop)
+            for task in pending:
+                task.cancel()
+            self.loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+            self.loop.run_until_complete(self.loop.shutdown_asyncgens())
+            self._reap()
+            self.loop.close()
+            self.ui_queue(("info", "WebSocket server stopped"))
+
+    async def _lag_monitor(self):
+        """How late the loop wakes up from a sleep: time spent in other callbacks."""
+        loop = self.loop
+        while True:
+            t0 = loop.time()
+            await asyncio.sleep(self.LAG_INTERVAL)
+            self.loop_lag = max(0.0, loop.time() - t0 - self.LAG_INTERVAL)
+            if self.loop_lag > self.loop_lag_max:
+                self.loop_lag_max = self.loop_lag
+
+    async def _handler(self, websocket, path):
+        client = _WSClient(websocket, self, self._new_queue(name=f"WS {websocket.remote_address}"))
+        client.writer = self.loop.create_task(self._writer(client))
+        with self._clients_lock:
+            self.clients.add(client)
+        self.registry.add_client(client)
+        addr = client.addr
+        self.ui_queue(("client_connect", f"WS {addr}"))
+        try:
+            validate = self.broker is None or self.broker.validate_data
+            async for message in websocket:
+                split = _split_pub(message, validate)
+                if split is not None:
+                    pkt, raw = split
+                else:
+                    raw = None
+                    try:
+                        pkt = loads(message)
+                    except Exception:
+                        self.ui_queue(("error", f"Invalid JSON from WS {addr}: {message!r}"))
+                        continue
+                self.metrics.received(WS, 1, len(message))
+                self.activity.message_in(f"WS {addr}", pkt)
+                await self._handle_packet(client, pkt, raw)
+        except websockets.exceptions.ConnectionClosed:
+            pass
+        finally:
+            client.queue.close()
+            self.metrics.client_gone(client.queue)
+            client.writer.cancel()
+            # many connections dropping at once are removed in one pass
+            self._gone.append(client)
+            if len(self._gone) == 1:
+                self.loop.call_soon(self._reap)
+            self.ui_queue(("client_disconnect", f"WS {addr}"))
+
+    def _reap(self):
+        gone, self._gone = self._gone, []
+        self.registry.remove_clients(gone)
+        with self._clients_lock:
+            self.clients.difference_update(gone)
+
+    async def _handle_packet(self, client, pkt, raw=None):
+        action = pkt.get("action", "").upper()
+        topic = pkt.get("topic", "")
+
+        if action == "SUB":
+            try:
+                self.registry.subscribe(client, topic, bool(pkt.get("conflate")))
+            except ValueError as e:
+                self.ui_queue(("error", f"Invalid WS SUB pattern: {e}"))
+                return
+            # ACK, por la misma cola para no adelantar mensajes ya encolados
+            self._enqueue(client, dumps({"topic": topic, "status": "subscribed"}))
+            # valores retenidos: el dashboard converge sin esperar al siguiente publish
+            if self.broker is not None:
+                for frame in self.broker.retained.match(topic):
+                    text = client.text(frame)
+                    if text is not None:
+                        self._enqueue(client, text, frame.topic)
+
+        elif action == "UNSUB":
+            self.registry.unsubscribe(client, topic)
+
+        elif action == "PUB":
+            data = pkt.get("data", None)
+            if self.broker is not None:
+                # reusa la lógica del broker (un solo match para TCP y WS)
+                self.broker.publish(topic, data, origin=client, retain=bool(pkt.get("retain")),
+                                    via=_via_in(pkt.get("via"), client.broker), raw=raw)
+
+        elif action == "HELLO":
+            # un puente desde otro broker se presenta con su id
+            if isinstance(pkt.get("broker"), str):
+                client.broker = pkt["broker"]
+            broker_id = self.broker.broker_id if self.broker is not None else None
+            self._enqueue(client, dumps({"status": "hello", "broker": broker_id}))
+
+        else:
+            self.ui_queue(("error", f"Unknown WS action: {action}"))
+
+    def deliver(self, handles, frame, conflated=()):
+        """
+        Llamado por Broker._deliver desde cualquier hilo con los destinos WS
+        de un publish (frame ya serializado). Si el publicador es un cliente
+        WS ya estamos en el loop y se encola sin saltos; si no, un solo
+        call_soon_threadsafe por publish, sin importar cuántos clientes WS
+        haya. Devuelve cuántos envíos se programaron.
+        """
+        if not self.loop or not self.running:
+            return 0
+        frame.text  # serialized here, not on the loop
+        if threading.get_ident() == self.thread_id:
+            self._fan_out(handles, frame, conflated)
+        else:
+            try:
+                self.loop.call_soon_threadsafe(self._fan_out, handles, frame, conflated)
+            except RuntimeError:
+                # loop already closed (server stopping)
+                return 0
+            self.handoffs += 1
+        return len(handles)
+
+    def _fan_out(self, handles, frame, conflated):
+        for client in handles:
+            text = client.text(frame)
+            if text is not None:
+                self._enqueue(client, text, frame.topic, client in conflated)
+
+    def _enqueue(self, client, text, topic=None, conflate=False):
+        try:
+            client.queue.put(text, topic, conflate)
+        except SlowConsumer as e:
+            self.ui_queue(("error", f"Slow WS consumer {client.addr} disconnected: {e}"))
+            client.queue.close()
+            self.loop.create_task(client.ws.close(1008, "slow consumer"))
+        client.wakeup.set()
+
+    async def _writer(self, client):
+        """Drains client.queue; ws.send waits while the socket buffer is full."""
+        q = client.queue
+        while not q.closed:
+            text = q.get_nowait()
+            if text is None:
+                client.wakeup.clear()
+                await client.wakeup.wait()
+                continue
+            try:
+                await client.ws.send(text)
+            except websockets.exceptions.ConnectionClosed:
+                # La limpieza real se hace en _handler cuando el WS se cierra
+                break
+            q.record_sent(len(text))
+
+    def client_stats(self):
+        """Outbound queue counters per client address."""
+        with self._clients_lock:
+            return {c.addr: c.queue.stats() for c in self.clients}
+
+    def stats(self):
+        """Per-server totals plus the event loop lag (milliseconds)."""
+        with self._clients_lock:
+            queues = [c.queue for c in self.clients]
+        return {
+            "clients": len(queues),
+            "queued_messages": sum(len(q) for q in queues),
+            "dropped": sum(q.dropped for q in queues),
+            "coalesced": sum(q.coalesced for q in queues),
+            "handoffs": self.handoffs,
+            "loop_lag_ms": round(self.loop_lag * 1000, 2),
+            "loop_lag_max_ms": round(self.loop_lag_max * 1000, 2),
+        }
+
+    def stop(self):
+        self.running = False
+        self.registry.drop_frontend(self)
+        if self.loop:
+            self.loop.call_soon_threadsafe(self.loop.stop)
@@ -0,0 +1,307 @@
+"""
+Multi-process broker: N worker processes sharing the TCP and WS ports.
+
+A single broker process is bound by the GIL: parsing JSON for many
+camera clients saturates one core while the others sit idle. With
+--workers N, pubsub_headless starts N worker processes, each running a
+complete broker (any engine) whose listening sockets are opened with
+SO_REUSEPORT, so the kernel spreads new connections over the workers.
+
+Routing bus: every worker listens on a Unix socket in a private run
+directory and connects to every other worker (full mesh). A message
+published on worker i is forwarded to every other worker as its bin1
+PUB frame (the same bytes binary subscribers get); the receiving worker
+publishes it to its own subscribers and does not forward it again. All
+workers share one broker id, so to bridges (pubsub_bridge) the cluster
+is a single broker.
+
+Every worker thus sees every message:
+
+- retained values are the same on all workers, whichever one a client
+  subscribes through;
+- only worker 0 writes the --log-dir message log, and it logs everything.
+
+Each peer has an OutboundQueue drained by a sender thread, so a busy
+worker never blocks the publisher; when that queue is full the oldest
+message is dropped (bus_dropped in the worker stats).
+
+  python3 -m pubsub_headless --workers 4 --engine async --port 5051 --ws-port 5052
+
+Needs SO_REUSEPORT load balancing (Linux).
+"""
+
+import logging
+import multiprocessing
+import os
+import queue
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import uuid
+
+from pubsub_json import loads
+from pubsub_outbound import OutboundQueue, DROP_OLDEST
+from pubsub_wire import StreamFramer, BinaryFrame, PUB, FLAG_RETAIN
+
+log = logging.getLogger("pubsub")
+
+BUS_QUEUE_MESSAGES = 4096
+BUS_QUEUE_BYTES = 64 * 1024 * 1024
+BUS_MAX_FRAME = 64 * 1024 * 1024
+
+
+def _socket_path(run_dir, index):
+    return os.path.join(run_dir, f"bus-{index}.sock")
+
+
+def _with_retain(payload):
+    """Copy of a bin1 frame with FLAG_RETAIN set (flags is header byte 3)."""
+    frame = bytearray(payload)
+    frame[3] |= FLAG_RETAIN
+    return bytes(frame)
+
+
+class _Peer:
+    """Outgoing side of the connection to another worker."""
+    __slots__ = ("index", "sock", "queue", "thread")
+
+    def __init__(self, index, sock):
+        self.index = index
+        self.sock = sock
+        self.queue = OutboundQueue(BUS_QUEUE_MESSAGES, BUS_QUEUE_BYTES, DROP_OLDEST)
+        self.thread = None
+
+
+class RoutingBus:
+    """
+    Full mesh of Unix sockets between the workers of a cluster.
+
+    Broker.publish calls forward(frame, retain) from any thread for every
+    message that did not come from the bus; messages read from the other
+    workers are published with origin=self.
+    """
+    CONNECT_TIMEOUT = 10.0  # seconds to wait for the other workers to listen
+
+    def __init__(self, index, workers, run_dir, broker, ui_queue=None):
+        self.index = index
+        self.workers = workers
+        self.run_dir = run_dir
+        self.broker = broker
+        self.ui_queue = ui_queue or (lambda *args, **kwargs: None)
+        self.running = False
+        self._server = None
+        self._peers = []
+        self._inbound = {}  # connection -> messages received on it (written by its reader only)
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Listen, then connect to every other worker. Raises OSError if one never listens."""
+        self._server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._server.bind(_socket_path(self.run_dir, self.index))
+        self._server.listen(self.workers)
+        self.running = True
+        threading.Thread(target=self._accept_loop, daemon=True).start()
+        deadline = time.monotonic() + self.CONNECT_TIMEOUT
+        for i in range(self.workers):
+            if i == self.index:
+                continue
+            peer = _Peer(i, self._connect(_socket_path(self.run_dir, i), deadline))
+            peer.thread = threading.Thread(target=self._sender, args=(peer,), daemon=True)
+            peer.thread.start()
+            self._peers.append(peer)
+
+    def _connect(self, path, deadline):
+        while True:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                sock.connect(path)
+                return sock
+            except (FileNotFoundError, ConnectionRefusedError):
+                sock.close()
+                if time.monotonic() > deadline:
+                    raise OSError(f"bus peer {path} is not listening")
+                time.sleep(0.05)
+
+    def forward(self, frame, retain=False):
+        """Queue frame for every other worker."""
+        payload = frame.via_binary() if frame.via else frame.binary
+        if retain:
+            payload = _with_retain(payload)
+        for peer in self._peers:
+            peer.queue.put(payload)
+
+    def _sender(self, peer):
+        q = peer.queue
+        while self.running and not q.closed:
+            payload = q.get(timeout=1.0)
+            if payload is None:
+                continue
+            try:
+                peer.sock.sendall(payload)
+            except OSError as e:
+                if self.running:
+                    self.ui_queue(("error", f"Bus connection to worker {peer.index} lost: {e}"))
+                break
+            q.record_sent(len(payload))
+
+    def _accept_loop(self):
+        while self.running:
+            try:
+                conn, _ = self._server.accept()
+            except OSError:
+                break
+            with self._lock:
+                self._inbound[conn] = 0
+            threading.Thread(target=self._reader, args=(conn,), daemon=True).start()
+
+    def _reader(self, conn):
+        framer = StreamFramer(max_frame=BUS_MAX_FRAME)
+        try:
+            while self.running and framer.recv_into(conn):
+                for frame in framer:
+                    if not isinstance(frame, BinaryFrame) or frame.action != PUB:
+                        continue
+                    # another worker already accepted it: data is forwarded unparsed
+                    blob = frame.blob if frame.key else None
+                    data = loads(frame.meta) if frame.meta and blob is not None else None
+                    raw = frame.meta if frame.meta and blob is None else None
+                    self.broker.publish(frame.topic, data, origin=self,
+                                        blob=blob, blob_key=frame.key or None,
+                                        retain=bool(frame.flags & FLAG_RETAIN), via=frame.via, raw=raw)
+                    self._inbound[conn] += 1
+        except (OSError, ValueError) as e:
+            if self.running:
+                self.ui_queue(("error", f"Bus read error: {e}"))
+        finally:
+            conn.close()
+
+    def stats(self):
+        queues = [p.queue.stats() for p in self._peers]
+        with self._lock:
+            received = sum(self._inbound.values())
+        return {
+            "peers": len(self._peers),
+            "forwarded": sum(q["sent_messages"] for q in queues),
+            "received": received,
+            "queued": sum(q["queued_messages"] for q in queues),
+            "dropped": sum(q["dropped"] for q in queues),
+        }
+
+    def stop(self):
+        self.running = False
+        if self._server is not None:
+            self._server.close()
+            try:
+                os.unlink(_socket_path(self.run_dir, self.index))
+            except OSError:
+                pass
+        for peer in self._peers:
+            peer.queue.close()
+            try:
+                peer.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            peer.sock.close()
+        with self._lock:
+            inbound = list(self._inbound)
+        for conn in inbound:
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+
+class Worker:
+    """One process of the cluster, as seen by pubsub_headless.run()."""
+
+    def __init__(self, index, workers, run_dir, events):
+        self.index = index
+        self.workers = workers
+        self.run_dir = run_dir
+        self._events = events
+        self.bus = None
+
+    def attach(self, broker):
+        """Connect broker to the other workers (before broker.start())."""
+        self.bus = RoutingBus(self.index, self.workers, self.run_dir, broker, broker.ui_queue)
+        broker.bus = self.bus
+        self.bus.start()
+
+    def ready(self):
+        self._events.put(("ready", self.index))
+
+    def failed(self):
+        self._events.put(("failed", self.index))
+
+    def stats(self):
+        return self.bus.stats() if self.bus is not None else {}
+
+    def stop(self):
+        if self.bus is not None:
+            self.bus.broker.bus = None
+            self.bus.stop()
+
+
+def _worker_main(index, args, run_dir, events):
+    """Entry point of a worker process (spawned, so it starts from a clean interpreter)."""
+    import pubsub_headless
+    pubsub_headless.setup_logging(args.log_format, args.log_level, worker=index)
+    raise SystemExit(pubsub_headless.run(args, worker=Worker(index, args.workers, run_dir, events)))
+
+
+def run_cluster(args, stop):
+    """
+    Start args.workers worker processes and supervise them until stop is
+    set or a worker dies. Returns the exit status.
+    """
+    if not hasattr(socket, "SO_REUSEPORT"):
+        log.error("--workers needs SO_REUSEPORT, not available on this system",
+                  extra={"fields": {"event": "error"}})
+        return 1
+    t0 = time.monotonic()
+    # one identity for the whole cluster
+    args.broker_id = args.broker_id or uuid.uuid4().hex[:12]
+    ctx = multiprocessing.get_context("spawn")
+    run_dir = tempfile.mkdtemp(prefix="pubsub-bus-")
+    events = ctx.Queue()
+    procs = [ctx.Process(target=_worker_main, args=(i, args, run_dir, events),
+                         name=f"pubsub-worker-{i}", daemon=True)
+             for i in range(args.workers)]
+    for p in procs:
+        p.start()
+
+    status = 0
+    ready = set()
+    while not stop.is_set():
+        try:
+            kind, index = events.get(timeout=0.5)
+        except queue.Empty:
+            dead = [p for p in procs if not p.is_alive()]
+            if dead:
+                log.error("%s exited with status %s", dead[0].name, dead[0].exitcode,
+                          extra={"fields": {"event": "error", "worker": procs.index(dead[0])}})
+                status = 1
+                break
+            continue
+        if kind == "failed":
+            status = 1
+            break
+        ready.add(index)
+        if len(ready) == len(procs):
+            log.info("cluster of %d workers ready in %.3f s", len(procs), time.monotonic() - t0,
+                     extra={"fields": {"event": "cluster_ready", "workers": len(procs),
+                                       "tcp_port": args.port,
+                                       "ws_port": None if args.no_ws else args.ws_port}})
+
+    for p in procs:
+        if p.is_alive():
+            p.terminate()  # SIGTERM: the worker stops its brokers cleanly
+    for p in procs:
+        p.join(timeout=10)
+        if p.is_alive():
+            p.kill()
+            p.join()
+    shutil.rmtree(run_dir, ignore_errors=True)
+    return status
@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+"""
+Pub/Sub broker without UI, for servers with no display.
+
+Starts the TCP broker and the WebSocket broker and logs to stdout.
+Never imports tkinter.
+
+  python3 -m pubsub_headless --port 5051 --ws-port 5052 --engine async --shards 4
+  python3 -m pubsub_headless --config broker.json --log-format json
+  python3 -m pubsub_headless --workers 4 --engine async   # see pubsub_cluster
+
+The config file is a JSON object whose keys are the long option names
+(with '_' or '-'), e.g. {"port": 5051, "overflow": "coalesce",
+"conflate": ["robots/+/pose"]}. Flags given on the command line win over
+the file.
+
+SIGTERM and SIGINT stop both brokers cleanly (exit status 0).
+"""
+
+import argparse
+import json
+import logging
+import signal
+import sys
+import threading
+import time
+
+from pubsub_broker import ENGINES, make_broker, WebSocketServer
+from pubsub_json import dumps
+from pubsub_activity import RateMeter
+import pubsub_broker
+import pubsub_log
+import pubsub_cluster
+import pubsub_bridge
+import pubsub_metrics
+
+log = logging.getLogger("pubsub")
+
+
+class _JsonFormatter(logging.Formatter):
+    """One JSON object per line: ts, level, msg and the record's event fields."""
+
+    def format(self, record):
+        entry = {
+            "ts": round(record.created, 3),
+            "level": record.levelname.lower(),
+            "msg": record.getMessage(),
+        }
+        entry.update(getattr(record, "fields", {}))
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return dumps(entry)
+
+
+class _WorkerFilter(logging.Filter):
+    """Tags every record with the cluster worker index."""
+
+    def __init__(self, index):
+        super().__init__()
+        self.index = index
+
+    def filter(self, record):
+        record.worker = self.index
+        record.fields = dict(getattr(record, "fields", {}), worker=self.index)
+        return True
+
+
+def setup_logging(fmt="text", level="info", worker=None):
+    handler = logging.StreamHandler(sys.stdout)
+    if fmt == "json":
+        handler.setFormatter(_JsonFormatter())
+    elif worker is not None:
+        handler.setFormatter(logging.Formatter("%(asctime)s [w%(worker)s] %(levelname)s %(message)s"))
+    else:
+        handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+    if worker is not None:
+        handler.addFilter(_WorkerFilter(worker))
+    root = logging.getLogger()
+    root.handlers[:] = [handler]
+    root.setLevel(level.upper())
+
+
+def log_event(evt):
+    """ui_queue callback: broker events as log records."""
+    kind, payload = evt
+    fields = {"event": kind}
+    if kind == "error":
+        log.error("%s", payload, extra={"fields": fields})
+    elif kind in ("client_connect", "client_disconnect"):
+        fields["addr"] = str(payload)
+        log.info("%s %s", kind.replace("_", " "), payload, extra={"fields": fields})
+    else:
+        log.info("%s", payload, extra={"fields": fields})
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Pub/Sub broker without UI")
+    parser.add_argument("--config", metavar="FILE", help="JSON file with default option values")
+    parser.add_argument("--host", default="0.0.0.0", help="address for the TCP and WS listeners")
+    parser.add_argument("--port", type=int, default=5051, help="TCP port")
+    parser.add_argument("--ws-port", type=int, default=5052, help="WebSocket port")
+    parser.add_argument("--no-ws", action="store_true", help="do not start the WebSocket broker")
+    parser.add_argument("--engine", choices=ENGINES, default="thread",
+                        help="TCP engine: one thread per client, or asyncio event loops")
+    parser.add_argument("--shards", type=int, default=1,
+                        help="number of event loops for --engine async")
+    parser.add_argument("--broker-id", help="identity of this broker on bridge links (default: random)")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="broker processes sharing the ports (SO_REUSEPORT, see pubsub_cluster)")
+    pubsub_broker.add_arguments(parser)
+    pubsub_log.add_arguments(parser)
+    pubsub_bridge.add_arguments(parser)
+    pubsub_metrics.add_arguments(parser)
+    parser.add_argument("--log-format", choices=("text", "json"), default="text",
+                        help="plain text lines or one JSON object per line")
+    parser.add_argument("--log-level", choices=("debug", "info", "warning", "error"), default="info")
+    parser.add_argument("--stats-interval", type=float, default=0,
+                        help="log message rates every N seconds (0: never)")
+    return parser
+
+
+def parse_args(argv=None):
+    """CLI flags, with defaults taken from --config if given."""
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if args.config:
+        try:
+            with open(args.config) as f:
+                cfg = json.load(f)
+        except (OSError, ValueError) as e:
+            parser.error(f"cannot read config {args.config}: {e}")
+        if not isinstance(cfg, dict):
+            parser.error(f"config {args.config} must be a JSON object")
+        known = {a.dest for a in parser._actions}
+        cfg = {k.replace("-", "_"): v for k, v in cfg.items()}
+        unknown = sorted(set(cfg) - known - {"config"})
+        if unknown:
+            parser.error(f"unknown keys in {args.config}: {', '.join(unknown)}")
+        cfg.pop("config", None)
+        parser.set_defaults(**cfg)
+        args = parser.parse_args(argv)
+    for spec in args.bridge or ():
+        try:
+            pubsub_bridge.parse_spec(spec)
+        except ValueError as e:
+            parser.error(f"--bridge {spec!r}: {e}")
+    return args
+
+
+def run(args, worker=None):
+    """
+    Start the brokers and block until SIGTERM/SIGINT. Returns the exit status.
+    With --workers > 1 this process only supervises the workers; each of
+    them calls run() again with its pubsub_cluster.Worker.
+    """
+    stop = threading.Event()
+
+    def on_signal(signum, frame):
+        log.info("%s received, stopping", signal.Signals(signum).name,
+                 extra={"fields": {"event": "signal"}})
+        stop.set()
+
+    signal.signal(signal.SIGTERM, on_signal)
+    signal.signal(signal.SIGINT, on_signal)
+
+    if worker is None and args.workers > 1:
+        return pubsub_cluster.run_cluster(args, stop)
+
+    t0 = time.monotonic()
+    # in a cluster every worker sees every message: worker 0 logs them all
+    message_log = pubsub_log.from_args(args) if worker is None or worker.index == 0 else None
+    broker = make_broker(args.engine, shards=args.shards, host=args.host, port=args.port,
+                         ui_queue=log_event, message_log=message_log,
+                         reuse_port=worker is not None, broker_id=args.broker_id,
+                         metrics=pubsub_metrics.Metrics(args.metrics_prefix_depth),
+                         **pubsub_broker.broker_kwargs(args))
+    try:
+        if worker is not None:
+            worker.attach(broker)
+        broker.start()
+    except OSError as e:
+        log.error("cannot listen on %s:%s: %s", args.host, args.port, e,
+                  extra={"fields": {"event": "error"}})
+        if worker is not None:
+            worker.stop()
+            worker.failed()
+        if message_log is not None:
+            message_log.close()
+        return 1
+    ws_server = None
+    if not args.no_ws:
+        ws_server = WebSocketServer(host=args.host, port=args.ws_port, broker=broker, ui_queue=log_event,
+                                    reuse_port=worker is not None)
+        ws_server.start()
+    # like the message log, bridges live in worker 0 only: it sees every message
+    bridges = pubsub_bridge.from_args(args, broker) if worker is None or worker.index == 0 else []
+    for bridge in bridges:
+        bridge.start()
+    # $SYS topics and /metrics, per worker in a cluster
+    reporters = pubsub_metrics.from_args(args, broker, ws_server, bridges,
+                                         worker.index if worker is not None else None)
+    try:
+        for reporter in reporters:
+            reporter.start()
+    except OSError as e:
+        log.error("cannot serve metrics on port %s: %s", args.metrics_port, e,
+                  extra={"fields": {"event": "error"}})
+    if worker is not None:
+        worker.ready()
+    log.info("ready in %.3f s", time.monotonic() - t0,
+             extra={"fields": {"event": "ready", "tcp_port": args.port,
+                               "ws_port": None if args.no_ws else args.ws_port}})
+
+    rates = RateMeter()
+    rates.sample(broker.activity.counters())
+    while not stop.wait(args.stats_interval or None):
+        r = rates.sample(broker.activity.counters())
+        fields = {"event": "stats", "clients": len(broker.clients),
+                  **{k + "_per_s": round(v, 1) for k, v in r.items()}}
+        if ws_server is not None:
+            fields.update({"ws_" + k: v for k, v in ws_server.stats().items()})
+        if worker is not None:
+            fields.update({"bus_" + k: v for k, v in worker.stats().items()})
+        if bridges:
+            fields["bridges"] = [b.stats() for b in bridges]
+        log.info("in %.1f/s published %.1f/s delivered %.1f/s",
+                 r["messages_in"], r["published"], r["deliveries"], extra={"fields": fields})
+
+    for reporter in reporters:
+        reporter.stop()
+    for bridge in bridges:
+        bridge.stop()
+    if worker is not None:
+        worker.stop()
+    if ws_server is not None:
+        ws_server.stop()
+        # let the WS thread close its connections before the process exits
+        ws_server.thread.join(timeout=5)
+    broker.stop()
+    if message_log is not None:
+        message_log.close()
+    return 0
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    setup_logging(args.log_format, args.log_level)
+    sys.exit(run(args))
+
+
+if __name__ == "__main__":
+    main()
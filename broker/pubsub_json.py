@@ -0,0 +1,228 @@
+"""
+JSON codec used by the broker modules.
+
+Picks the fastest backend installed: orjson, then ujson, then the
+standard json module. PUBSUB_JSON=orjson|ujson|stdlib forces one (e.g.
+to compare them); if it is not installed the fastest installed one is
+used, with a warning.
+
+  dumps(obj)  -> str     (WebSocket text frames, logs)
+  dumpb(obj)  -> bytes   UTF-8, ready for a socket or a bin1 meta
+  dumpl(obj)  -> bytes   dumpb + b"\\n": a JSON line for TCP
+  loads(data) -> object  from str, bytes, bytearray or memoryview
+
+dumpb/dumpl skip the str -> bytes copy of json.dumps(obj).encode():
+orjson writes bytes directly (and the newline, OPT_APPEND_NEWLINE).
+
+Output is compact with orjson ({"a":1}) and spaced with the stdlib
+({"a": 1}); both parse the same. Whatever a faster backend rejects and
+the stdlib accepts (non-str keys, integers past 64 bits, NaN on input)
+is retried with the stdlib, so only the speed changes.
+
+  python3 -m pubsub_json            # micro-benchmark over typical payloads
+  python3 -m pubsub_json --number 2000
+"""
+
+import argparse
+import base64
+import json
+import logging
+import os
+import timeit
+
+log = logging.getLogger("pubsub")
+
+BACKENDS = ("orjson", "ujson", "stdlib")
+
+
+class Codec:
+    """dumps / dumpb / dumpl / loads of one backend."""
+    __slots__ = ("name", "dumps", "dumpb", "dumpl", "loads")
+
+    def __init__(self, name, dumps, dumpb, dumpl, loads):
+        self.name = name
+        self.dumps = dumps
+        self.dumpb = dumpb
+        self.dumpl = dumpl
+        self.loads = loads
+
+
+def _stdlib_loads(data):
+    if isinstance(data, memoryview):
+        data = bytes(data)
+    return json.loads(data)
+
+
+def _stdlib():
+    dumps = json.dumps
+
+    def dumpb(obj):
+        return dumps(obj).encode("utf-8")
+
+    def dumpl(obj):
+        return (dumps(obj) + "\n").encode("utf-8")
+
+    return Codec("stdlib", dumps, dumpb, dumpl, _stdlib_loads)
+
+
+def _orjson():
+    import orjson
+    fast_dumps = orjson.dumps
+    fast_loads = orjson.loads
+    newline = orjson.OPT_APPEND_NEWLINE
+
+    def dumpb(obj):
+        try:
+            return fast_dumps(obj)
+        except TypeError:
+            return json.dumps(obj).encode("utf-8")
+
+    def dumpl(obj):
+        try:
+            return fast_dumps(obj, option=newline)
+        except TypeError:
+            return (json.dumps(obj) + "\n").encode("utf-8")
+
+    def dumps(obj):
+        return dumpb(obj).decode("utf-8")
+
+    def loads(data):
+        try:
+            return fast_loads(data)
+        except ValueError:
+            # the stdlib is more lenient (NaN, big integers); it raises if the input is really bad
+            return _stdlib_loads(data)
+
+    return Codec("orjson", dumps, dumpb, dumpl, loads)
+
+
+def _ujson():
+    import ujson
+    fast_dumps = ujson.dumps
+    fast_loads = ujson.loads
+
+    def dumps(obj):
+        try:
+            return fast_dumps(obj, ensure_ascii=False, escape_forward_slashes=False)
+        except (TypeError, OverflowError):
+            return json.dumps(obj)
+
+    def dumpb(obj):
+        return dumps(obj).encode("utf-8")
+
+    def dumpl(obj):
+        return (dumps(obj) + "\n").encode("utf-8")
+
+    def loads(data):
+        if isinstance(data, (memoryview, bytearray)):
+            data = bytes(data)
+        try:
+            return fast_loads(data)
+        except (ValueError, OverflowError):
+            return _stdlib_loads(data)
+
+    return Codec("ujson", dumps, dumpb, dumpl, loads)
+
+
+_FACTORIES = {"orjson": _orjson, "ujson": _ujson, "stdlib": _stdlib}
+
+
+def codec(name):
+    """The Codec of a backend. Raises ImportError if it is not installed."""
+    if name not in _FACTORIES:
+        raise ValueError(f"Unknown JSON backend: {name} (choose from {', '.join(BACKENDS)})")
+    return _FACTORIES[name]()
+
+
+def available():
+    """Codecs of the installed backends, fastest first."""
+    codecs = []
+    for name in BACKENDS:
+        try:
+            codecs.append(codec(name))
+        except ImportError:
+            pass
+    return codecs
+
+
+def _select(forced):
+    if forced:
+        try:
+            return codec(forced)
+        except ValueError:
+            log.warning("PUBSUB_JSON=%s is not a JSON backend, using the fastest installed", forced)
+        except ImportError:
+            log.warning("PUBSUB_JSON=%s is not installed, using the fastest installed", forced)
+    return available()[0]
+
+
+_codec = _select(os.environ.get("PUBSUB_JSON", "").strip().lower())
+BACKEND = _codec.name
+dumps = _codec.dumps
+dumpb = _codec.dumpb
+dumpl = _codec.dumpl
+loads = _codec.loads
+
+
+# ---------------------------
+# Micro-benchmark
+# ---------------------------
+
+def sample_payloads():
+    """PUB packets as the robots, the Tk UI, the ArUco detector and the camera send them (topics.md)."""
+    state = {"v_dm/s": 0.2, "w_deg/s": 0.0, "alfa0_deg": 0, "alfa1_deg": 45, "alfa2_deg": 30,
+             "duration_s": 2.0}
+    sequence = {"action": "create", "name": "saludo", "time": "2025-09-25T20:00:00Z", "states": [
+        {"v_dm/s": v, "w_deg/s": w, "alfa0_deg": a0, "alfa1_deg": a1, "alfa2_deg": a2, "duration_s": d}
+        for v, w, a0, a1, a2, d in [(10, 0, 0, 0, 0, 1.0), (15.7, 90, 0, 0, 0, 1.0), (0, 0, -90, 0, 0, 1.0),
+                                    (0, 0, 90, 0, 0, 2.0), (0, 0, 0, 90, 0, 1.0), (0, 0, 0, 0, 90, 1.0)]]}
+    pose = {"robot_id": 3, "x": 1.2345678901, "y": 0.9876543210, "theta_rad": 0.7853981634,
+            "theta_deg": 45.0000000001}
+    frame = bytes(range(256)) * 150  # 160x120 RGB565: 38400 bytes
+    camera = {"w": 160, "h": 120, "format": "RGB565", "ts": 1727294400.123,
+              "frame_b64": base64.b64encode(frame).decode("ascii")}
+    prefix = "UDFJC/emb1/robot0/"
+    return {
+        "state": {"action": "PUB", "topic": prefix + "RPi/state", "data": state},
+        "sequence": {"action": "PUB", "topic": prefix + "RPi/sequence", "data": sequence},
+        "pose": {"action": "PUB", "topic": "robots/robot3/pose", "data": pose},
+        "camera": {"action": "PUB", "topic": prefix + "camera/frame", "data": camera},
+    }
+
+
+def benchmark(number=0, codecs=None):
+    """
+    Microseconds per dumpl (encode to a TCP line) and per loads (decode a
+    line) for every sample payload and installed backend. number=0 picks
+    a repeat count per payload (about 50 ms of stdlib work).
+    """
+    results = []
+    for name, pkt in sample_payloads().items():
+        line = json.dumps(pkt).encode("utf-8")
+        n = number or max(50, int(0.05 / max(timeit.timeit(lambda: json.loads(line), number=20) / 20, 1e-7)))
+        for c in codecs or available():
+            enc = min(timeit.repeat(lambda: c.dumpl(pkt), number=n, repeat=3)) / n
+            dec = min(timeit.repeat(lambda: c.loads(line), number=n, repeat=3)) / n
+            results.append({"payload": name, "bytes": len(line), "backend": c.name,
+                            "encode_us": round(enc * 1e6, 2), "decode_us": round(dec * 1e6, 2)})
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="JSON backend micro-benchmark")
+    parser.add_argument("--number", type=int, default=0, help="calls per measurement (0: automatic)")
+    args = parser.parse_args(argv)
+    results = benchmark(args.number)
+    base = {(r["payload"], "encode"): r["encode_us"] for r in results if r["backend"] == "stdlib"}
+    base.update({(r["payload"], "decode"): r["decode_us"] for r in results if r["backend"] == "stdlib"})
+    print(f"default backend: {BACKEND}")
+    print(f"{'payload':<9} {'bytes':>6} {'backend':<7} {'encode us':>10} {'decode us':>10}  vs stdlib")
+    for r in results:
+        speedup = "/".join(f"{base[(r['payload'], op)] / r[op + '_us']:.1f}x" if r[op + "_us"] else "-"
+                           for op in ("encode", "decode"))
+        print(f"{r['payload']:<9} {r['bytes']:>6} {r['backend']:<7} {r['encode_us']:>10} "
+              f"{r['decode_us']:>10}  {speedup}")
+
+
+if __name__ == "__main__":
+    main()
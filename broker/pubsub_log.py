@@ -0,0 +1,413 @@
+#!/usr/bin/env python3
+"""
+Durable, append-only log of published messages, with replay.
+
+Enabled with --log-dir: every Broker.publish() is appended, so a
+choreography run can be replayed or inspected after a restart.
+
+Layout: DIR/<first record number, 20 digits>.seg. Segments are
+preallocated to --log-segment-bytes and memory-mapped; appends are a
+copy into the map. A record is
+
+  length  u32  payload bytes
+  crc32   u32  of the payload
+  ts      f64  publish time (time.time())
+  payload      the message as a bin1 PUB frame (topic inline), i.e. the
+               EncodedMessage.binary form, shared with binary subscribers
+
+A zero length marks the end of the written part of a segment; after a
+crash the first record with a bad CRC does. A flusher thread msyncs the
+active segment every --log-fsync seconds and applies retention: whole
+closed segments are deleted, oldest first, while the log exceeds
+--log-retention-bytes or a segment is older than --log-retention-hours.
+
+CLI:
+
+  python3 -m pubsub_log info   DIR
+  python3 -m pubsub_log dump   DIR --from -10m --topic "robots/#"
+  python3 -m pubsub_log replay DIR --from 2026-10-18T10:00 --to 2026-10-18T10:05 \\
+                               --speed 2 --host 127.0.0.1 --port 5051
+
+replay re-publishes the records over TCP (bin1, so blobs stay raw) at
+the original pace divided by --speed (0: as fast as possible).
+"""
+
+import argparse
+import mmap
+import os
+import re
+import socket
+import struct
+import sys
+import threading
+import time
+import zlib
+from datetime import datetime
+
+from pubsub_json import dumps, loads
+from pubsub_topics import matches
+from pubsub_wire import unpack_frame
+
+REC = struct.Struct(">IId")
+SUFFIX = ".seg"
+
+
+class LogRecord:
+    """One logged message. The payload is decoded on first access."""
+    __slots__ = ("seq", "ts", "payload", "_frame")
+
+    def __init__(self, seq, ts, payload):
+        self.seq = seq
+        self.ts = ts
+        self.payload = payload  # bin1 PUB frame
+        self._frame = None
+
+    def _decoded(self):
+        if self._frame is None:
+            self._frame = unpack_frame(self.payload)
+        return self._frame
+
+    @property
+    def topic(self):
+        return self._decoded().topic
+
+    @property
+    def data(self):
+        meta = self._decoded().meta
+        return loads(meta) if meta else None
+
+    @property
+    def blob(self):
+        frame = self._decoded()
+        return frame.blob if frame.key else None
+
+    @property
+    def blob_key(self):
+        return self._decoded().key or None
+
+
+def _scan(buf, limit):
+    """Yield (offset, ts, length) for each valid record in buf[:limit]."""
+    pos = 0
+    with memoryview(buf) as view:
+        while pos + REC.size <= limit:
+            length, crc, ts = REC.unpack_from(buf, pos)
+            end = pos + REC.size + length
+            if length == 0 or end > limit:
+                return
+            with view[pos + REC.size:end] as payload:
+                if zlib.crc32(payload) != crc:
+                    return
+            yield pos, ts, length
+            pos = end
+
+
+class _Segment:
+    """The active, memory-mapped segment."""
+
+    def __init__(self, path, base, size):
+        self.path = path
+        self.base = base
+        self.file = open(path, "r+b" if os.path.exists(path) else "w+b")
+        if os.fstat(self.file.fileno()).st_size < size:
+            self.file.truncate(size)
+        self.mm = mmap.mmap(self.file.fileno(), 0)
+        self.lock = threading.Lock()  # flush() vs close(): never msync an unmapped segment
+        self.pos = 0
+        self.count = 0
+        for offset, ts, length in _scan(self.mm, len(self.mm)):
+            self.pos = offset + REC.size + length
+            self.count += 1
+        # leftovers of a record cut by a crash must not look like data
+        tail = len(self.mm) - self.pos
+        if tail and any(self.mm[self.pos:self.pos + min(tail, 4096)]):
+            self.mm[self.pos:] = bytes(tail)
+
+    def room(self):
+        # keep space for the zero length that ends the segment
+        return len(self.mm) - self.pos - REC.size
+
+    def flush(self):
+        """msync to disk; a no-op once closed."""
+        with self.lock:
+            if not self.mm.closed:
+                self.mm.flush()
+
+    def close(self):
+        """Flush, then shrink the file to the written part."""
+        with self.lock:
+            self.mm.flush()
+            self.mm.close()
+            self.file.truncate(self.pos)
+            self.file.close()
+
+
+class MessageLog:
+    """
+    Segmented append-only log, safe to append to from any thread.
+
+    append(frame) costs one CRC and one copy into the mmap under a lock;
+    durability comes from the flusher thread (every fsync_interval s)
+    and from close().
+    """
+
+    def __init__(self, directory, segment_bytes=64 * 1024 * 1024, fsync_interval=1.0,
+                 retention_bytes=1 << 30, retention_seconds=7 * 24 * 3600):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.fsync_interval = fsync_interval
+        self.retention_bytes = retention_bytes
+        self.retention_seconds = retention_seconds
+        self.appended = 0
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._dirty = False
+        self._closed = threading.Event()
+        bases = segment_bases(directory)
+        base = bases[-1] if bases else 0
+        self._active = _Segment(self._path(base), base, segment_bytes)
+        self._flusher = threading.Thread(target=self._flush_loop, daemon=True)
+        self._flusher.start()
+
+    def _path(self, base):
+        return os.path.join(self.directory, f"{base:020d}{SUFFIX}")
+
+    def append(self, frame, ts=None):
+        """Append an EncodedMessage. Returns its record number."""
+        payload = frame.binary
+        ts = time.time() if ts is None else ts
+        size = REC.size + len(payload)
+        crc = zlib.crc32(payload)
+        with self._lock:
+            seg = self._active
+            if seg.room() < size:
+                seg = self._roll(size)
+            REC.pack_into(seg.mm, seg.pos, len(payload), crc, ts)
+            seg.mm[seg.pos + REC.size:seg.pos + size] = payload
+            seg.pos += size
+            seg.count += 1
+            self._dirty = True
+            self.appended += 1
+            return seg.base + seg.count - 1
+
+    def _roll(self, need):
+        old = self._active
+        old.close()
+        base = old.base + old.count
+        self._active = _Segment(self._path(base), base, max(self.segment_bytes, need + 2 * REC.size))
+        return self._active
+
+    def _flush_loop(self):
+        while not self._closed.wait(self.fsync_interval):
+            self.flush()
+            self.apply_retention()
+
+    def flush(self):
+        with self._lock:
+            if not self._dirty or self._closed.is_set():
+                return
+            seg = self._active
+            self._dirty = False
+        # the msync runs without self._lock: append() (and so Broker.publish)
+        # never waits for the disk; a _roll meanwhile closes seg, which flushes it
+        seg.flush()
+
+    def apply_retention(self, now=None):
+        """Delete closed segments beyond retention_bytes / retention_seconds."""
+        now = time.time() if now is None else now
+        with self._lock:
+            active = self._active.path
+        paths = [self._path(b) for b in segment_bases(self.directory)]
+        closed = [p for p in paths if p != active]
+        sizes = {p: os.path.getsize(p) for p in paths if os.path.exists(p)}
+        total = sum(sizes.values())
+        for path in closed:
+            too_big = self.retention_bytes and total > self.retention_bytes
+            too_old = self.retention_seconds and os.path.getmtime(path) < now - self.retention_seconds
+            if not (too_big or too_old):
+                break
+            os.remove(path)
+            total -= sizes.get(path, 0)
+
+    def read(self, start=None, end=None, topic=None):
+        """Records of this log, see read_log()."""
+        self.flush()
+        return read_log(self.directory, start, end, topic)
+
+    def close(self):
+        if self._closed.is_set():
+            return
+        self._closed.set()
+        self._flusher.join(timeout=5)
+        with self._lock:
+            self._active.close()
+
+
+def segment_bases(directory):
+    """Record numbers of the segments in directory, oldest first."""
+    bases = []
+    for name in os.listdir(directory):
+        if name.endswith(SUFFIX) and name[:-len(SUFFIX)].isdigit():
+            bases.append(int(name[:-len(SUFFIX)]))
+    return sorted(bases)
+
+
+def read_log(directory, start=None, end=None, topic=None):
+    """
+    Yield LogRecord in publish order with start <= ts <= end (epoch
+    seconds, None: unbounded) and topic matching the pattern `topic`.
+    Safe while a MessageLog appends to the same directory.
+    """
+    bases = segment_bases(directory)
+    for base in bases:
+        path = os.path.join(directory, f"{base:020d}{SUFFIX}")
+        try:
+            # closed segments: mtime is the last write (the active one may lag)
+            if start is not None and base != bases[-1] and os.path.getmtime(path) < start:
+                continue
+            with open(path, "rb") as f:
+                if not os.fstat(f.fileno()).st_size:
+                    continue
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    for i, (offset, ts, length) in enumerate(_scan(mm, len(mm))):
+                        if start is not None and ts < start:
+                            continue
+                        if end is not None and ts > end:
+                            return
+                        record = LogRecord(base + i, ts, mm[offset + REC.size:offset + REC.size + length])
+                        if topic is not None and not matches(topic, record.topic):
+                            continue
+                        yield record
+        except FileNotFoundError:
+            continue  # removed by retention meanwhile
+
+
+def replay(records, publish, speed=1.0, sleep=time.sleep):
+    """
+    Call publish(record) for each record, spaced like the original
+    timestamps divided by speed (speed 0: no waiting). Returns the count.
+    """
+    n = 0
+    t0 = ts0 = None
+    for record in records:
+        if speed and ts0 is not None:
+            delay = t0 + (record.ts - ts0) / speed - time.monotonic()
+            if delay > 0:
+                sleep(delay)
+        elif ts0 is None:
+            t0, ts0 = time.monotonic(), record.ts
+        publish(record)
+        n += 1
+    return n
+
+
+def broker_publisher(broker):
+    """publish callback for replay() into a Broker in the same process."""
+    return lambda r: broker.publish(r.topic, r.data, blob=r.blob, blob_key=r.blob_key)
+
+
+def add_arguments(parser):
+    """The --log-* broker options (shared by the Tk and headless entry points)."""
+    parser.add_argument("--log-dir", help="append every published message to a log in this directory")
+    parser.add_argument("--log-segment-bytes", type=int, default=64 * 1024 * 1024,
+                        help="size of each log segment file")
+    parser.add_argument("--log-fsync", type=float, default=1.0,
+                        help="seconds between flushes of the log to disk")
+    parser.add_argument("--log-retention-bytes", type=int, default=1 << 30,
+                        help="delete the oldest segments above this total size (0: no limit)")
+    parser.add_argument("--log-retention-hours", type=float, default=7 * 24,
+                        help="delete segments older than this (0: keep forever)")
+
+
+def from_args(args):
+    """MessageLog for the parsed --log-* options, or None without --log-dir."""
+    if not args.log_dir:
+        return None
+    return MessageLog(args.log_dir, segment_bytes=args.log_segment_bytes, fsync_interval=args.log_fsync,
+                      retention_bytes=args.log_retention_bytes,
+                      retention_seconds=args.log_retention_hours * 3600)
+
+
+# ---------------------------
+# CLI
+# ---------------------------
+
+_RELATIVE = re.compile(r"^-(\d+(?:\.\d+)?)([smhd])$")
+
+
+def parse_time(text):
+    """Epoch seconds from '1729250000', '2026-10-18T10:00[:00]' or '-10m' (s/m/h/d ago)."""
+    if text is None:
+        return None
+    m = _RELATIVE.match(text)
+    if m:
+        return time.time() - float(m.group(1)) * {"s": 1, "m": 60, "h": 3600, "d": 86400}[m.group(2)]
+    try:
+        return float(text)
+    except ValueError:
+        return datetime.fromisoformat(text).timestamp()
+
+
+def _fmt_ts(ts):
+    return datetime.fromtimestamp(ts).isoformat(timespec="milliseconds")
+
+
+def cmd_info(args):
+    bases = segment_bases(args.dir)
+    count, first, last, size = 0, None, None, 0
+    for record in read_log(args.dir):
+        count += 1
+        first = record.ts if first is None else first
+        last = record.ts
+    for base in bases:
+        size += os.path.getsize(os.path.join(args.dir, f"{base:020d}{SUFFIX}"))
+    print(f"segments {len(bases)}  records {count}  bytes on disk {size}")
+    if count:
+        print(f"from {_fmt_ts(first)}  to {_fmt_ts(last)}")
+
+
+def cmd_dump(args):
+    for record in read_log(args.dir, parse_time(args.start), parse_time(args.end), args.topic):
+        entry = {"seq": record.seq, "ts": record.ts, "topic": record.topic, "data": record.data}
+        if record.blob is not None:
+            entry["blob_key"], entry["blob_len"] = record.blob_key, len(record.blob)
+        print(dumps(entry))
+
+
+def cmd_replay(args):
+    start = parse_time(args.start)
+    # records published while replaying (possibly into this same log) are not replayed again
+    end = parse_time(args.end) if args.end else time.time()
+    sock = socket.create_connection((args.host, args.port))
+    sock.sendall(b'{"action": "HELLO", "proto": "bin1"}\n')
+    try:
+        n = replay(read_log(args.dir, start, end, args.topic),
+                   lambda r: sock.sendall(r.payload), speed=args.speed)
+    finally:
+        sock.close()
+    print(f"replayed {n} messages", file=sys.stderr)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Inspect or replay a broker message log")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    for name, fn in (("info", cmd_info), ("dump", cmd_dump), ("replay", cmd_replay)):
+        p = sub.add_parser(name)
+        p.add_argument("dir", help="the broker's --log-dir")
+        p.set_defaults(fn=fn)
+        if name == "info":
+            continue
+        p.add_argument("--from", dest="start", help="epoch, ISO time or -10m/-2h (default: beginning)")
+        p.add_argument("--to", dest="end", help="epoch, ISO time or -10m/-2h (default: now)")
+        p.add_argument("--topic", help="only topics matching this pattern (+ and # allowed)")
+        if name == "replay":
+            p.add_argument("--host", default="127.0.0.1")
+            p.add_argument("--port", type=int, default=5051)
+            p.add_argument("--speed", type=float, default=1.0,
+                           help="1: original pace, 2: twice as fast, 0: no waiting")
+    args = parser.parse_args(argv)
+    args.fn(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,446 @@
+"""
+Broker metrics: counters and histograms, published on $SYS topics and
+served in the Prometheus text format.
+
+Recording costs one lock and a few integer updates per publish (or per
+recv), never any formatting:
+
+- messages and bytes received per transport (tcp, ws);
+- per topic prefix (the first prefix_depth levels; past max_prefixes
+  distinct prefixes the rest count as "other"): messages published,
+  deliveries and bytes delivered;
+- histograms of the fan-out (deliveries per publish) and of the publish
+  latency (match, encode and queue; not the network);
+- messages dropped, sent and socket write calls of the queues of
+  clients that already left (sent / writes = messages per syscall).
+
+Everything else (clients per transport, queue depth per client, drops
+of live queues, retained topics) is read from the brokers when a
+snapshot is taken by collect().
+
+SysPublisher publishes a snapshot every --sys-interval seconds as
+retained JSON messages, so a dashboard gets them as soon as it
+subscribes to "$SYS/#":
+
+  $SYS/broker/<id>/clients       {"tcp": 12, "ws": 3, "bridges": 1}
+  $SYS/broker/<id>/messages      totals and rates in / published / delivered,
+                                 messages_per_write
+  $SYS/broker/<id>/topics        the hottest prefixes, with rates
+  $SYS/broker/<id>/latency       publish latency and fan-out percentiles
+  $SYS/broker/<id>/slow_clients  the deepest outbound queues
+
+In a --workers cluster each worker publishes under $SYS/broker/<id>/w<N>
+and serves /metrics on --metrics-port + N.
+
+MetricsServer answers GET /metrics on --metrics-port with the snapshot
+in the Prometheus text exposition format.
+"""
+
+import threading
+import time
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from pubsub_topics import SEP
+
+TCP = "tcp"
+WS = "ws"
+OTHER = "other"
+
+# upper bounds, seconds
+LATENCY_BOUNDS = (1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4, 1e-3, 2.5e-3, 5e-3,
+                  0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+FANOUT_BOUNDS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+
+class Histogram:
+    """Observations counted per bucket (cumulative upper bounds, as in Prometheus). Not thread-safe."""
+
+    def __init__(self, bounds):
+        self.bounds = tuple(bounds)
+        self.buckets = [0] * (len(self.bounds) + 1)  # the last one: above every bound
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.buckets[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def copy(self):
+        h = Histogram(self.bounds)
+        h.buckets = list(self.buckets)
+        h.count = self.count
+        h.sum = self.sum
+        return h
+
+    def since(self, earlier):
+        """Observations made after the copy `earlier` was taken."""
+        h = self.copy()
+        if earlier is not None:
+            h.buckets = [a - b for a, b in zip(self.buckets, earlier.buckets)]
+            h.count -= earlier.count
+            h.sum -= earlier.sum
+        return h
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q quantile (None if empty)."""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if seen >= rank:
+                break
+        return self.bounds[i] if i < len(self.bounds) else float("inf")
+
+
+class Metrics:
+    """Counters and histograms recorded by the brokers. Thread-safe."""
+    PREFIX_DEPTH = 2
+    MAX_PREFIXES = 256
+
+    def __init__(self, prefix_depth=PREFIX_DEPTH, max_prefixes=MAX_PREFIXES):
+        self.prefix_depth = max(1, int(prefix_depth))
+        self.max_prefixes = max_prefixes
+        self._lock = threading.Lock()
+        self._in = {}        # transport -> [messages, bytes]
+        self._prefixes = {}  # prefix -> [messages, deliveries, bytes delivered]
+        self._fanout = Histogram(FANOUT_BOUNDS)
+        self._latency = Histogram(LATENCY_BOUNDS)
+        self._dropped_gone = 0
+        self._sent_gone = 0
+        self._writes_gone = 0
+
+    def prefix(self, topic):
+        return SEP.join(topic.split(SEP, self.prefix_depth)[:self.prefix_depth])
+
+    def received(self, transport, messages, nbytes):
+        """messages / nbytes read from clients of a transport."""
+        with self._lock:
+            entry = self._in.get(transport)
+            if entry is None:
+                entry = self._in[transport] = [0, 0]
+            entry[0] += messages
+            entry[1] += nbytes
+
+    def published(self, topic, deliveries, size, seconds):
+        """A publish of size bytes (as encoded) routed to `deliveries` subscribers in `seconds`."""
+        prefix = self.prefix(topic)
+        with self._lock:
+            entry = self._prefixes.get(prefix)
+            if entry is None:
+                if len(self._prefixes) >= self.max_prefixes:
+                    prefix = OTHER
+                entry = self._prefixes.setdefault(prefix, [0, 0, 0])
+            entry[0] += 1
+            entry[1] += deliveries
+            entry[2] += deliveries * size
+            self._fanout.observe(deliveries)
+            self._latency.observe(seconds)
+
+    def client_gone(self, queue):
+        """Keep the drop, sent and write counts of a client's outbound queue after it disconnects."""
+        with self._lock:
+            self._dropped_gone += queue.dropped
+            self._sent_gone += queue.sent_messages
+            self._writes_gone += queue.writes
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "in": {t: {"messages": m, "bytes": b} for t, (m, b) in self._in.items()},
+                "prefixes": {p: {"messages": m, "deliveries": d, "bytes": b}
+                             for p, (m, d, b) in self._prefixes.items()},
+                "fanout": self._fanout.copy(),
+                "latency": self._latency.copy(),
+                "dropped_gone": self._dropped_gone,
+                "sent_gone": self._sent_gone,
+                "writes_gone": self._writes_gone,
+            }
+
+
+def collect(broker, ws_server=None, bridges=(), top=10):
+    """
+    Snapshot of broker.metrics plus the live state of the brokers: clients
+    per transport, queued and dropped messages, and the `top` clients with
+    the most bytes queued.
+    """
+    snap = broker.metrics.snapshot()
+    queues = [(TCP, addr, q) for addr, q in broker.client_stats().items()]
+    if ws_server is not None and ws_server.running:
+        queues += [(WS, addr, q) for addr, q in ws_server.client_stats().items()]
+    snap["ts"] = time.time()
+    snap["activity"] = broker.activity.counters()
+    snap["clients"] = {
+        TCP: sum(1 for t, _, _ in queues if t == TCP),
+        WS: sum(1 for t, _, _ in queues if t == WS),
+        "bridges": sum(1 for b in bridges if b.connected),
+    }
+    snap["queued_messages"] = sum(q["queued_messages"] for _, _, q in queues)
+    snap["queued_bytes"] = sum(q["queued_bytes"] for _, _, q in queues)
+    snap["dropped"] = snap.pop("dropped_gone") + sum(q["dropped"] for _, _, q in queues)
+    # messages per write call (syscall) = sent / writes, see pubsub_outbound
+    snap["sent"] = snap.pop("sent_gone") + sum(q["sent_messages"] for _, _, q in queues)
+    snap["writes"] = snap.pop("writes_gone") + sum(q["writes"] for _, _, q in queues)
+    deepest = sorted(queues, key=lambda e: e[2]["queued_bytes"], reverse=True)[:top]
+    snap["slow_clients"] = [
+        {"transport": t, "client": _addr(addr), "queued_messages": q["queued_messages"],
+         "queued_bytes": q["queued_bytes"], "dropped": q["dropped"]}
+        for t, addr, q in deepest if q["queued_messages"]
+    ]
+    snap["retained_topics"] = broker.retained.stats()["topics"]
+    snap["loops_dropped"] = broker.loops_dropped
+    snap["serializations_avoided"] = broker.serializations_avoided
+    return snap
+
+
+def _addr(addr):
+    return f"{addr[0]}:{addr[1]}" if isinstance(addr, tuple) and len(addr) >= 2 else str(addr)
+
+
+def _finite(value):
+    """value for a JSON document: an open-ended bucket (inf) becomes None."""
+    return None if value is None or value == float("inf") else value
+
+
+def _ms(seconds):
+    seconds = _finite(seconds)
+    return None if seconds is None else round(seconds * 1000, 3)
+
+
+# ---------------------------
+# $SYS topics
+# ---------------------------
+
+class SysPublisher:
+    """Publishes collect() snapshots on $SYS topics every `interval` seconds, from its own thread."""
+    HOT_TOPICS = 20
+
+    def __init__(self, broker, ws_server=None, bridges=(), interval=10.0, topic=None):
+        self.broker = broker
+        self.ws_server = ws_server
+        self.bridges = bridges
+        self.interval = interval
+        self.topic = topic or f"$SYS/broker/{broker.broker_id}"
+        self._prev = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.publish_once()
+            except Exception as e:
+                self.broker.ui_queue(("error", f"$SYS publish failed: {e}"))
+
+    def publish_once(self):
+        snap = collect(self.broker, self.ws_server, self.bridges)
+        prev = self._prev
+        self._prev = snap
+        dt = snap["ts"] - prev["ts"] if prev is not None else 0
+
+        def rate(now, before):
+            return round((now - before) / dt, 1) if dt > 0 else None
+
+        activity = snap["activity"]
+        before = prev["activity"] if prev is not None else {}
+        messages = dict(activity)
+        messages.update({k + "_per_s": rate(v, before.get(k, 0)) for k, v in activity.items()})
+        messages["bytes_in"] = {t: e["bytes"] for t, e in snap["in"].items()}
+        messages.update(queued_messages=snap["queued_messages"], queued_bytes=snap["queued_bytes"],
+                        dropped=snap["dropped"], loops_dropped=snap["loops_dropped"],
+                        retained_topics=snap["retained_topics"], sent=snap["sent"], writes=snap["writes"],
+                        serializations_avoided=snap["serializations_avoided"])
+        writes = snap["writes"] - (prev["writes"] if prev is not None else 0)
+        sent = snap["sent"] - (prev["sent"] if prev is not None else 0)
+        messages["messages_per_write"] = round(sent / writes, 2) if writes > 0 else None
+
+        old = prev["prefixes"] if prev is not None else {}
+        topics = []
+        for prefix, e in snap["prefixes"].items():
+            o = old.get(prefix, {"messages": 0, "deliveries": 0, "bytes": 0})
+            topics.append({"prefix": prefix, "messages": e["messages"], "bytes": e["bytes"],
+                           "messages_per_s": rate(e["messages"], o["messages"]),
+                           "deliveries_per_s": rate(e["deliveries"], o["deliveries"]),
+                           "bytes_per_s": rate(e["bytes"], o["bytes"])})
+        topics.sort(key=lambda t: (t["messages_per_s"] or 0, t["messages"]), reverse=True)
+
+        latency = snap["latency"].since(prev["latency"] if prev is not None else None)
+        fanout = snap["fanout"].since(prev["fanout"] if prev is not None else None)
+        stats = {
+            "publishes": latency.count,
+            "latency_ms": {"p50": _ms(latency.quantile(0.5)), "p99": _ms(latency.quantile(0.99)),
+                           "mean": _ms(latency.sum / latency.count) if latency.count else None},
+            "fanout": {"p50": _finite(fanout.quantile(0.5)), "p99": _finite(fanout.quantile(0.99)),
+                       "mean": round(fanout.sum / fanout.count, 2) if fanout.count else None},
+        }
+
+        publish = self.broker.publish
+        publish(self.topic + "/clients", snap["clients"], retain=True)
+        publish(self.topic + "/messages", messages, retain=True)
+        publish(self.topic + "/topics", topics[:self.HOT_TOPICS], retain=True)
+        publish(self.topic + "/latency", stats, retain=True)
+        publish(self.topic + "/slow_clients", snap["slow_clients"], retain=True)
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=2.0)
+
+
+# ---------------------------
+# Prometheus endpoint
+# ---------------------------
+
+def _label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _histogram(lines, name, help_text, h):
+    lines.append(f"# HELP {name} {help_text}")
+    lines.append(f"# TYPE {name} histogram")
+    cumulative = 0
+    for bound, n in zip(h.bounds + (float("inf"),), h.buckets):
+        cumulative += n
+        le = "+Inf" if bound == float("inf") else repr(bound)
+        lines.append(f'{name}_bucket{{le="{le}"}} {cumulative}')
+    lines.append(f"{name}_sum {h.sum!r}")
+    lines.append(f"{name}_count {h.count}")
+
+
+def render_prometheus(snap):
+    """collect() snapshot in the Prometheus text exposition format (version 0.0.4)."""
+    lines = []
+
+    def metric(name, kind, help_text, samples):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for labels, value in samples:
+            if labels:
+                text = ",".join(f'{k}="{_label(v)}"' for k, v in labels.items())
+                lines.append(f"{name}{{{text}}} {value}")
+            else:
+                lines.append(f"{name} {value}")
+
+    activity = snap["activity"]
+    metric("pubsub_received_messages_total", "counter", "Messages read from clients.",
+           [({"transport": t}, e["messages"]) for t, e in sorted(snap["in"].items())])
+    metric("pubsub_received_bytes_total", "counter", "Bytes read from clients.",
+           [({"transport": t}, e["bytes"]) for t, e in sorted(snap["in"].items())])
+    metric("pubsub_published_total", "counter", "Messages routed.", [({}, activity["published"])])
+    metric("pubsub_deliveries_total", "counter", "Messages queued for subscribers.",
+           [({}, activity["deliveries"])])
+    prefixes = sorted(snap["prefixes"].items())
+    metric("pubsub_topic_messages_total", "counter", "Messages published per topic prefix.",
+           [({"prefix": p}, e["messages"]) for p, e in prefixes])
+    metric("pubsub_topic_deliveries_total", "counter", "Deliveries per topic prefix.",
+           [({"prefix": p}, e["deliveries"]) for p, e in prefixes])
+    metric("pubsub_topic_bytes_total", "counter", "Bytes delivered per topic prefix.",
+           [({"prefix": p}, e["bytes"]) for p, e in prefixes])
+    metric("pubsub_clients", "gauge", "Connected clients.",
+           [({"transport": t}, n) for t, n in sorted(snap["clients"].items())])
+    metric("pubsub_queued_messages", "gauge", "Messages waiting in outbound queues.",
+           [({}, snap["queued_messages"])])
+    metric("pubsub_queued_bytes", "gauge", "Bytes waiting in outbound queues.",
+           [({}, snap["queued_bytes"])])
+    metric("pubsub_dropped_total", "counter", "Messages dropped by full outbound queues.",
+           [({}, snap["dropped"])])
+    metric("pubsub_serializations_avoided_total", "counter",
+           "Deliveries that reused an already encoded message instead of serializing it again.",
+           [({}, snap["serializations_avoided"])])
+    metric("pubsub_sent_messages_total", "counter", "Messages written to subscriber sockets.",
+           [({}, snap["sent"])])
+    metric("pubsub_socket_writes_total", "counter", "Write calls on subscriber sockets (several messages each when coalesced).",
+           [({}, snap["writes"])])
+    metric("pubsub_client_queued_bytes", "gauge", "Bytes queued for the slowest clients.",
+           [({"transport": c["transport"], "client": c["client"]}, c["queued_bytes"])
+            for c in snap["slow_clients"]])
+    metric("pubsub_retained_topics", "gauge", "Topics with a retained message.",
+           [({}, snap["retained_topics"])])
+    metric("pubsub_loops_dropped_total", "counter", "Bridged messages dropped as loops.",
+           [({}, snap["loops_dropped"])])
+    _histogram(lines, "pubsub_fanout", "Deliveries per publish.", snap["fanout"])
+    _histogram(lines, "pubsub_publish_latency_seconds", "Time to route and queue a publish.",
+               snap["latency"])
+    return "\n".join(lines) + "\n"
+
+
+class MetricsServer:
+    """GET /metrics over HTTP, rendered from collect() on each scrape."""
+
+    def __init__(self, broker, ws_server=None, bridges=(), host="0.0.0.0", port=9105):
+        self.broker = broker
+        self.ws_server = ws_server
+        self.bridges = bridges
+        self.host = host
+        self.port = port
+        self._httpd = None
+
+    def start(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = render_prometheus(collect(server.broker, server.ws_server, server.bridges))
+                body = body.encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, fmt, *args):
+                pass
+
+        self._httpd = ThreadingHTTPServer((self.host, self.port), Handler)
+        self._httpd.daemon_threads = True
+        threading.Thread(target=self._httpd.serve_forever, daemon=True).start()
+        self.broker.ui_queue(("info", f"Metrics on http://{self.host}:{self.port}/metrics"))
+
+    def stop(self):
+        if self._httpd is not None:
+            self._httpd.shutdown()
+            self._httpd.server_close()
+            self._httpd = None
+
+
+# ---------------------------
+# CLI
+# ---------------------------
+
+def add_arguments(parser):
+    """The metrics options (shared by the Tk and headless entry points)."""
+    parser.add_argument("--sys-interval", type=float, default=10.0,
+                        help="publish broker statistics on $SYS/broker/<id>/... every N seconds (0: never)")
+    parser.add_argument("--metrics-port", type=int, default=0,
+                        help="serve Prometheus metrics on http://host:PORT/metrics (0: off)")
+    parser.add_argument("--metrics-prefix-depth", type=int, default=Metrics.PREFIX_DEPTH,
+                        help="topic levels that make up a prefix in the per-topic counters")
+
+
+def make_reporters(broker, ws_server=None, bridges=(), sys_interval=10.0, metrics_port=0,
+                   host="0.0.0.0", topic=None):
+    """SysPublisher and MetricsServer for the options given, not started."""
+    reporters = []
+    if sys_interval > 0:
+        reporters.append(SysPublisher(broker, ws_server, bridges, sys_interval, topic))
+    if metrics_port:
+        reporters.append(MetricsServer(broker, ws_server, bridges, host, metrics_port))
+    return reporters
+
+
+def from_args(args, broker, ws_server=None, bridges=(), worker=None):
+    """Reporters for the parsed options; cluster worker N uses its own topic and port."""
+    topic = f"$SYS/broker/{broker.broker_id}" + (f"/w{worker}" if worker is not None else "")
+    port = args.metrics_port + worker if args.metrics_port and worker is not None else args.metrics_port
+    return make_reporters(broker, ws_server, bridges, args.sys_interval, port, args.host, topic)
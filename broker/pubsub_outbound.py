@@ -0,0 +1,275 @@
+"""
+Per-subscriber outbound queues.
+
+Publishers never write to a subscriber socket directly: they put the
+encoded frame in the subscriber's OutboundQueue and the transport drains
+it at the pace the subscriber can take. When a queue is full the
+overflow policy decides what happens:
+
+  drop-oldest   discard the oldest queued message
+  drop-newest   discard the message being queued
+  coalesce      replace the queued message of the same topic, if any,
+                otherwise drop the oldest
+  disconnect    raise SlowConsumer so the broker closes the client
+                (default: nothing is lost silently)
+
+Independently of the policy, a message put with conflate=True replaces
+the not yet drained message of the same topic in place (latest value
+wins), so high-rate state topics never queue behind themselves.
+
+Write coalescing: get_batch() hands the transport every queued message
+(up to a count and a byte budget), optionally lingering a few
+microseconds for more, and sendmsg_all() writes them with one sendmsg
+(writev) call instead of one send per message. The queue counts the
+write calls (`writes`), so sent_messages / writes is the number of
+messages per syscall.
+"""
+
+import logging
+import socket
+import threading
+import time
+from collections import deque
+
+log = logging.getLogger("pubsub")
+
+DROP_OLDEST = "drop-oldest"
+DROP_NEWEST = "drop-newest"
+COALESCE = "coalesce"
+DISCONNECT = "disconnect"
+POLICIES = (DROP_OLDEST, DROP_NEWEST, COALESCE, DISCONNECT)
+
+# per-subscriber defaults: large enough to absorb bursts, and a client that
+# still falls behind is disconnected rather than silently losing messages
+# (dropping is opt-in with one of the other policies)
+QUEUE_MESSAGES = 16384
+QUEUE_BYTES = 32 * 1024 * 1024
+OVERFLOW = DISCONNECT
+
+# write coalescing defaults (see get_batch / sendmsg_all)
+WRITE_BATCH = 64                 # messages per write call
+WRITE_BATCH_BYTES = 256 * 1024   # bytes per write call (a bigger single message still goes alone)
+IOV_MAX = 1024                   # buffers per sendmsg on Linux
+
+
+class SlowConsumer(Exception):
+    """Queue full with the 'disconnect' policy."""
+
+
+class OutboundQueue:
+    """
+    Bounded FIFO of encoded frames (bytes or str) for one subscriber.
+
+    Limits are both a message count and a byte budget. Thread-safe: any
+    thread may put(), the transport calls get()/get_nowait(). The first
+    message a queue drops is logged as a warning (name identifies the
+    subscriber); `dropped` counts them all.
+    """
+
+    def __init__(self, max_messages=QUEUE_MESSAGES, max_bytes=QUEUE_BYTES, policy=OVERFLOW, name=None):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown overflow policy: {policy}")
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.name = name
+        self._items = deque()   # entries: [topic, payload]
+        self._by_topic = {}     # topic -> queued entry (for coalescing)
+        self._bytes = 0
+        self._cond = threading.Condition()
+        self.closed = False
+        # counters
+        self.enqueued = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.sent_messages = 0
+        self.sent_bytes = 0
+        self.writes = 0
+
+    def __len__(self):
+        return len(self._items)
+
+    @property
+    def queued_bytes(self):
+        return self._bytes
+
+    def _full(self, extra):
+        return (len(self._items) >= self.max_messages
+                or (self._items and self._bytes + extra > self.max_bytes))
+
+    def _popleft(self):
+        entry = self._items.popleft()
+        topic, payload = entry
+        if topic is not None and self._by_topic.get(topic) is entry:
+            del self._by_topic[topic]
+        self._bytes -= len(payload)
+        return payload
+
+    def _drop(self):
+        self.dropped += 1
+        if self.dropped == 1:
+            log.warning("Outbound queue %s full (%d messages, %d bytes): %s is dropping messages",
+                        self.name or hex(id(self)), len(self._items), self._bytes, self.policy)
+
+    def _replace(self, entry, payload):
+        self._bytes += len(payload) - len(entry[1])
+        entry[1] = payload
+        self.coalesced += 1
+
+    def put(self, payload, topic=None, conflate=False):
+        """
+        Queue payload. Returns False if a message was dropped to make room
+        (or payload itself was dropped). Raises SlowConsumer with the
+        'disconnect' policy.
+        """
+        size = len(payload)
+        with self._cond:
+            if self.closed:
+                return False
+            if conflate and topic is not None:
+                entry = self._by_topic.get(topic)
+                if entry is not None:
+                    self._replace(entry, payload)
+                    self._cond.notify()
+                    return True
+            ok = True
+            if self._full(size):
+                policy = self.policy
+                if policy == DISCONNECT:
+                    raise SlowConsumer(f"{len(self._items)} messages / {self._bytes} bytes queued")
+                if policy == DROP_NEWEST:
+                    self._drop()
+                    return False
+                if policy == COALESCE and topic is not None:
+                    entry = self._by_topic.get(topic)
+                    if entry is not None:
+                        self._replace(entry, payload)
+                        self._drop()
+                        self._cond.notify()
+                        return False
+                while self._items and self._full(size):
+                    self._popleft()
+                    self._drop()
+                ok = False
+            entry = [topic, payload]
+            self._items.append(entry)
+            if topic is not None:
+                self._by_topic[topic] = entry
+            self._bytes += size
+            self.enqueued += 1
+            self._cond.notify()
+            return ok
+
+    def get_nowait(self):
+        """Next payload, or None if the queue is empty."""
+        with self._cond:
+            if not self._items:
+                return None
+            return self._popleft()
+
+    def get(self, timeout=None):
+        """Block until a payload is available. Returns None on timeout or close."""
+        with self._cond:
+            if not self._items and not self.closed:
+                self._cond.wait(timeout)
+            if not self._items:
+                return None
+            return self._popleft()
+
+    def wait(self, timeout=None):
+        """Block until a payload is queued, without taking it. False on timeout or close."""
+        with self._cond:
+            if not self._items and not self.closed:
+                self._cond.wait(timeout)
+            return bool(self._items)
+
+    def get_batch(self, max_messages=WRITE_BATCH, max_bytes=WRITE_BATCH_BYTES, timeout=None, linger=0.0):
+        """
+        Block like get() for the first payload, then take the ones already
+        queued behind it, up to max_messages / max_bytes. With linger > 0
+        (seconds) a short batch waits that long for more. Returns a list,
+        empty on timeout or close.
+        """
+        with self._cond:
+            if not self._items and not self.closed:
+                self._cond.wait(timeout)
+            if not self._items:
+                return []
+            batch = [self._popleft()]
+            size = len(batch[0])
+            deadline = None
+            while len(batch) < max_messages:
+                if not self._items:
+                    if linger <= 0 or self.closed:
+                        break
+                    now = time.monotonic()
+                    if deadline is None:
+                        deadline = now + linger
+                    if now >= deadline:
+                        break
+                    self._cond.wait(deadline - now)
+                    continue
+                if size + len(self._items[0][1]) > max_bytes:
+                    break
+                payload = self._popleft()
+                batch.append(payload)
+                size += len(payload)
+            return batch
+
+    def record_sent(self, nbytes, messages=1, writes=1):
+        self.sent_messages += messages
+        self.sent_bytes += nbytes
+        self.writes += writes
+
+    def close(self):
+        """Discard queued messages and wake up any waiting get()."""
+        with self._cond:
+            self.closed = True
+            self._items.clear()
+            self._by_topic.clear()
+            self._bytes = 0
+            self._cond.notify_all()
+
+    def stats(self):
+        return {
+            "queued_messages": len(self._items),
+            "queued_bytes": self._bytes,
+            "enqueued": self.enqueued,
+            "dropped": self.dropped,
+            "coalesced": self.coalesced,
+            "sent_messages": self.sent_messages,
+            "sent_bytes": self.sent_bytes,
+            "writes": self.writes,
+            "policy": self.policy,
+        }
+
+
+def sendmsg_all(sock, buffers, running=None):
+    """
+    Write every buffer to sock, gathered in as few sendmsg calls as the
+    kernel allows; partial writes resume where they stopped. A socket
+    timeout retries while running() is true. Returns the number of write
+    calls. Platforms without sendmsg (Windows) get one sendall of the
+    joined buffers.
+    """
+    if not hasattr(sock, "sendmsg"):
+        sock.sendall(b"".join(buffers))
+        return 1
+    views = [memoryview(b) for b in buffers]
+    writes = 0
+    while views:
+        try:
+            n = sock.sendmsg(views[:IOV_MAX])
+        except socket.timeout:
+            if running is not None and not running():
+                raise
+            continue
+        writes += 1
+        while n:
+            if n >= len(views[0]):
+                n -= len(views[0])
+                views.pop(0)
+            else:
+                views[0] = views[0][n:]
+                n = 0
+    return writes
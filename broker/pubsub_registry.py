@@ -0,0 +1,165 @@
+"""
+Subscription registry shared by every transport.
+
+The TCP broker and the WebSocket server register their client handles
+here. A publish does a single match and gets a single target set with
+TCP and WebSocket handles mixed, under a single lock. The broker then
+hands each handle to the front-end that owns it (see Broker._deliver).
+
+Handles are opaque: TCP sockets, asyncio protocols, WebSocket wrappers.
+A handle owned by a front-end other than the TCP broker exposes it as
+`handle.frontend`, an object with deliver(handles, frame, conflated).
+
+Front-ends also report connections (add_client / remove_client), so the
+registry knows every client, subscribed or not, and its patterns.
+Listeners (add_listener) get each change as it happens, and a UI keeps
+its own copy up to date instead of scanning the registry.
+"""
+
+import threading
+
+from pubsub_topics import TopicTrie
+
+# change events: listener(event, handle, pattern)
+CONNECTED = "connected"
+DISCONNECTED = "disconnected"
+SUBSCRIBED = "subscribed"
+UNSUBSCRIBED = "unsubscribed"
+
+
+class SubscriptionRegistry:
+    """
+    Patterns -> handles, indexed by a TopicTrie for matching.
+
+    `lock` is public: the broker also uses it for its client table, so
+    routing and client bookkeeping never take two locks.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.subscriptions = {}              # pattern -> set(handle)
+        self._by_handle = {}                 # handle -> set(pattern), reverse index
+        self._index = TopicTrie()            # pattern trie over subscriptions
+        self._conflate_index = TopicTrie()   # subscriptions made with "conflate": true
+        self._listeners = []
+
+    def __len__(self):
+        return len(self._index)
+
+    def add_listener(self, fn):
+        """
+        Call fn(event, handle, pattern) on every change (pattern is None for
+        CONNECTED / DISCONNECTED). fn runs under the registry lock, on the
+        thread making the change: it must only record or queue the event.
+        """
+        with self.lock:
+            self._listeners.append(fn)
+
+    def remove_listener(self, fn):
+        with self.lock:
+            if fn in self._listeners:
+                self._listeners.remove(fn)
+
+    def _notify(self, event, handle, pattern=None):
+        for fn in self._listeners:
+            fn(event, handle, pattern)
+
+    def add_client(self, handle):
+        """A new connection, before any subscription."""
+        with self.lock:
+            if handle not in self._by_handle:
+                self._by_handle[handle] = set()
+                self._notify(CONNECTED, handle)
+
+    def subscribe(self, handle, pattern, conflate=False):
+        """Raises ValueError for an invalid pattern."""
+        with self.lock:
+            added = self._index.add(pattern, handle)
+            self.subscriptions.setdefault(pattern, set()).add(handle)
+            if conflate:
+                self._conflate_index.add(pattern, handle)
+            else:
+                self._conflate_index.remove(pattern, handle)
+            if added:
+                patterns = self._by_handle.get(handle)
+                if patterns is None:
+                    # a handle that never connected (e.g. a bridge)
+                    patterns = self._by_handle[handle] = set()
+                    self._notify(CONNECTED, handle)
+                patterns.add(pattern)
+                self._notify(SUBSCRIBED, handle, pattern)
+
+    def unsubscribe(self, handle, pattern):
+        with self.lock:
+            self._discard(handle, pattern)
+
+    def _discard(self, handle, pattern):
+        clients = self.subscriptions.get(pattern)
+        if clients is None or handle not in clients:
+            return
+        clients.discard(handle)
+        if not clients:
+            del self.subscriptions[pattern]
+        self._index.remove(pattern, handle)
+        self._conflate_index.remove(pattern, handle)
+        patterns = self._by_handle.get(handle)
+        if patterns is not None:
+            patterns.discard(pattern)
+        self._notify(UNSUBSCRIBED, handle, pattern)
+
+    def remove_client(self, handle):
+        """Drop handle and every subscription of handle (O(its own patterns))."""
+        with self.lock:
+            self._remove(handle)
+
+    def remove_clients(self, handles):
+        """remove_client for many handles (e.g. a Wi-Fi drop), in one pass under the lock."""
+        with self.lock:
+            for handle in handles:
+                self._remove(handle)
+
+    def _remove(self, handle):
+        patterns = self._by_handle.pop(handle, None)
+        if patterns is None:
+            return
+        for pattern in patterns:
+            clients = self.subscriptions.get(pattern)
+            if clients is not None:
+                clients.discard(handle)
+                if not clients:
+                    del self.subscriptions[pattern]
+            self._index.remove(pattern, handle)
+            self._conflate_index.remove(pattern, handle)
+        self._notify(DISCONNECTED, handle)
+
+    def match(self, topic):
+        """(targets, conflated): every handle subscribed to topic, and the conflating ones."""
+        with self.lock:
+            targets = self._index.match(topic)
+            conflated = self._conflate_index.match(topic) if len(self._conflate_index) else ()
+        return targets, conflated
+
+    def patterns(self, handle):
+        """Patterns handle is subscribed to."""
+        with self.lock:
+            return sorted(self._by_handle.get(handle, ()))
+
+    def clients(self):
+        """{handle: [patterns]} for every known client (a snapshot for a new listener)."""
+        with self.lock:
+            return {h: sorted(p) for h, p in self._by_handle.items()}
+
+    def clear(self):
+        with self.lock:
+            for handle in list(self._by_handle):
+                self._notify(DISCONNECTED, handle)
+            self.subscriptions.clear()
+            self._by_handle.clear()
+            self._index.clear()
+            self._conflate_index.clear()
+
+    def drop_frontend(self, frontend):
+        """Drop the handles owned by frontend (None: the TCP broker's own handles)."""
+        with self.lock:
+            for handle in [h for h in self._by_handle if getattr(h, "frontend", None) is frontend]:
+                self._remove(handle)
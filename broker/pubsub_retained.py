@@ -0,0 +1,99 @@
+"""
+Retained messages: the last value published on a topic.
+
+A subscriber that SUBs to robots/robot3/pose gets the current pose right
+away instead of waiting for the next publish. A message is retained when
+
+- the PUB says so: {"action": "PUB", ..., "retain": true}, or the bin1
+  FLAG_RETAIN flag, or
+- its topic matches a pattern configured with --retain.
+
+A retained PUB with "data": null (and no blob) clears the topic.
+
+The store keeps the EncodedMessage as published, so a retained message
+is not serialized again when sent on SUB. It is capped both in topics
+and in bytes; when a cap is exceeded the least recently used topic
+(published or sent) is evicted.
+"""
+
+import threading
+from collections import OrderedDict
+
+from pubsub_topics import SINGLE, MULTI, matches
+
+
+class RetainedStore:
+    """LRU map topic -> EncodedMessage, bounded by max_topics and max_bytes. Thread-safe."""
+
+    def __init__(self, max_topics=10000, max_bytes=16 * 1024 * 1024):
+        self.max_topics = max_topics
+        self.max_bytes = max_bytes
+        self._items = OrderedDict()   # topic -> (frame, size), oldest first
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.evicted = 0
+
+    def __len__(self):
+        return len(self._items)
+
+    @staticmethod
+    def _size(frame):
+        """Bytes accounted for frame, without building a form only to measure it."""
+        size = frame.size
+        if size:
+            return size
+        if frame.blob is not None or frame.raw is not None:
+            # the payload dominates: no JSON + base64 of a blob nobody may ask for
+            return len(frame.topic) + len(frame.raw or b"") + len(frame.blob or b"")
+        # parsed data: the JSON line is what most subscribers get (and reuse)
+        return len(frame.line)
+
+    def put(self, frame):
+        """Retain frame as the value of frame.topic (clear it if there is no data)."""
+        if frame.empty:
+            self.discard(frame.topic)
+            return
+        size = self._size(frame)
+        with self._lock:
+            old = self._items.pop(frame.topic, None)
+            if old is not None:
+                self._bytes -= old[1]
+            if size > self.max_bytes:
+                self.evicted += 1
+                return
+            self._items[frame.topic] = (frame, size)
+            self._bytes += size
+            while len(self._items) > self.max_topics or self._bytes > self.max_bytes:
+                _, (_, evicted_size) = self._items.popitem(last=False)
+                self._bytes -= evicted_size
+                self.evicted += 1
+
+    def discard(self, topic):
+        with self._lock:
+            old = self._items.pop(topic, None)
+            if old is not None:
+                self._bytes -= old[1]
+
+    def match(self, pattern):
+        """Retained frames whose topic matches pattern, marked as recently used."""
+        with self._lock:
+            if SINGLE not in pattern and MULTI not in pattern:
+                item = self._items.get(pattern)
+                if item is None:
+                    return []
+                self._items.move_to_end(pattern)
+                return [item[0]]
+            found = [topic for topic in self._items if matches(pattern, topic)]
+            for topic in found:
+                self._items.move_to_end(topic)
+            return [self._items[topic][0] for topic in found]
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {"topics": len(self._items), "bytes": self._bytes, "evicted": self.evicted,
+                    "max_topics": self.max_topics, "max_bytes": self.max_bytes}
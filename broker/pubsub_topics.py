@@ -0,0 +1,152 @@
+"""
+Topic index shared by the TCP and WebSocket brokers.
+
+Topics are hierarchical strings separated by '/', as in MQTT:
+
+  UDFJC/emb1/robot0/RPi/state
+
+Subscription patterns may use wildcards:
+
+  +   matches exactly one level        UDFJC/emb1/+/RPi/state
+  #   matches the parent level and     UDFJC/emb1/robot0/#
+      everything below it (last level only)
+
+Topics starting with '$' (broker statistics, $SYS/...) are not matched
+by a wildcard in the first level: '#' does not get them, '$SYS/#' does.
+"""
+
+SEP = "/"
+SINGLE = "+"
+MULTI = "#"
+SYS = "$"
+
+
+def validate_pattern(pattern):
+    """Raise ValueError if '#' is used anywhere but as the last level."""
+    levels = pattern.split(SEP)
+    for i, level in enumerate(levels):
+        if MULTI in level and (level != MULTI or i != len(levels) - 1):
+            raise ValueError(f"'#' must be the last level of the pattern: {pattern!r}")
+        if SINGLE in level and level != SINGLE:
+            raise ValueError(f"'+' must occupy a whole level: {pattern!r}")
+    return levels
+
+
+def matches(pattern, topic):
+    """True if topic matches the subscription pattern (same rules as TopicTrie)."""
+    p_levels = pattern.split(SEP)
+    t_levels = topic.split(SEP)
+    if topic.startswith(SYS) and p_levels[0] in (SINGLE, MULTI):
+        return False
+    for i, level in enumerate(p_levels):
+        if level == MULTI:
+            return True
+        if i >= len(t_levels):
+            return False
+        if level != SINGLE and level != t_levels[i]:
+            return False
+    return len(p_levels) == len(t_levels)
+
+
+class _TrieNode:
+    __slots__ = ("children", "handles")
+
+    def __init__(self):
+        self.children = {}   # level -> _TrieNode
+        self.handles = set()  # subscribers whose pattern ends here
+
+
+class TopicTrie:
+    """
+    Level-by-level index of subscription patterns.
+
+    match(topic) walks at most one literal, one '+' and one '#' branch per
+    level, so its cost depends on the topic depth and on the number of
+    matching subscribers, not on the total number of subscriptions.
+
+    Not thread-safe: callers keep using their own lock.
+    """
+
+    def __init__(self):
+        self._root = _TrieNode()
+        self._size = 0
+
+    def __len__(self):
+        """Number of (pattern, handle) pairs stored."""
+        return self._size
+
+    def add(self, pattern, handle):
+        """Add handle under pattern. Returns True if it was not there yet."""
+        node = self._root
+        for level in validate_pattern(pattern):
+            child = node.children.get(level)
+            if child is None:
+                child = node.children[level] = _TrieNode()
+            node = child
+        if handle in node.handles:
+            return False
+        node.handles.add(handle)
+        self._size += 1
+        return True
+
+    def remove(self, pattern, handle):
+        """Remove handle from pattern, pruning empty branches. Returns True if found."""
+        path = []
+        node = self._root
+        for level in pattern.split(SEP):
+            child = node.children.get(level)
+            if child is None:
+                return False
+            path.append((node, level))
+            node = child
+        if handle not in node.handles:
+            return False
+        node.handles.discard(handle)
+        self._size -= 1
+        # prune nodes left without handles or children
+        for parent, level in reversed(path):
+            child = parent.children[level]
+            if child.handles or child.children:
+                break
+            del parent.children[level]
+        return True
+
+    def match(self, topic):
+        """Return a new set with every handle whose pattern matches topic."""
+        found = set()
+        nodes = [self._root]
+        levels = topic.split(SEP)
+        if topic.startswith(SYS):
+            # only a literal first level matches a '$' topic
+            child = self._root.children.get(levels[0])
+            if child is None:
+                return found
+            nodes = [child]
+            levels = levels[1:]
+        for level in levels:
+            nxt = []
+            for node in nodes:
+                children = node.children
+                multi = children.get(MULTI)
+                if multi is not None:
+                    found |= multi.handles
+                child = children.get(level)
+                if child is not None:
+                    nxt.append(child)
+                single = children.get(SINGLE)
+                if single is not None:
+                    nxt.append(single)
+            if not nxt:
+                return found
+            nodes = nxt
+        for node in nodes:
+            found |= node.handles
+            # 'a/b/#' also matches 'a/b'
+            multi = node.children.get(MULTI)
+            if multi is not None:
+                found |= multi.handles
+        return found
+
+    def clear(self):
+        self._root = _TrieNode()
+        self._size = 0
@@ -0,0 +1,587 @@
+"""
+Wire formats shared by the brokers and the Python clients.
+
+JSON-lines (TCP): one JSON object per line, terminated by b"\\n".
+WebSocket: one JSON object per text frame.
+
+Binary frames (TCP, "bin1") travel on the same port and can be mixed with
+JSON lines: a frame starts with the MAGIC byte, which never starts a JSON
+line. Header (big-endian, 14 bytes):
+
+  magic    u8   0xB5
+  action   u8   PUB=1 SUB=2 UNSUB=3 TOPIC=4 CTRL=5
+  key_len  u8   length of the blob field name
+  flags    u8   FLAG_TOPIC_INLINE: topic is a string in the body
+                FLAG_RETAIN: (PUB) keep as the topic's retained value
+                FLAG_VIA: (PUB, inline topic) the topic is followed by
+                NUL and the comma-separated ids of the brokers the
+                message went through (bridges, see pubsub_bridge)
+  topic    u16  topic id, or length of the inline topic
+  meta_len u32  JSON metadata (the "data" object without the blob)
+  blob_len u32  raw payload, e.g. an RGB565 frame
+
+followed by [topic] key meta blob.
+
+- Clients define a topic id once with a TOPIC frame (id in the header,
+  name in meta) and then PUB with the id only.
+- The broker always sends PUB frames with the topic inline, so the same
+  bytes serve every binary subscriber.
+- SUB/UNSUB/CTRL carry a JSON object in meta, like the JSON-lines packet.
+- A client asks for binary deliveries with the JSON line
+  {"action": "HELLO", "proto": "bin1"}; until then it gets JSON lines.
+  JSON-only subscribers see the blob base64-encoded under data[key].
+- A bridge between brokers adds "broker": <id> to its HELLO. Messages
+  sent on such a link carry the brokers they went through: FLAG_VIA in
+  bin1, a "via" list in JSON.
+
+Lazy payloads: the broker only needs action and topic to route a PUB.
+split_packet() reads those from a large JSON packet and returns "data"
+as the raw slice of the document; EncodedMessage(raw=...) copies that
+slice into every outgoing form (JSON line, text, bin1 meta) without
+parsing or re-serializing it, and parses it only if something asks for
+.data. A bin1 PUB without blob forwards its meta the same way.
+raw_json() is the check both go through: one valid JSON value (grammar
+checked token by token, strings by the C decoder) and no line break (a
+pretty-printed payload would split a JSON line); anything else is
+parsed whole.
+"""
+
+import base64
+import re
+import struct
+import threading
+
+from pubsub_json import dumps, dumpb, dumpl, loads
+
+PROTO_JSON = "json"
+PROTO_BIN1 = "bin1"
+
+MAGIC = 0xB5
+HEADER = struct.Struct(">BBBBHII")
+PUB, SUB, UNSUB, TOPIC, CTRL = 1, 2, 3, 4, 5
+ACTION_NAMES = {PUB: "PUB", SUB: "SUB", UNSUB: "UNSUB", TOPIC: "TOPIC", CTRL: "CTRL"}
+FLAG_TOPIC_INLINE = 0x01
+FLAG_RETAIN = 0x02
+FLAG_VIA = 0x04
+
+# split_packet: shorter packets are parsed whole (a C parser is faster on
+# them than scanning in Python); data with more than LAZY_MAX_TOKENS
+# tokens (strings, brackets, punctuation, literals) is dense JSON, not a
+# long blob: parsed whole too
+LAZY_MIN_BYTES = 4096
+LAZY_MAX_TOKENS = 32
+
+
+class BinaryFrame:
+    """A decoded bin1 frame. topic is an int id or, if sent inline, a str."""
+    __slots__ = ("action", "topic", "key", "meta", "blob", "flags", "via")
+
+    def __init__(self, action, topic, key, meta, blob, flags=0, via=()):
+        self.action = action
+        self.topic = topic
+        self.key = key
+        self.meta = meta
+        self.blob = blob
+        self.flags = flags
+        self.via = via
+
+
+def pack_frame(action, topic=0, meta=b"", blob=b"", key=b"", flags=0):
+    """Build a bin1 frame. topic is an int id, or a str sent inline."""
+    if isinstance(topic, str):
+        topic_bytes = topic.encode("utf-8")
+        flags |= FLAG_TOPIC_INLINE
+        topic_field = len(topic_bytes)
+    else:
+        topic_bytes = b""
+        topic_field = topic
+    header = HEADER.pack(MAGIC, action, len(key), flags, topic_field, len(meta), len(blob))
+    return b"".join((header, topic_bytes, key, meta, blob))
+
+
+def pack_ctrl(obj):
+    """A JSON control message (acks, hello) as a bin1 CTRL frame."""
+    return pack_frame(CTRL, 0, dumpb(obj))
+
+
+class FrameTooLarge(ValueError):
+    """A JSON line or bin1 frame longer than the framer's max_frame."""
+
+
+class StreamFramer:
+    """
+    Incremental splitter for a mixed JSON-lines / bin1 TCP stream.
+
+    - Data is received straight into a preallocated bytearray
+      (recv_into, or writable()/commit() for asyncio.BufferedProtocol),
+      never by concatenating bytes objects.
+    - The newline search resumes where the previous one stopped, so each
+      byte of a long line is scanned once, not once per recv.
+    - Consumed bytes are dropped by moving the tail to the front only when
+      space is needed; the buffer grows (doubling) up to max_frame.
+
+    Iterating yields complete frames: a JSON line (bytes, without the
+    newline; blank lines are skipped) or a BinaryFrame. Raises
+    FrameTooLarge once a frame exceeds max_frame.
+    """
+
+    def __init__(self, size=16 * 1024, max_frame=1 << 20):
+        self.max_frame = max_frame
+        self._buf = bytearray(size)
+        self._start = 0  # first unconsumed byte
+        self._end = 0    # end of received data
+        self._scan = 0   # newline search resumes here
+        self._need = 0   # size of an incomplete bin1 frame
+
+    def __len__(self):
+        """Bytes received but not yet returned as frames."""
+        return self._end - self._start
+
+    def writable(self, hint=0):
+        """Free space at the end of the buffer (at least hint bytes, if given)."""
+        self._reserve(max(hint, self._need - len(self), 4096))
+        return memoryview(self._buf)[self._end:]
+
+    def commit(self, nbytes):
+        """Mark nbytes written into the last writable() view as received."""
+        self._end += nbytes
+
+    def recv_into(self, sock):
+        """One recv_into from sock. Returns the byte count (0 on EOF)."""
+        n = sock.recv_into(self.writable())
+        self._end += n
+        return n
+
+    def feed(self, data):
+        """Append bytes that were already received elsewhere."""
+        n = len(data)
+        self.writable(n)[:n] = data
+        self._end += n
+
+    def _reserve(self, need):
+        buf = self._buf
+        if len(buf) - self._end >= need:
+            return
+        used = self._end - self._start
+        size = len(buf)
+        while size - used < need:
+            size *= 2
+        if size != len(buf):
+            # new buffer instead of resize: views handed out stay valid
+            new = bytearray(size)
+            new[:used] = memoryview(buf)[self._start:self._end]
+            self._buf = new
+        else:
+            buf[:used] = buf[self._start:self._end]
+        self._scan -= self._start
+        self._start = 0
+        self._end = used
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        buf = self._buf
+        while self._start < self._end:
+            start, end = self._start, self._end
+            if buf[start] == MAGIC:
+                frame = self._next_binary(start, end)
+                if frame is None:
+                    raise StopIteration
+                return frame
+            nl = buf.find(b"\n", max(self._scan, start), end)
+            if nl < 0:
+                self._scan = end
+                if end - start > self.max_frame:
+                    raise FrameTooLarge(f"line longer than {self.max_frame} bytes")
+                raise StopIteration
+            self._start = self._scan = nl + 1
+            line = bytes(memoryview(buf)[start:nl])
+            if line.strip():
+                return line
+        # everything consumed: next recv starts at the front again
+        self._start = self._end = self._scan = 0
+        raise StopIteration
+
+    def _next_binary(self, start, end):
+        buf = self._buf
+        if end - start < HEADER.size:
+            return None
+        _, action, key_len, flags, topic_field, meta_len, blob_len = HEADER.unpack_from(buf, start)
+        topic_len = topic_field if flags & FLAG_TOPIC_INLINE else 0
+        total = HEADER.size + topic_len + key_len + meta_len + blob_len
+        if total > self.max_frame:
+            raise FrameTooLarge(f"bin1 frame of {total} bytes, max {self.max_frame}")
+        if end - start < total:
+            self._need = total
+            return None
+        self._need = 0
+        self._start = self._scan = start + total
+        return _decode(buf, start, total)
+
+
+def _decode(buf, start, total):
+    """BinaryFrame from the complete frame of `total` bytes at buf[start:]."""
+    _, action, key_len, flags, topic_field, meta_len, blob_len = HEADER.unpack_from(buf, start)
+    view = memoryview(buf)
+    pos = start + HEADER.size
+    if flags & FLAG_TOPIC_INLINE:
+        topic = bytes(view[pos:pos + topic_field]).decode("utf-8")
+        pos += topic_field
+    else:
+        topic = topic_field
+    key = bytes(view[pos:pos + key_len]).decode("utf-8")
+    pos += key_len
+    meta = bytes(view[pos:pos + meta_len])
+    pos += meta_len
+    blob = bytes(view[pos:start + total])
+    via = ()
+    if flags & FLAG_VIA and isinstance(topic, str):
+        topic, _, ids = topic.partition("\0")
+        via = tuple(ids.split(",")) if ids else ()
+    return BinaryFrame(action, topic, key, meta, blob, flags & ~(FLAG_TOPIC_INLINE | FLAG_VIA), via)
+
+
+def unpack_frame(data):
+    """Decode one complete bin1 frame (bytes-like). Raises ValueError if malformed."""
+    if len(data) < HEADER.size or data[0] != MAGIC:
+        raise ValueError("not a bin1 frame")
+    _, _, key_len, flags, topic_field, meta_len, blob_len = HEADER.unpack_from(data, 0)
+    topic_len = topic_field if flags & FLAG_TOPIC_INLINE else 0
+    total = HEADER.size + topic_len + key_len + meta_len + blob_len
+    if total != len(data):
+        raise ValueError(f"bin1 frame of {total} bytes in {len(data)}")
+    return _decode(data, 0, total)
+
+
+class _Syntax:
+    """What split_packet needs to scan a str or a bytes document."""
+
+    def __init__(self, enc):
+        self.quote = enc('"')
+        self.backslash = enc("\\")
+        self.close = enc("}")
+        self.colon = enc(":")
+        self.comma = enc(",")
+        self.closers = {enc("{"): enc("}"), enc("["): enc("]")}
+        self.start = re.compile(enc(r"\s*\{"))
+        self.key = re.compile(enc(r'\s*"([^"\\]*)"\s*:\s*'))
+        self.sep = re.compile(enc(r"\s*([,}])"))
+        scalar = r"(?:-?(?:0|[1-9][0-9]*)(?:\.[0-9]+)?(?:[eE][-+]?[0-9]+)?|true|false|null)"
+        # one token: punctuation (group 1) or a scalar (no group)
+        self.token = re.compile(enc(rf'\s*(?:(["{{}}\[\]:,])|{scalar})'))
+        self.line_breaks = (enc("\n"), enc("\r"))
+
+
+_SYNTAX = {str: _Syntax(str), bytes: _Syntax(lambda s: s.encode("ascii"))}
+_UNPARSED = object()
+# _value_end states: what the next token must be
+_VALUE, _KEY, _COLON, _NEXT = range(4)
+
+
+def _string_end(doc, i, syn):
+    """Index after the closing quote of the string whose contents start at doc[i]."""
+    while True:
+        j = doc.find(syn.quote, i)
+        if j < 0:
+            raise ValueError("unterminated string")
+        k = j
+        while doc[k - 1:k] == syn.backslash:
+            k -= 1
+        if (j - k) % 2 == 0:
+            return j + 1
+        i = j + 1
+
+
+def _value_end(doc, i, syn, max_tokens):
+    """
+    Index after the JSON value starting at doc[i], found without parsing
+    it: strings are skipped with find, every other token must fit the
+    JSON grammar (brackets matched, "key": value pairs, no trailing
+    commas). Raises ValueError if it does not; None if the value needs
+    more than max_tokens tokens. The contents of strings are checked by
+    _check_raw.
+    """
+    stack = []  # closing bracket of every open object/array
+    state = _VALUE
+    opened = False  # right after "{" or "[": the closing bracket may follow
+    pos = i
+    for _ in range(max_tokens):
+        m = syn.token.match(doc, pos)
+        if m is None:
+            raise ValueError("invalid value")
+        pos = m.end()
+        token = m.group(1)
+        if state == _COLON:
+            if token != syn.colon:
+                raise ValueError("expected ':'")
+            state = _VALUE
+            continue
+        if stack and token == stack[-1] and (state == _NEXT or opened):
+            stack.pop()
+        elif state == _NEXT:
+            if token != syn.comma or not stack:
+                raise ValueError("expected ',' or a closing bracket")
+            state = _KEY if stack[-1] == syn.close else _VALUE
+            continue
+        elif state == _KEY:
+            if token != syn.quote:
+                raise ValueError("expected a key")
+            pos = _string_end(doc, pos, syn)
+            state = _COLON
+            opened = False
+            continue
+        elif token in syn.closers:
+            stack.append(syn.closers[token])
+            state = _KEY if stack[-1] == syn.close else _VALUE
+            opened = True
+            continue
+        elif token == syn.quote:
+            pos = _string_end(doc, pos, syn)
+        elif token is not None:
+            raise ValueError("expected a value")
+        if not stack:
+            return pos
+        state = _NEXT
+        opened = False
+    return None
+
+
+def _check_raw(raw, syn):
+    """
+    Raise ValueError unless raw is one line of valid JSON. The C decoder
+    checks what _value_end skips (escapes and control characters in
+    strings, UTF-8): cheaper than any scan in Python, and raw is still
+    forwarded as it is, never encoded again.
+    """
+    if any(raw.find(c) >= 0 for c in syn.line_breaks):
+        raise ValueError("data spread over several lines")
+    loads(raw)
+
+
+def raw_json(raw, max_tokens=LAZY_MAX_TOKENS):
+    """
+    True if raw (bytes or str) can be forwarded without parsing: a single
+    JSON value that follows the grammar (see _value_end), on one line,
+    with no control characters or invalid escapes in its strings.
+    """
+    syn = _SYNTAX.get(type(raw))
+    if syn is None:
+        return False
+    start = len(raw) - len(raw.lstrip())
+    try:
+        end = _value_end(raw, start, syn, max_tokens)
+        if end is None or raw[end:].strip():
+            return False
+        _check_raw(raw, syn)
+    except ValueError:
+        return False
+    return True
+
+
+def split_packet(doc, max_tokens=LAZY_MAX_TOKENS):
+    """
+    (pkt, raw) from a JSON packet (bytes or str) without parsing its
+    "data": pkt has every other key, parsed; raw is the data value as the
+    slice of doc it occupies, None if there is no "data". raw passed the
+    raw_json() checks; its strings are not decoded.
+
+    Returns None when the fast path does not apply: not an object, a key
+    with escapes, data too dense (max_tokens), spread over several lines
+    or not valid JSON. The caller then parses doc whole, which also reports
+    any error.
+    """
+    syn = _SYNTAX.get(type(doc))
+    if syn is None:
+        return None
+    m = syn.start.match(doc)
+    if m is None:
+        return None
+    pos = m.end()
+    pkt = {}
+    raw = None
+    try:
+        while True:
+            m = syn.key.match(doc, pos)
+            if m is None:
+                return None
+            key = m.group(1)
+            if not isinstance(key, str):
+                key = key.decode("utf-8")
+            pos = m.end()
+            end = _value_end(doc, pos, syn, max_tokens)
+            if end is None:
+                return None
+            if key == "data":
+                raw = doc[pos:end]
+                _check_raw(raw, syn)
+            else:
+                pkt[key] = loads(doc[pos:end])
+            m = syn.sep.match(doc, end)
+            if m is None:
+                return None
+            pos = m.end()
+            if m.group(1) == syn.close:
+                break
+    except ValueError:
+        return None
+    if doc[pos:].strip():
+        return None
+    return pkt, raw
+
+
+class EncodeCounter:
+    """
+    Serializations done by the EncodedMessages sharing it (one per
+    broker). Counted where they happen: forms are built lazily, on
+    whichever thread or event loop first needs them.
+    """
+    __slots__ = ("_lock", "value")
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.value = 0
+
+    def add(self):
+        with self._lock:
+            self.value += 1
+
+
+class EncodedMessage:
+    """
+    A published message, serialized once and shared by every transport.
+
+    - text: the JSON document (WebSocket text frame)
+    - line: the same document as newline-terminated UTF-8 bytes (TCP)
+    - binary: the bin1 PUB frame, blob kept raw (TCP, binary clients)
+
+    Each form is built lazily on first access and cached, so a message
+    sent to N subscribers costs one serialization per format instead of N
+    (text and line share one: each is derived from the other if built).
+    blob/blob_key carry a raw payload published by a binary client; the
+    JSON forms include it base64-encoded under data[blob_key].
+
+    via: ids of the brokers the message went through, for links to other
+    brokers (via_binary/via_text); the shared forms never include it.
+
+    raw: data as the JSON text it arrived in (bytes or str, see
+    split_packet) instead of an object. It is copied verbatim into every
+    form and parsed only when .data is read.
+    """
+    __slots__ = ("topic", "_data", "raw", "blob", "blob_key", "via", "_text", "_line", "_binary", "encodes",
+                 "counter")
+
+    def __init__(self, topic, data=None, blob=None, blob_key=None, via=(), raw=None, counter=None):
+        self.topic = topic
+        self._data = data if raw is None else _UNPARSED
+        self.raw = raw
+        self.blob = blob
+        self.blob_key = blob_key
+        self.via = via
+        self._text = None
+        self._line = None
+        self._binary = None
+        self.encodes = 0  # serializations actually done
+        self.counter = counter  # EncodeCounter also told of each one
+
+    @property
+    def data(self):
+        if self._data is _UNPARSED:
+            self._data = loads(self.raw)
+        return self._data
+
+    @property
+    def empty(self):
+        """No data (None, or a raw JSON null) and no blob."""
+        if self.blob is not None:
+            return False
+        if self._data is _UNPARSED:
+            return self.raw in (b"null", "null")
+        return self._data is None
+
+    @property
+    def json_data(self):
+        if self.blob is None:
+            return self.data
+        data = dict(self.data or {})
+        data[self.blob_key] = base64.b64encode(self.blob).decode("ascii")
+        return data
+
+    def _meta(self):
+        """data as bin1 meta: the raw bytes if there are, else serialized."""
+        raw = self.raw
+        if raw is not None:
+            return raw if isinstance(raw, bytes) else raw.encode("utf-8")
+        return dumpb(self._data) if self._data is not None else b""
+
+    def _spliced(self, head=b"", tail=b"", end=b"}"):
+        """{head "topic": ..., "data": raw tail} as bytes, raw copied in as is."""
+        return b"".join((b"{", head, b'"topic":', dumpb(self.topic), b',"data":', self._meta(), tail, end))
+
+    def _encoded(self):
+        self.encodes += 1
+        if self.counter is not None:
+            self.counter.add()
+
+    @property
+    def text(self):
+        if self._text is None:
+            if self._line is not None or (self.raw is not None and self.blob is None):
+                self._text = self.line[:-1].decode("utf-8", "replace")
+            else:
+                self._text = dumps({"topic": self.topic, "data": self.json_data})
+                self._encoded()
+        return self._text
+
+    @property
+    def line(self):
+        if self._line is None:
+            if self._text is not None:
+                self._line = (self._text + "\n").encode("utf-8")
+            elif self.raw is not None and self.blob is None:
+                self._line = self._spliced(end=b"}\n")
+                self._encoded()
+            else:
+                self._line = dumpl({"topic": self.topic, "data": self.json_data})
+                self._encoded()
+        return self._line
+
+    @property
+    def binary(self):
+        if self._binary is None:
+            meta = self._meta()
+            key = (self.blob_key or "").encode("utf-8")
+            self._binary = pack_frame(PUB, self.topic, meta, self.blob or b"", key)
+            self._encoded()
+        return self._binary
+
+    @property
+    def size(self):
+        """Length of a form already built (bin1 first), 0 if none was needed yet."""
+        for form in (self._binary, self._line, self._text):
+            if form is not None:
+                return len(form)
+        return 0
+
+    def via_binary(self):
+        """bin1 PUB frame with FLAG_VIA (not cached: only links to other brokers use it)."""
+        meta = self._meta()
+        key = (self.blob_key or "").encode("utf-8")
+        topic = self.topic + "\0" + ",".join(self.via)
+        return pack_frame(PUB, topic, meta, self.blob or b"", key, FLAG_VIA)
+
+    def via_text(self):
+        """The JSON document with the "via" list."""
+        if self.raw is not None and self.blob is None:
+            return self._spliced(tail=b',"via":' + dumpb(list(self.via))).decode("utf-8", "replace")
+        return dumps({"topic": self.topic, "data": self.json_data, "via": list(self.via)})
+
+    def pub_text(self):
+        """The PUB packet as a client sends it, with "via" if any (WebSocket links to other brokers)."""
+        if self.raw is not None and self.blob is None:
+            tail = b',"via":' + dumpb(list(self.via)) if self.via else b""
+            return self._spliced(b'"action":"PUB",', tail).decode("utf-8", "replace")
+        pkt = {"action": "PUB", "topic": self.topic, "data": self.json_data}
+        if self.via:
+            pkt["via"] = list(self.via)
+        return dumps(pkt)
@@ -87,7 +87,9 @@
 
 import network, time, json, gc
 import usocket as socket
+import errno
 import ubinascii
+import struct
 from machine import Timer
 
 import time
@@ -201,14 +203,46 @@ class WiFiManager:
 # =========================================================
 # SOCKET CLIENT
 # =========================================================
+# Binary frames "bin1" (same format as broker/pubsub_wire.py):
+# header >BBBBHII = magic, action, key_len, flags, topic, meta_len, blob_len
+# then [topic] key meta blob. Mixed with JSON lines on the same socket.
+BIN_MAGIC = 0xB5
+BIN_HEADER = ">BBBBHII"
+BIN_HEADER_SIZE = 14
+BIN_PUB, BIN_SUB, BIN_UNSUB, BIN_TOPIC, BIN_CTRL = 1, 2, 3, 4, 5
+BIN_TOPIC_INLINE = 0x01
+
+
 class SocketClient(Task):
-    def __init__(self, host, port, scheduler, period_ms=100):
+    # coalesce=True: send_json() only appends to a buffer and update()
+    # writes it once per period (or when max_batch lines / bytes pile up),
+    # so many small state updates cost one send() instead of one each.
+    #
+    # The socket is non-blocking: what send() cannot write now stays in
+    # _tx and update() resumes it when the socket has room, so a message
+    # is never cut in half. Past max_pending bytes waiting, new messages
+    # are dropped whole (counted in dropped).
+    def __init__(self, host, port, scheduler, period_ms=100, binary=False,
+                 coalesce=False, max_batch=32, max_batch_bytes=4096, max_pending=64 * 1024):
         super().__init__(scheduler, period_ms)
         self.host = host
         self.port = port
         self.sock = None
         self.actions = {}
         self._rx_buffer = b""
+        self.binary = binary   # True: frames raw (sin base64) con el broker PubSub_server_python
+        self._topic_ids = {}
+        self.coalesce = coalesce
+        self.max_batch = max_batch
+        self.max_batch_bytes = max_batch_bytes
+        self._pending = []
+        self._pending_bytes = 0
+        self._tx = []       # output not yet accepted by the socket (bytes / memoryview)
+        self._tx_bytes = 0
+        self.max_pending = max_pending
+        self.messages = 0   # sent
+        self.writes = 0     # send() calls
+        self.dropped = 0    # messages dropped with max_pending bytes waiting
 
     def connect(self):
         print("🔌 Conectando al broker...")
@@ -221,30 +255,104 @@ class SocketClient(Task):
         #self.sock.settimeout(0.1)
         self.sock.setblocking(False)
         print("✅ Conectado")
+        if self.binary:
+            self._topic_ids = {}
+            self.send_json({"action": "HELLO", "proto": "bin1"})
 
     def ensure(self):
         if self.sock is None:
             self.connect()
 
-    def send(self, data):
-        total = 0
-        while total < len(data):
+    def send(self, *parts):
+        """
+        Queue one message (its parts go together) and write what the socket
+        takes now. Returns False if it was dropped or the connection closed.
+        """
+        size = sum(len(p) for p in parts)
+        if self._tx_bytes and self._tx_bytes + size > self.max_pending:
+            self.dropped += 1
+            return False
+        for p in parts:
+            if p:
+                self._tx.append(p)
+        self._tx_bytes += size
+        return self._write_pending()
+
+    def _write_pending(self):
+        while self._tx and self.sock is not None:
+            buf = self._tx[0]
             try:
-                sent = self.sock.send(data[total:])
-                if sent == 0:
-                    print("⚠️ Socket closed")
-                    return False
-                total += sent
-            except OSError:
-                # Socket not ready → exit and retry later
+                self.writes += 1
+                sent = self.sock.send(buf)
+            except OSError as e:
+                if e.args[0] == errno.EAGAIN:
+                    # Socket not ready → the rest goes on the next update()
+                    return True
+                print("⚠️ Send error:", e)
+                self.close()
+                return False
+            if sent == 0:
+                print("⚠️ Socket closed")
+                self.close()
                 return False
+            self._tx_bytes -= sent
+            if sent < len(buf):
+                self._tx[0] = memoryview(buf)[sent:]
+            else:
+                self._tx.pop(0)
         return True
 
 
     def send_json(self, obj):
-        self.send((json.dumps(obj) + "\n").encode())
+        line = (json.dumps(obj) + "\n").encode()
+        if not self.coalesce:
+            self.messages += 1
+            self.send(line)
+            return
+        self._pending.append(line)
+        self._pending_bytes += len(line)
+        if len(self._pending) >= self.max_batch or self._pending_bytes >= self.max_batch_bytes:
+            self.flush()
+
+    def flush(self):
+        """Send the coalesced lines in one write."""
+        if not self._pending or self.sock is None:
+            return
+        data = b"".join(self._pending)
+        self.messages += len(self._pending)
+        self._pending = []
+        self._pending_bytes = 0
+        self.send(data)
+
+    def send_frame(self, action, topic_id, meta=b"", blob=b"", key=b""):
+        self.flush()  # keep the order with queued JSON lines
+        self.messages += 1
+        header = struct.pack(BIN_HEADER, BIN_MAGIC, action, len(key), 0,
+                             topic_id, len(meta), len(blob))
+        # header + key + meta are small; the blob goes without copying
+        self.send(header + key + meta, blob)
+
+    def publish(self, topic, data, blob=None, blob_key="frame"):
+        """PUB to the broker. blob (bytes) goes raw in binary mode, base64 in data[blob_key] otherwise."""
+        if not self.binary:
+            if blob is not None:
+                data = dict(data)
+                data[blob_key] = ubinascii.b2a_base64(blob).decode().replace("\n", "")
+            self.send_json({"action": "PUB", "topic": topic, "data": data})
+            return
+        tid = self._topic_ids.get(topic)
+        if tid is None:
+            tid = len(self._topic_ids) + 1
+            self._topic_ids[topic] = tid
+            self.send_frame(BIN_TOPIC, tid, topic.encode())
+        key = blob_key.encode() if blob is not None else b""
+        self.send_frame(BIN_PUB, tid, json.dumps(data).encode(), blob or b"", key)
 
     def close(self):
+        self._pending = []
+        self._pending_bytes = 0
+        self._tx = []
+        self._tx_bytes = 0
         try:
             if self.sock:
                 self.sock.close()
@@ -272,7 +380,16 @@ class SocketClient(Task):
             # No data available (non-blocking)
             return []
 
-        while b"\n" in self._rx_buffer:
+        while self._rx_buffer:
+            if self._rx_buffer[0] == BIN_MAGIC:
+                msg = self._read_binary()
+                if msg is None:
+                    break  # frame incompleto
+                messages.append(msg)
+                continue
+
+            if b"\n" not in self._rx_buffer:
+                break
             line, self._rx_buffer = self._rx_buffer.split(b"\n", 1)
 
             if not line:
@@ -286,9 +403,40 @@ class SocketClient(Task):
 
         return messages
 
+    def _read_binary(self):
+        buf = self._rx_buffer
+        if len(buf) < BIN_HEADER_SIZE:
+            return None
+        _, action, key_len, flags, topic, meta_len, blob_len = struct.unpack(BIN_HEADER, buf[:BIN_HEADER_SIZE])
+        topic_len = topic if flags & BIN_TOPIC_INLINE else 0
+        end = BIN_HEADER_SIZE + topic_len + key_len + meta_len + blob_len
+        if len(buf) < end:
+            return None
+        pos = BIN_HEADER_SIZE
+        if topic_len:
+            topic = buf[pos:pos + topic_len].decode()
+            pos += topic_len
+        key = buf[pos:pos + key_len].decode()
+        pos += key_len
+        meta = buf[pos:pos + meta_len]
+        pos += meta_len
+        self._rx_buffer = buf[end:]
+        obj = json.loads(meta) if meta else None
+        if action != BIN_PUB:
+            return obj or {}
+        # mismo dict que un PUB JSON: los handlers reciben el blob en base64, como en modo JSON
+        if key:
+            obj = obj or {}
+            obj[key] = ubinascii.b2a_base64(buf[pos:end]).decode().replace("\n", "")
+        return {"action": "PUB", "topic": topic, "data": obj}
+
 
 
     def update(self):
+        if self.sock is None:
+            return
+        self.flush()
+        self._write_pending()
         msgs = self.recv_json_nonblocking()
         for msg in msgs:
             action = msg.get("action")
@@ -311,20 +459,17 @@ class Node:
         self.prefix=prefix
         self.subscriptions = {}  # topic -> set(callback)
 
-    def publish(self, topic, data):
-        self.broker_publish(topic,data)
+    def publish(self, topic, data, blob=None, blob_key="frame"):
+        self.broker_publish(topic, data, blob, blob_key)
+        if blob is not None and self.subscriptions.get(topic):
+            # los callbacks locales reciben el blob en base64, como los del broker
+            data = dict(data)
+            data[blob_key] = ubinascii.b2a_base64(blob).decode().replace("\n", "")
         self.local_publish(topic,data)
        
-    def broker_publish(self,topic,data):   
+    def broker_publish(self, topic, data, blob=None, blob_key="frame"):
         self.sock.ensure()
-
-        pkt = {
-            "action": "PUB",
-            "topic": self.prefix+topic,
-            "data": data
-        }
-
-        self.sock.send_json(pkt)
+        self.sock.publish(self.prefix+topic, data, blob, blob_key)
 
 
     def local_publish(self,topic,data):   
@@ -425,16 +570,16 @@ class CameraPublisherTask(Task):
 #            gc.collect()
 
             frame = self._generate_frame()
-#            frame_b64 = ubinascii.b2a_base64(frame).decode().strip()
-            frame_b64 = ubinascii.b2a_base64(frame).decode().replace("\n", "")
 
+            # SocketClient sends it raw (binary=True) or as base64 in "frame"
             self.pubsub.publish(
                 "camera/frame",
                 {
                     "w": self.WIDTH,
                     "h": self.HEIGHT,
-                    "frame": frame_b64
-                }
+                },
+                blob=frame,
+                blob_key="frame"
             )
 
             print("📤 Frame")
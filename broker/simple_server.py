@@ -1,36 +1,127 @@
+import abc
 import asyncio
 import websockets
 import socket
-import json
+
+from pubsub_topics import TopicTrie
+from pubsub_outbound import OutboundQueue, SlowConsumer, QUEUE_MESSAGES, QUEUE_BYTES, OVERFLOW
+from pubsub_json import dumpl, loads
+
+
+class Client(abc.ABC):
+    """
+    A subscriber: publish() only puts the message in its bounded queue and
+    a writer task sends it at the client's pace, so one slow client never
+    delays the others. Subclasses implement write(); TEXT says whether
+    they take the message as str (WebSocket) or as a bytes JSON line (TCP).
+    """
+    TEXT = False
+
+    def __init__(self, queue_size=QUEUE_MESSAGES, queue_bytes=QUEUE_BYTES, overflow=OVERFLOW):
+        self.queue = OutboundQueue(queue_size, queue_bytes, overflow, repr(self))
+        self.wakeup = asyncio.Event()
+        self.writer_task = asyncio.get_running_loop().create_task(self._writer())
+
+    def send(self, msg, topic=None):
+        """Send or queue msg without waiting. Raises SlowConsumer with the 'disconnect' policy."""
+        if not len(self.queue) and self.write_now(msg):
+            return
+        self.queue.put(msg, topic)
+        self.wakeup.set()
+
+    def write_now(self, msg):
+        """Write msg at once if the transport has room (nothing queued). Returns False otherwise."""
+        return False
+
+    async def _writer(self):
+        q = self.queue
+        while not q.closed:
+            msg = q.get_nowait()
+            if msg is None:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
+            try:
+                await self.write(msg)
+            except (ConnectionError, websockets.exceptions.ConnectionClosed):
+                break
+            q.record_sent(len(msg))
+
+    @abc.abstractmethod
+    async def write(self, msg):
+        """Send msg and wait until the transport accepts more."""
+
+    @abc.abstractmethod
+    def abort(self):
+        """Close the connection; its handler then removes the client."""
+
+    def close(self):
+        self.queue.close()
+        self.writer_task.cancel()
 
 
-class TCPClient:
-    def __init__(self, writer):
+class TCPClient(Client):
+    def __init__(self, writer, **queue_opts):
+        super().__init__(**queue_opts)
         self.writer = writer
         print('TCPClient ',writer)
 
-    async def send(self, msg):
-        self.writer.write((msg + "\n").encode())
+    HIGH_WATER = 64 * 1024  # bytes buffered in the transport before messages wait in the queue
+
+    async def write(self, msg):
+        self.writer.write(msg)
         await self.writer.drain()
 
+    def write_now(self, msg):
+        transport = self.writer.transport
+        if transport.is_closing() or transport.get_write_buffer_size() > self.HIGH_WATER:
+            return False
+        transport.write(msg)
+        self.queue.record_sent(len(msg))
+        return True
+
+    def abort(self):
+        self.writer.transport.abort()
+
     def __repr__(self):
         return f"TCPClient({id(self)})"
 
 
 
 
-class WSClient:
-    def __init__(self, websocket):
+class WSClient(Client):
+    TEXT = True
+
+    def __init__(self, websocket, **queue_opts):
+        super().__init__(**queue_opts)
         self.ws = websocket
         print('WSClient ',websocket)
 
-    async def send(self, msg):
+    async def write(self, msg):
         await self.ws.send(msg)
 
+    def abort(self):
+        asyncio.get_running_loop().create_task(self.ws.close(1008, "slow consumer"))
+
     def __repr__(self):
         return f"WSClient({id(self)})"
 
 
+def handle_packet(pubsub, client, pkt):
+    """SUB / UNSUB / PUB from a TCP or WS client."""
+    action = str(pkt.get("action", "")).upper()
+    topic = pkt.get("topic", "")
+    if action == "SUB":
+        try:
+            pubsub.subscribe(client, topic)
+        except ValueError as e:
+            print(f"[SUB] {client} invalid pattern: {e}")
+    elif action == "UNSUB":
+        pubsub.unsubscribe(client, topic)
+    elif action == "PUB":
+        pubsub.publish(topic, pkt.get("data"), origin=client)
+
+
 
 class TCPServer:
     def __init__(self, pubsub, host="0.0.0.0", port=5051):
@@ -40,26 +131,34 @@ class TCPServer:
         print('TCPServer '+socket.gethostbyname(socket.gethostname()))
 
     async def handle_client(self, reader, writer):
-        client = TCPClient(writer)
-
-        while True:
-            data = await reader.readline()
-            if not data:
-                break
+        client = TCPClient(writer, **self.pubsub.queue_opts)
+        try:
+            while True:
+                try:
+                    data = await reader.readline()
+                except (ConnectionError, ValueError):
+                    # reset, or a line longer than the stream limit
+                    break
+                if not data:
+                    break
 
+                try:
+                    pkt = loads(data)
+                except ValueError:
+                    continue
+
+                if isinstance(pkt, dict):
+                    handle_packet(self.pubsub, client, pkt)
+                # readline() does not yield while lines are buffered: let the writers run
+                await asyncio.sleep(0)
+        finally:
+            # immediately: no more deliveries to a closed connection
+            self.pubsub.remove(client)
+            writer.close()
             try:
-                pkt = json.loads(data.decode())
-            except:
-                continue
-
-            if pkt["action"] == "SUB":
-                self.pubsub.subscribe(client, pkt["topic"])
-
-            elif pkt["action"] == "PUB":
-                await self.pubsub.publish(pkt["topic"], pkt["data"], origin=client)
-
-        writer.close()
-        await writer.wait_closed()
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
 
     async def start(self):
         server = await asyncio.start_server(
@@ -79,49 +178,82 @@ class WSServer:
         self.host = host
         self.port = port
 
-    async def handler(self, websocket):
-        client = WSClient(websocket)
-
-        async for message in websocket:
-            pkt = json.loads(message)
-
-            if pkt["action"] == "SUB":
-                self.pubsub.subscribe(client, pkt["topic"])
+    async def handler(self, websocket, path=None):
+        client = WSClient(websocket, **self.pubsub.queue_opts)
+        try:
+            async for message in websocket:
+                try:
+                    pkt = loads(message)
+                except ValueError:
+                    continue
 
-            elif pkt["action"] == "PUB":
-                await self.pubsub.publish(pkt["topic"], pkt["data"], origin=client)
+                if isinstance(pkt, dict):
+                    handle_packet(self.pubsub, client, pkt)
+        except websockets.exceptions.ConnectionClosed:
+            pass
+        finally:
+            self.pubsub.remove(client)
 
     async def start(self):
         return await websockets.serve(self.handler, self.host, self.port)
 
 class PubSub:
-    def __init__(self):
-        self.subscriptions = {}  # topic -> set(clients)
+    """
+    Topics with MQTT wildcards ('+', '#', see pubsub_topics). Everything
+    runs on one event loop: no locks. publish() never waits for a client;
+    a full queue applies the overflow policy (see pubsub_outbound).
+    """
+
+    def __init__(self, queue_size=QUEUE_MESSAGES, queue_bytes=QUEUE_BYTES, overflow=OVERFLOW, verbose=False):
+        self.subscriptions = TopicTrie()  # pattern -> clients
+        self.patterns = {}  # client -> set(pattern), to remove a client in O(its patterns)
+        self.queue_opts = dict(queue_size=queue_size, queue_bytes=queue_bytes, overflow=overflow)
+        self.verbose = verbose  # print every PUB
 
     def subscribe(self, client, topic):
-        self.subscriptions.setdefault(topic, set()).add(client)
+        """Raises ValueError for an invalid pattern."""
+        self.subscriptions.add(topic, client)
+        self.patterns.setdefault(client, set()).add(topic)
         print(f"[SUB] {client} -> {topic}")
 
-    async def publish(self, topic, data, origin=None):
-        msg = json.dumps({
+    def unsubscribe(self, client, topic):
+        self.subscriptions.remove(topic, client)
+        self.patterns.get(client, set()).discard(topic)
+        print(f"[UNSUB] {client} -> {topic}")
+
+    def remove(self, client):
+        """Forget a disconnected client and stop its writer."""
+        for topic in self.patterns.pop(client, ()):
+            self.subscriptions.remove(topic, client)
+        client.close()
+        print(f"[GONE] {client}")
+
+    def publish(self, topic, data, origin=None):
+        # serialized once: bytes line for TCP, the same text for WS only if needed
+        line = dumpl({
             "action": "PUB",
             "topic": topic,
             "data": data
         })
+        text = None
 
-        clients = self.subscriptions.get(topic, set())
+        clients = self.subscriptions.match(topic)
 
-        print(f"[PUB] {topic} -> {len(clients)} clients")
+        if self.verbose:
+            print(f"[PUB] {topic} -> {len(clients)} clients")
 
-        for c in list(clients):
-            if c != origin:
+        for c in clients:
+            if c is not origin:
+                if c.TEXT and text is None:
+                    text = line[:-1].decode("utf-8")
                 try:
-                    await c.send(msg)
-                except:
-                    clients.remove(c)
+                    c.send(text if c.TEXT else line, topic)
+                except SlowConsumer:
+                    print(f"[SLOW] {c} disconnected")
+                    c.abort()
+
 
 
-                            
 
 
 async def main():
@@ -140,4 +272,5 @@ async def main():
     print("...")
 
 
-asyncio.run(main())
\ No newline at end of file
+if __name__ == "__main__":
+    asyncio.run(main())
\ No newline at end of file
@@ -0,0 +1,18 @@
+import os
+import socket
+import sys
+
+import pytest
+
+# the broker modules are flat files next to this directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def free_port():
+    """A function returning a TCP port nobody listens on."""
+    def pick():
+        with socket.socket() as s:
+            s.bind(("127.0.0.1", 0))
+            return s.getsockname()[1]
+    return pick
@@ -0,0 +1,164 @@
+"""Two localhost brokers linked by pubsub_bridge: forwarding and loop prevention."""
+
+import json
+import socket
+import time
+
+import pytest
+
+from pubsub_broker import make_broker, WebSocketServer
+from pubsub_bridge import make_bridges
+
+
+def _wait(cond, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not cond():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.05)
+    return True
+
+
+def _subscribe(broker, pattern):
+    sock = socket.create_connection(("127.0.0.1", broker.port))
+    sock.settimeout(3)
+    reader = sock.makefile("rb")
+    sock.sendall(json.dumps({"action": "SUB", "topic": pattern}).encode() + b"\n")
+    assert json.loads(reader.readline())["status"] == "subscribed"
+    return sock, reader
+
+
+def _publish(broker, topic, data):
+    with socket.create_connection(("127.0.0.1", broker.port)) as sock:
+        sock.sendall(json.dumps({"action": "PUB", "topic": topic, "data": data}).encode() + b"\n")
+        time.sleep(0.05)
+
+
+def _drain(sock, reader, quiet=0.5):
+    """Messages received until the socket stays quiet for `quiet` seconds."""
+    sock.settimeout(quiet)
+    got = []
+    try:
+        while True:
+            line = reader.readline()
+            if not line:
+                break
+            got.append(json.loads(line))
+    except socket.timeout:
+        pass
+    return got
+
+
+@pytest.fixture
+def pair(free_port):
+    a = make_broker("thread", host="127.0.0.1", port=free_port())
+    b = make_broker("async", host="127.0.0.1", port=free_port())
+    ws = WebSocketServer(host="127.0.0.1", port=free_port(), broker=b)
+    for server in (a, b, ws):
+        server.start()
+    time.sleep(0.3)
+    bridges = []
+    yield a, b, ws, bridges
+    for bridge in bridges:
+        bridge.stop()
+    ws.stop()
+    ws.thread.join(3)
+    a.stop()
+    b.stop()
+
+
+@pytest.mark.parametrize("transport", ["tcp", "ws"])
+def test_forwarding_both_directions(pair, transport):
+    a, b, ws, bridges = pair
+    port = b.port if transport == "tcp" else ws.port
+    bridges += make_bridges(a, [f"{transport}://127.0.0.1:{port} out=up/# in=down/#"])
+    bridges[0].start()
+    assert _wait(lambda: bridges[0].connected and bridges[0].remote_id)
+    time.sleep(0.2)  # the inbound SUB reaches b
+    sock_a, reader_a = _subscribe(a, "#")
+    sock_b, reader_b = _subscribe(b, "#")
+
+    _publish(a, "up/1", {"n": 1})
+    _publish(b, "down/1", "go")
+    _publish(a, "local/1", 2)  # not in out=
+    _publish(b, "other/1", 3)  # not in in=
+
+    assert [m["topic"] for m in _drain(sock_b, reader_b)] == ["up/1", "down/1", "other/1"]
+    assert [m["topic"] for m in _drain(sock_a, reader_a)] == ["up/1", "down/1", "local/1"]
+    sock_a.close()
+    sock_b.close()
+
+
+def test_two_way_link_delivers_once(pair):
+    a, b, _, bridges = pair
+    # the same topics out and in: without via each message would bounce back
+    bridges += make_bridges(a, [f"127.0.0.1:{b.port} out=t/# in=t/#"])
+    bridges[0].start()
+    assert _wait(lambda: bridges[0].connected and bridges[0].remote_id)
+    time.sleep(0.2)
+    sock_a, reader_a = _subscribe(a, "t/#")
+    sock_b, reader_b = _subscribe(b, "t/#")
+
+    _publish(a, "t/a", "from a")
+    _publish(b, "t/b", "from b")
+
+    assert [m["data"] for m in _drain(sock_a, reader_a, quiet=1.0)] == ["from a", "from b"]
+    assert [m["data"] for m in _drain(sock_b, reader_b)] == ["from a", "from b"]
+    assert bridges[0].messages_out == 1 and bridges[0].messages_in == 1
+    sock_a.close()
+    sock_b.close()
+
+
+def test_cycle_is_cut_by_via(pair, free_port):
+    a, b, _, bridges = pair
+    c = make_broker("thread", host="127.0.0.1", port=free_port())
+    c.start()
+    try:
+        # a -> b -> c -> a
+        bridges += make_bridges(a, [f"127.0.0.1:{b.port} out=t/# in=t/#"])
+        bridges += make_bridges(b, [f"127.0.0.1:{c.port} out=t/# in=t/#"])
+        bridges += make_bridges(c, [f"127.0.0.1:{a.port} out=t/# in=t/#"])
+        for bridge in bridges:
+            bridge.start()
+        assert _wait(lambda: all(br.connected and br.remote_id for br in bridges))
+        time.sleep(0.2)
+        subs = [_subscribe(broker, "t/#") for broker in (a, b, c)]
+
+        _publish(a, "t/x", "once")
+
+        # the origin sees it once; b and c once per direction around the ring
+        counts = [len(_drain(sock, reader, quiet=1.0)) for sock, reader in subs]
+        assert counts[0] == 1 and 1 <= counts[1] <= 2 and 1 <= counts[2] <= 2
+        sent = sum(br.messages_out for br in bridges)
+        time.sleep(0.5)
+        assert sum(br.messages_out for br in bridges) == sent  # nothing still circling
+        for sock, _ in subs:
+            sock.close()
+    finally:
+        for bridge in bridges:
+            bridge.stop()
+        bridges.clear()
+        c.stop()
+
+
+def test_messages_queued_while_the_ws_link_is_down_survive(pair, free_port):
+    a, b, ws, bridges = pair
+    bridges += make_bridges(a, [f"ws://127.0.0.1:{ws.port} out=up/#"])
+    bridge = bridges[0]
+    bridge.start()
+    assert _wait(lambda: bridge.connected and bridge.remote_id)
+    sock_b, reader_b = _subscribe(b, "up/#")
+
+    ws.stop()
+    ws.thread.join(3)
+    assert _wait(lambda: not bridge.connected)
+    # the old session's writer was cancelled while its executor job waited on
+    # the queue: the job must not take (and lose) what is published now
+    _publish(a, "up/1", "while down")
+    time.sleep(0.7)
+    assert len(bridge.queue) == 1
+
+    ws.start()
+    assert _wait(lambda: bridge.connected and bridge.remote_id, timeout=10)
+    assert [m["data"] for m in _drain(sock_b, reader_b, quiet=1.0)] == ["while down"]
+    sock_b.close()
@@ -0,0 +1,36 @@
+"""Each published message is serialized once for all its subscribers."""
+
+import json
+import socket
+import time
+
+import pytest
+
+from pubsub_broker import make_broker
+
+
+@pytest.mark.parametrize("engine", ["thread", "async"])
+def test_serializations_avoided(engine, free_port):
+    # async: the shards encode later, on their own loops
+    broker = make_broker(engine, shards=2, host="127.0.0.1", port=free_port())
+    broker.start()
+    time.sleep(0.3)
+    try:
+        subs = []
+        for _ in range(5):
+            sock = socket.create_connection(("127.0.0.1", broker.port))
+            sock.settimeout(3)
+            reader = sock.makefile("rb")
+            sock.sendall(b'{"action": "SUB", "topic": "t"}\n')
+            reader.readline()
+            subs.append((sock, reader))
+        with socket.create_connection(("127.0.0.1", broker.port)) as pub:
+            pub.sendall(b"".join(json.dumps({"action": "PUB", "topic": "t", "data": i}).encode() + b"\n"
+                                 for i in range(10)))
+            for sock, reader in subs:
+                assert [json.loads(reader.readline())["data"] for _ in range(10)] == list(range(10))
+                sock.close()
+        assert broker.encodes.value == 10  # one JSON line per message
+        assert broker.serializations_avoided == 50 - 10
+    finally:
+        broker.stop()
@@ -0,0 +1,97 @@
+"""Large PUBs routed on their header (pubsub_wire.split_packet) stay valid JSON lines."""
+
+import asyncio
+import json
+import socket
+import time
+
+import pytest
+import websockets
+
+from pubsub_broker import make_broker, WebSocketServer
+from pubsub_json import sample_payloads
+from pubsub_wire import LAZY_MIN_BYTES, split_packet, raw_json
+
+
+@pytest.fixture(params=["thread", "async"])
+def brokers(request, free_port):
+    broker = make_broker(request.param, host="127.0.0.1", port=free_port())
+    ws = WebSocketServer(host="127.0.0.1", port=free_port(), broker=broker)
+    broker.start()
+    ws.start()
+    time.sleep(0.3)
+    yield broker, ws
+    ws.stop()
+    ws.thread.join(3)
+    broker.stop()
+
+
+def _subscribe(broker, pattern):
+    sock = socket.create_connection(("127.0.0.1", broker.port))
+    sock.settimeout(3)
+    reader = sock.makefile("rb")
+    sock.sendall(json.dumps({"action": "SUB", "topic": pattern}).encode() + b"\n")
+    assert json.loads(reader.readline())["status"] == "subscribed"
+    return sock, reader
+
+
+def _ws_publish(ws, *texts):
+    async def run():
+        async with websockets.connect(f"ws://127.0.0.1:{ws.port}", max_size=None) as conn:
+            for text in texts:
+                await conn.send(text)
+            await asyncio.sleep(0.3)
+    asyncio.run(run())
+
+
+def test_pretty_printed_ws_pub_is_one_tcp_line(brokers):
+    broker, ws = brokers
+    sock, reader = _subscribe(broker, "camera/#")
+    data = sample_payloads()["camera"]["data"]
+    text = json.dumps({"action": "PUB", "topic": "camera/frame", "data": data}, indent=2)
+    assert len(text) >= LAZY_MIN_BYTES and text.count("\n") > 3
+    _ws_publish(ws, text)
+    line = reader.readline()
+    assert json.loads(line) == {"topic": "camera/frame", "data": data}
+    sock.settimeout(0.3)
+    with pytest.raises(socket.timeout):
+        reader.readline()  # nothing left over from the pretty-printed document
+    sock.close()
+
+
+def test_malformed_large_data_is_not_forwarded(brokers):
+    broker, ws = brokers
+    sock, reader = _subscribe(broker, "camera/#")
+    filler = "z" * LAZY_MIN_BYTES
+    bad = [b'{"action": "PUB", "topic": "camera/bad", "data": {"a": nope, "f": "%s"}}\n' % filler.encode(),
+           b'{"action": "PUB", "topic": "camera/bad", "data": {"frame": "%s", "x": }}\n' % filler.encode()]
+    good = json.dumps({"action": "PUB", "topic": "camera/ok", "data": {"f": filler}}).encode() + b"\n"
+    pub = socket.create_connection(("127.0.0.1", broker.port))
+    pub.sendall(b"".join(bad) + good)
+    assert json.loads(reader.readline())["topic"] == "camera/ok"
+    pub.close()
+    sock.close()
+
+
+def test_split_packet_checks():
+    data = {"a": "x" * 5000, "n": [1, 2.5, -3e2, True, None], "o": {"k": "v"}}
+    pkt, raw = split_packet(json.dumps({"action": "PUB", "topic": "t", "data": data}).encode())
+    assert pkt == {"action": "PUB", "topic": "t"} and json.loads(raw) == data
+    assert split_packet(json.dumps({"action": "PUB", "topic": "t", "data": data}, indent=2)) is None
+    for good in ['{"a": 1}', '[1, 2, {"b": [null]}]', '"s"', "-0.5", "{}", "[[]]", '{"a": "\\"\\u00e9"}']:
+        assert raw_json(good) and raw_json(good.encode())
+
+
+@pytest.mark.parametrize("bad", [
+    '{"a": nope}', '{"a": 1 2}', '[tru]', "nope", '{"a":\n1}',
+    '{"a":}', '{"a" 1}', '{,}', '{"a":[1}]', '["a":"b"]', '{"a":1,}', '[1,]', '[,1]',
+    '{"a":1}}', '{1: 2}', '{"a"}', '01', '"\x01"', '"\\q"', '"\\u12"',
+])
+def test_malformed_data_is_never_raw(bad):
+    assert not raw_json(bad) and not raw_json(bad.encode())
+    doc = '{"action": "PUB", "topic": "t", "data": %s, "pad": "%s"}' % (bad, "x" * LAZY_MIN_BYTES)
+    assert split_packet(doc) is None and split_packet(doc.encode()) is None
+
+
+def test_invalid_utf8_is_never_raw():
+    assert not raw_json(b'"\xff"')
@@ -0,0 +1,48 @@
+"""pubsub_log: appends never wait for the periodic flush to disk."""
+
+import threading
+
+import pubsub_log
+from pubsub_log import MessageLog, read_log
+from pubsub_wire import EncodedMessage
+
+
+def test_append_does_not_wait_for_msync(tmp_path, monkeypatch):
+    log = MessageLog(str(tmp_path), fsync_interval=3600)
+    release = threading.Event()
+    in_flush = threading.Event()
+    real_flush = pubsub_log._Segment.flush
+
+    def slow_flush(seg):
+        in_flush.set()
+        release.wait(5)  # a slow SD card
+        real_flush(seg)
+
+    monkeypatch.setattr(pubsub_log._Segment, "flush", slow_flush)
+    try:
+        log.append(EncodedMessage("t", 0))
+        flusher = threading.Thread(target=log.flush)
+        flusher.start()
+        assert in_flush.wait(5)
+        # appends go on while the msync is stuck
+        done = threading.Thread(target=lambda: [log.append(EncodedMessage("t", i)) for i in range(1, 200)])
+        done.start()
+        done.join(2)
+        assert not done.is_alive()
+        release.set()
+        flusher.join(5)
+    finally:
+        release.set()
+        log.close()
+    assert [r.data for r in read_log(str(tmp_path))] == list(range(200))
+
+
+def test_flush_after_roll_is_harmless(tmp_path):
+    log = MessageLog(str(tmp_path), segment_bytes=4096, fsync_interval=3600)
+    old = log._active
+    for i in range(200):  # several segments
+        log.append(EncodedMessage("t", i))
+    assert log._active is not old
+    old.flush()  # what a flush that raced with _roll ends up doing
+    log.close()
+    assert [r.data for r in read_log(str(tmp_path))] == list(range(200))
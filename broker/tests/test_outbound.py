@@ -0,0 +1,37 @@
+"""The per-subscriber queues (pubsub_outbound): overflow policies, waiting."""
+
+import logging
+
+import pytest
+
+from pubsub_outbound import OutboundQueue, SlowConsumer, DISCONNECT, DROP_OLDEST, OVERFLOW
+
+
+def test_default_never_drops():
+    assert OVERFLOW == DISCONNECT
+    q = OutboundQueue(max_messages=2)
+    q.put(b"1")
+    q.put(b"2")
+    with pytest.raises(SlowConsumer):
+        q.put(b"3")
+    assert q.dropped == 0 and [q.get_nowait(), q.get_nowait()] == [b"1", b"2"]
+
+
+def test_first_drop_is_logged_once(caplog):
+    q = OutboundQueue(max_messages=1, policy=DROP_OLDEST, name="client-1")
+    with caplog.at_level(logging.WARNING, logger="pubsub"):
+        for i in range(5):
+            q.put(str(i).encode())
+    assert q.dropped == 4 and q.get_nowait() == b"4"
+    warnings = [r for r in caplog.records if r.levelno == logging.WARNING]
+    assert len(warnings) == 1 and "client-1" in warnings[0].getMessage()
+
+
+def test_wait_does_not_take():
+    q = OutboundQueue()
+    assert q.wait(0.01) is False
+    q.put(b"1")
+    assert q.wait(0.01) is True and len(q) == 1
+    assert q.get_nowait() == b"1"
+    q.close()
+    assert q.wait() is False  # close wakes a waiter
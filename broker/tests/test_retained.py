@@ -0,0 +1,22 @@
+"""pubsub_retained: the store sizes entries without serializing them again."""
+
+from pubsub_retained import RetainedStore
+from pubsub_wire import EncodedMessage
+
+
+def test_blob_is_not_encoded_to_be_retained():
+    store = RetainedStore(max_bytes=100 * 1024)
+    frame = EncodedMessage("cam/frame", {"w": 2}, blob=bytes(60 * 1024), blob_key="frame_b64")
+    store.put(frame)
+    assert frame.encodes == 0  # neither JSON nor base64 built
+    assert store.match("cam/#") == [frame]
+    # the blob length counts against max_bytes: a second one evicts the first
+    store.put(EncodedMessage("cam/other", {"w": 2}, blob=bytes(60 * 1024), blob_key="frame_b64"))
+    assert [f.topic for f in store.match("cam/#")] == ["cam/other"]
+
+
+def test_raw_data_is_sized_as_it_arrived():
+    store = RetainedStore(max_bytes=1024)
+    frame = EncodedMessage("t", raw=b'"' + b"x" * 2000 + b'"')
+    store.put(frame)
+    assert frame.encodes == 0 and store.match("t") == []  # too big, not encoded to find out
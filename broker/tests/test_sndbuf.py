@@ -0,0 +1,48 @@
+"""Payloads much larger than the kernel send buffer reach subscribers whole."""
+
+import json
+import os
+import socket
+import threading
+import time
+
+import pytest
+
+from pubsub_broker import make_broker
+
+SNDBUF = 4096
+PAYLOAD = 256 * 1024
+COUNT = 12
+
+
+@pytest.mark.parametrize("engine", ["thread", "async"])
+def test_large_payloads_through_tiny_sndbuf(engine, free_port):
+    broker = make_broker(engine, host="127.0.0.1", port=free_port(), sndbuf=SNDBUF)
+    broker.start()
+    time.sleep(0.3)
+    try:
+        sub = socket.socket()
+        sub.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SNDBUF)
+        sub.connect(("127.0.0.1", broker.port))
+        sub.settimeout(10)
+        reader = sub.makefile("rb")
+        sub.sendall(b'{"action": "SUB", "topic": "big"}\n')
+        assert json.loads(reader.readline())["status"] == "subscribed"
+
+        sent = [os.urandom(PAYLOAD // 2).hex() for _ in range(COUNT)]
+        lines = [json.dumps({"action": "PUB", "topic": "big", "data": data}).encode() + b"\n"
+                 for data in sent]
+        pub = socket.create_connection(("127.0.0.1", broker.port))
+        # the subscriber does not read until everything is published: the
+        # broker's writes to it can only complete partially
+        publisher = threading.Thread(target=pub.sendall, args=(b"".join(lines),))
+        publisher.start()
+        time.sleep(0.5)
+
+        received = [json.loads(reader.readline()) for _ in range(COUNT)]
+        publisher.join(10)
+        assert [m["data"] for m in received] == sent
+        pub.close()
+        sub.close()
+    finally:
+        broker.stop()